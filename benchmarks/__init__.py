@@ -0,0 +1,5 @@
+"""CPU benchmarks of the performance critical parts of retinal-rl on synthetic data.
+
+Run them with ``python -m benchmarks run`` and compare two result files with
+``python -m benchmarks compare``.
+"""
@@ -0,0 +1,68 @@
+"""Command line interface of the benchmarks.
+
+python -m benchmarks run [-k PATTERN] [-o results.json]
+python -m benchmarks compare baseline.json results.json [--tolerance 0.1]
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import torch
+
+from benchmarks import (  # noqa: F401
+    bench_analysis,
+    bench_checkpoint,
+    bench_environment,
+    bench_imageset,
+    bench_models,
+    bench_scenarios,
+)
+from benchmarks.harness import compare, load_results, run_benchmarks, save_results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmarks")
+    run_parser.add_argument(
+        "-k", "--pattern", help="Only run benchmarks containing this"
+    )
+    run_parser.add_argument(
+        "-o", "--output", type=Path, default=Path("benchmarks.json")
+    )
+    run_parser.add_argument("--repeats", type=int, default=10)
+    run_parser.add_argument("--threads", type=int, default=1, help="Torch CPU threads")
+
+    compare_parser = commands.add_parser(
+        "compare", help="Compare results against a baseline"
+    )
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("results", type=Path)
+    compare_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative slowdown of the median time that counts as a regression",
+    )
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        torch.set_num_threads(args.threads)
+        results = run_benchmarks(args.pattern, args.repeats)
+        save_results(results, args.output)
+        return 0
+
+    regressions = compare(
+        load_results(args.baseline), load_results(args.results), args.tolerance
+    )
+    if regressions:
+        print(f"{len(regressions)} benchmark(s) regressed.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
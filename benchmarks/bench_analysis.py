@@ -0,0 +1,39 @@
+"""Benchmarks of the CNN analyses of the classification framework."""
+
+from typing import Any, Callable
+
+import torch
+from torch import nn
+
+from benchmarks.bench_imageset import synthetic_images
+from benchmarks.bench_models import experiment_config
+from benchmarks.harness import register
+from retinal_rl.analysis.statistics import _compute_receptive_fields, cnn_statistics
+from retinal_rl.classification.imageset import Imageset
+from retinal_rl.classification.transforms import ScaleShiftTransform
+from retinal_rl.models.brain import get_cnn_circuit
+from runner.util import create_brain
+
+_device = torch.device("cpu")
+
+
+@register("cnn_statistics/classification")
+def _cnn_statistics() -> Callable[[], Any]:
+    brain = create_brain(experiment_config("classification").brain)
+    _, height, width = brain.sensors["vision"]
+    source = ScaleShiftTransform(width, height, (1, 1))
+    imageset = Imageset(synthetic_images(32), [source])
+
+    return lambda: cnn_statistics(_device, imageset, brain, False)
+
+
+@register("compute_receptive_fields/classification")
+def _receptive_fields() -> Callable[[], Any]:
+    brain = create_brain(experiment_config("classification").brain)
+    input_shape, cnn_layers = get_cnn_circuit(brain)
+    layers = list(cnn_layers.values())
+    out_channels = [layer for layer in layers if isinstance(layer, nn.Conv2d)][
+        -1
+    ].out_channels
+
+    return lambda: _compute_receptive_fields(_device, layers, input_shape, out_channels)
@@ -0,0 +1,39 @@
+"""Benchmarks of writing checkpoints."""
+
+import tempfile
+from pathlib import Path
+from typing import Any, Callable
+
+import torch
+
+from benchmarks.bench_models import experiment_config
+from benchmarks.harness import register
+from runner.util import CheckpointWriter, create_brain, save_checkpoint
+
+_tmp_dir = tempfile.TemporaryDirectory()
+
+
+@register("save_checkpoint/classification")
+def _save_checkpoint() -> Callable[[], Any]:
+    brain = create_brain(experiment_config("classification").brain)
+    optimizer = torch.optim.AdamW(brain.parameters())
+    histories = {"train_loss": [0.0] * 100, "test_loss": [0.0] * 100}
+    data_dir = Path(_tmp_dir.name)
+    checkpoint_dir = data_dir / "checkpoints"
+    checkpoint_dir.mkdir(exist_ok=True)
+    # The writer scans the checkpoints on disk once, like during training
+    writer = CheckpointWriter(data_dir, checkpoint_dir, 2)
+    epoch = 0
+
+    def save():
+        nonlocal epoch
+        epoch += 1
+        # Perturb the weights, so that shards are not deduplicated
+        with torch.no_grad():
+            for param in brain.parameters():
+                param.add_(1e-3)
+        save_checkpoint(
+            data_dir, checkpoint_dir, 2, brain, optimizer, histories, epoch, writer
+        )
+
+    return save
@@ -0,0 +1,64 @@
+"""Micro-benchmarks of the environment wrappers.
+
+The wrappers are stepped on top of a stub environment that returns a fixed observation,
+so that the timings only contain the overhead of the wrappers. gymnasium and sample
+factory are imported in the setup functions, as they might be missing.
+"""
+
+import time
+from typing import Any, Callable
+
+import numpy as np
+
+from benchmarks.harness import register
+
+_STEPS = 10000
+
+
+def _stub_env() -> Any:
+    import gymnasium as gym
+
+    class StubDoomEnv(gym.Env):
+        """Returns the same frame and health (like VizDoom's get_info) every step."""
+
+        observation_space = gym.spaces.Box(0, 255, (120, 160, 3), dtype=np.uint8)
+        action_space = gym.spaces.Discrete(3)
+
+        def __init__(self):
+            self.frame = np.zeros((120, 160, 3), dtype=np.uint8)
+            self.info = {"HEALTH": 75.0}
+
+        def reset(self, **kwargs):
+            return self.frame, self.info
+
+        def step(self, action):
+            return self.frame, 0.0, False, False, self.info
+
+        def get_info(self):
+            return self.info
+
+    return StubDoomEnv()
+
+
+def _stepper(env: Any) -> Callable[[], Any]:
+    env.reset()
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(_STEPS):
+            env.step(0)
+        return {"steps_per_second": _STEPS / (time.perf_counter() - start)}
+
+    return run
+
+
+@register("environment/stub")
+def _stub() -> Callable[[], Any]:
+    return _stepper(_stub_env())
+
+
+@register("environment/satiety_input")
+def _satiety_input() -> Callable[[], Any]:
+    from retinal_rl.rl.sample_factory.environment import SatietyInput
+
+    return _stepper(SatietyInput(_stub_env()))
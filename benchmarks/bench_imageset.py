@@ -0,0 +1,67 @@
+"""Benchmarks of loading transformed images from an Imageset."""
+
+from typing import Any, Callable, List, Tuple
+
+import numpy as np
+from PIL import Image
+from torch import nn
+
+from benchmarks.harness import register
+from retinal_rl.classification.imageset import Imageset
+from retinal_rl.classification.transforms import (
+    BlurTransform,
+    ContrastTransform,
+    IlluminationTransform,
+    ScaleShiftTransform,
+    ShotNoiseTransform,
+)
+
+IMAGE_SIZE = 32
+VISION_SIZE = 160
+NUM_IMAGES = 64
+
+# Noise transforms, applied on top of a fixed size source transform
+_noise_transforms: List[Tuple[str, Callable[[], nn.Module]]] = [
+    ("none", nn.Identity),
+    ("shot_noise", lambda: ShotNoiseTransform((0.5, 1.5))),
+    ("contrast", lambda: ContrastTransform((0.6, 1.4))),
+    ("illumination", lambda: IlluminationTransform((0.6, 1.4))),
+    ("blur", lambda: BlurTransform((0, 2))),
+]
+
+
+def synthetic_images(
+    num_images: int = NUM_IMAGES, size: int = IMAGE_SIZE
+) -> List[Tuple[Image.Image, int]]:
+    """Random RGB images with labels, standing in for a downloaded dataset."""
+    rng = np.random.default_rng(0)
+    return [
+        (Image.fromarray(rng.integers(0, 256, (size, size, 3), dtype=np.uint8)), i % 10)
+        for i in range(num_images)
+    ]
+
+
+def _imageset_getitem(
+    source_transform: nn.Module, noise_transform: nn.Module
+) -> Callable[[], Any]:
+    imageset = Imageset(synthetic_images(), [source_transform], [noise_transform])
+
+    def load_all():
+        for i in range(len(imageset)):
+            imageset[i]
+
+    return load_all
+
+
+@register("imageset_getitem/scale_shift")
+def _scale_shift() -> Callable[[], Any]:
+    source = ScaleShiftTransform(VISION_SIZE, VISION_SIZE, (1, 4))
+    return _imageset_getitem(source, nn.Identity())
+
+
+for _name, _transform in _noise_transforms:
+    register(f"imageset_getitem/{_name}")(
+        lambda transform=_transform: _imageset_getitem(
+            ScaleShiftTransform(VISION_SIZE, VISION_SIZE, (1, 1)), transform()
+        )
+    )
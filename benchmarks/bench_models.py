@@ -0,0 +1,80 @@
+"""Benchmarks of the forward and backward passes of the configured brains."""
+
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+import hydra
+import torch
+from hydra.utils import instantiate
+from omegaconf import DictConfig, OmegaConf
+
+from benchmarks.harness import register
+from retinal_rl.classification.loss import get_classification_context
+from retinal_rl.models.brain import Brain
+from runner.util import create_brain
+
+BATCH_SIZE = 16
+
+_root = Path(__file__).parent.parent
+_experiments = sorted(
+    path.stem
+    for path in (_root / "resources/config_templates/user/experiment").glob("*.yaml")
+)
+
+
+def experiment_config(experiment: str) -> DictConfig:
+    """Compose the config of an experiment from the config templates."""
+    if not OmegaConf.has_resolver("eval"):
+        OmegaConf.register_new_resolver("eval", eval)
+    with hydra.initialize(config_path="../config/base", version_base=None):
+        return hydra.compose(
+            "config",
+            overrides=[
+                f"+experiment={experiment}",
+                "system.device=cpu",
+                f"hydra.searchpath=[file://{_root / 'resources/config_templates/user'}]",
+            ],
+        )
+
+
+def random_stimulus(
+    brain: Brain, batch_size: int = BATCH_SIZE
+) -> Dict[str, torch.Tensor]:
+    return {
+        sensor: torch.rand(batch_size, *shape)
+        for sensor, shape in brain.sensors.items()
+    }
+
+
+def _brain_forward(experiment: str) -> Callable[[], Any]:
+    brain = create_brain(experiment_config(experiment).brain)
+    brain.eval()
+    stimulus = random_stimulus(brain)
+
+    def forward():
+        with torch.no_grad():
+            brain(stimulus)
+
+    return forward
+
+
+for _experiment in _experiments:
+    register(f"brain_forward/{_experiment}")(
+        lambda experiment=_experiment: _brain_forward(experiment)
+    )
+
+
+@register("objective_backward/classification")
+def _objective_backward() -> Callable[[], Any]:
+    cfg = experiment_config("classification")
+    brain = create_brain(cfg.brain)
+    objective = instantiate(cfg.optimizer.objective, brain=brain)
+    stimulus = random_stimulus(brain)["vision"]
+    batch = (stimulus, stimulus, torch.randint(0, 10, (BATCH_SIZE,)))
+
+    def backward():
+        context = get_classification_context(torch.device("cpu"), brain, batch, 1)
+        objective.backward(context)
+        brain.zero_grad(set_to_none=True)
+
+    return backward
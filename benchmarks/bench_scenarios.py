@@ -0,0 +1,108 @@
+"""Benchmarks of building and starting scenarios with large texture sets.
+
+The doom_creator and sample factory imports are deferred to the setup functions, as
+they need the scenario build tools (omgifol, acc) and VizDoom, which might be missing.
+"""
+
+import functools
+import os
+import tempfile
+from pathlib import Path
+from typing import Any, Callable, Tuple
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.harness import register
+
+_tmp_dir = tempfile.TemporaryDirectory()
+
+_CLASSES = [
+    "zero",
+    "one",
+    "two",
+    "three",
+    "four",
+    "five",
+    "six",
+    "seven",
+    "eight",
+    "nine",
+]
+_TEXTURES_PER_CLASS = 1000
+
+
+@functools.lru_cache
+def _scenario_sources() -> Tuple[Any, Any]:
+    """Directories with synthetic MNIST-like textures, and the gathering-mnist config."""
+    from doom_creator.util.config import load
+    from doom_creator.util.directories import Directories
+    from doom_creator.util.preload import doomify
+
+    directories = Directories(Path(_tmp_dir.name, "cache"))
+    rng = np.random.default_rng(0)
+    for name in _CLASSES:
+        class_dir = Path(directories.TEXTURES_DIR, "mnist", name)
+        class_dir.mkdir(parents=True)
+        for i in range(_TEXTURES_PER_CLASS):
+            pixels = rng.integers(0, 256, (28, 28), dtype=np.uint8)
+            img, pnginfo = doomify(Image.fromarray(pixels), 2)
+            img.save(class_dir / f"{i}.png", pnginfo=pnginfo)
+    cfg = load(["gathering", "mnist"], directories.SCENARIO_YAML_DIR)
+    return cfg, directories
+
+
+def _build(packed: bool) -> Tuple[str, Callable[[], Any]]:
+    from doom_creator.util.make import make_scenario
+
+    cfg, directories = _scenario_sources()
+    name = "packed" if packed else "loose"
+    out_file = Path(directories.SCENARIO_OUT_DIR, name + ".zip")
+
+    def build():
+        make_scenario(cfg, directories, name, progress=False, force=True, packed=packed)
+        return {"archive_bytes": os.path.getsize(out_file)}
+
+    return name, build
+
+
+def _env_startup(packed: bool) -> Callable[[], Any]:
+    from retinal_rl.rl.sample_factory.environment import (
+        make_retinal_env_from_spec,
+        retinal_doomspec,
+    )
+    from runner.frameworks.rl.sf_framework import SFFramework
+
+    name, build = _build(packed)
+    build()
+    _, directories = _scenario_sources()
+    cfg_path = os.path.join(directories.SCENARIO_OUT_DIR, name + ".cfg")
+    spec = retinal_doomspec(name, cfg_path, False)
+    sf_cfg = SFFramework._get_default_cfg(name)
+
+    def start():
+        env = make_retinal_env_from_spec(spec, name, sf_cfg, None)
+        env.reset()
+        env.close()
+
+    return start
+
+
+@register("scenario_build/loose")
+def _build_loose() -> Callable[[], Any]:
+    return _build(packed=False)[1]
+
+
+@register("scenario_build/packed")
+def _build_packed() -> Callable[[], Any]:
+    return _build(packed=True)[1]
+
+
+@register("env_startup/loose")
+def _env_startup_loose() -> Callable[[], Any]:
+    return _env_startup(packed=False)
+
+
+@register("env_startup/packed")
+def _env_startup_packed() -> Callable[[], Any]:
+    return _env_startup(packed=True)
@@ -0,0 +1,143 @@
+"""Registry, timing and comparison of benchmarks."""
+
+import json
+import platform
+import statistics
+import subprocess
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+# A benchmark is a setup function returning the callable that is timed
+Setup = Callable[[], Callable[[], Any]]
+
+_benchmarks: Dict[str, Setup] = {}
+
+
+@dataclass
+class Result:
+    """Timings of a benchmark in seconds per call.
+
+    Benchmarks returning a dict of numbers (e.g. sizes) report it as metrics.
+    """
+
+    median: float
+    mean: float
+    min: float
+    std: float
+    repeats: int
+    metrics: Optional[Dict[str, float]] = None
+
+
+def register(name: str) -> Callable[[Setup], Setup]:
+    """Register a benchmark setup function under the given name."""
+
+    def decorator(setup: Setup) -> Setup:
+        if name in _benchmarks:
+            raise ValueError(f"Benchmark {name} is already registered")
+        _benchmarks[name] = setup
+        return setup
+
+    return decorator
+
+
+def measure(fn: Callable[[], Any], repeats: int, warmup: int = 1) -> Result:
+    """Time repeated calls of fn after some warmup calls."""
+    for _ in range(warmup):
+        fn()
+    times: List[float] = []
+    output = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = fn()
+        times.append(time.perf_counter() - start)
+    return Result(
+        median=statistics.median(times),
+        mean=statistics.mean(times),
+        min=min(times),
+        std=statistics.stdev(times) if repeats > 1 else 0.0,
+        repeats=repeats,
+        metrics=output if isinstance(output, dict) else None,
+    )
+
+
+def run_benchmarks(
+    pattern: Optional[str] = None, repeats: int = 10, seed: int = 0
+) -> Dict[str, Any]:
+    """Run all registered benchmarks whose name contains pattern, and return the results."""
+    results: Dict[str, Dict[str, Any]] = {}
+    for name, setup in sorted(_benchmarks.items()):
+        if pattern is not None and pattern not in name:
+            continue
+        torch.manual_seed(seed)
+        np.random.seed(seed)
+        try:
+            result = measure(setup(), repeats)
+        except Exception as e:
+            # A broken benchmark should not prevent the others from running
+            results[name] = {"error": f"{type(e).__name__}: {e}"}
+            print(f"{name:<50} {'FAILED':>13} ({type(e).__name__})")
+            continue
+        results[name] = result.__dict__
+        print(f"{name:<50} {1000 * result.median:10.3f} ms")
+    return {"metadata": _metadata(), "benchmarks": results}
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], tolerance: float = 0.1
+) -> List[Tuple[str, float, float, float]]:
+    """Print the median times of both results side by side and return the regressions.
+
+    A benchmark regresses if its median time grew by more than the tolerance (relative).
+    """
+    regressions: List[Tuple[str, float, float, float]] = []
+    print(f"{'benchmark':<50} {'baseline':>12} {'current':>12} {'ratio':>8}")
+    for name, result in sorted(current["benchmarks"].items()):
+        if "error" in result or "error" in baseline["benchmarks"].get(name, {}):
+            print(f"{name:<50} {'failed':>12}")
+            continue
+        if name not in baseline["benchmarks"]:
+            print(f"{name:<50} {'-':>12} {1000 * result['median']:10.3f}ms {'new':>8}")
+            continue
+        base = baseline["benchmarks"][name]["median"]
+        ratio = result["median"] / base
+        flag = "  REGRESSION" if ratio > 1 + tolerance else ""
+        print(
+            f"{name:<50} {1000 * base:10.3f}ms {1000 * result['median']:10.3f}ms"
+            f" {ratio:8.2f}{flag}"
+        )
+        if flag:
+            regressions.append((name, base, result["median"], ratio))
+    return regressions
+
+
+def save_results(results: Dict[str, Any], path: Path) -> None:
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path: Path) -> Dict[str, Any]:
+    with open(path) as f:
+        return json.load(f)
+
+
+def _metadata() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "torch_threads": torch.get_num_threads(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
@@ -8,16 +8,21 @@ Usage:
     python -m exec.compile-scenario [options] [yaml_files...]
 
 Example:
-    python -m exec.compile-scenario gathering apples"""
+    python -m exec.compile-scenario gathering apples
+
+Several scenarios can be compiled concurrently with --batch, e.g.
+    python -m doom_creator.compile_scenario --batch gathering,apples gathering,mnist --both_splits"""
 
 import argparse
 import os
 import sys
 import warnings
+from typing import List, Optional, Tuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED
 
-from doom_creator.util.config import load
+from doom_creator.util.config import Config, load
 from doom_creator.util.directories import Directories
-from doom_creator.util.make import make_scenario
+from doom_creator.util.make import make_scenario, make_scenarios
 from doom_creator.util.preload import check_preload, preload
 from doom_creator.util.texture import TextureType as TType
 
@@ -81,6 +86,49 @@ def make_parser():
         action="store_true",
         help="Preload resources",
     )
+    parser.add_argument(
+        "--batch",
+        nargs="+",
+        metavar="YAMLS",
+        help="""Compile several scenarios concurrently, each given as comma separated
+        names of component yaml files (e.g. gathering,apples gathering,mnist).""",
+    )
+    parser.add_argument(
+        "--both_splits",
+        action="store_true",
+        help="In batch mode, compile train and test splits of dataset scenarios",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="""Number of processes preloading dataset textures and compiling scenarios
+        in batch mode (default: all cores)""",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild scenarios even if their config, textures and templates didn't change",
+    )
+    parser.add_argument(
+        "--packed",
+        action="store_true",
+        help="""Pack all sprites into a single WAD inside the scenario zip, which is
+        faster to build and load for large (dataset) texture sets""",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=["stored", "deflated"],
+        default="stored",
+        help="""How to write the scenario zip. Textures are PNGs, which are already
+        compressed, so storing them is much faster at almost the same size.""",
+    )
+    parser.add_argument(
+        "--compresslevel",
+        type=int,
+        default=None,
+        help="Compression level (0-9) if deflated",
+    )
     # List the contents of the scenario yaml directory
     parser.add_argument(
         "--list_yamls",
@@ -90,6 +138,39 @@ def make_parser():
     return parser
 
 
+def prepare_scenario(
+    yamls: List[str],
+    dirs: Directories,
+    test: bool,
+    dataset_dir: Optional[str] = None,
+    name: Optional[str] = None,
+    num_workers: Optional[int] = None,
+) -> Tuple[Config, str, bool]:
+    """
+    Load the config of a scenario and preload the textures it needs.
+
+    Returns:
+        Tuple[Config, str, bool]: The config, the scenario name and whether the
+        scenario uses dataset textures (i.e. has a test split).
+    """
+    cfg = load(yamls, dirs.SCENARIO_YAML_DIR)
+    cfg, needed_types = check_preload(cfg, test)
+    any_dataset = False
+    for t in needed_types:
+        any_dataset = any_dataset or t.is_dataset
+        if t.is_asset:
+            preload(t, dirs.TEXTURES_DIR, dirs.ASSETS_DIR)
+        else:
+            preload(t, dirs.TEXTURES_DIR, dataset_dir, not test, num_workers)
+    if not any_dataset:
+        warnings.warn("No test set will be created - no dataset textures used!")
+    scenario_name = name
+    if name is None:
+        scenario_name = "-".join(yamls)
+        scenario_name += "-test" if test and any_dataset else ""
+    return cfg, scenario_name, any_dataset
+
+
 def main():
     """
     Main function to parse arguments and execute scenario compilation tasks.
@@ -106,41 +187,64 @@ def main():
     args = parser.parse_args(argv)
 
     dirs = Directories(args.out_dir)
+    build_options = {
+        "compression": ZIP_DEFLATED if args.compression == "deflated" else ZIP_STORED,
+        "compresslevel": args.compresslevel,
+        "packed": args.packed,
+    }
 
-    cfg = load(args.yamls, dirs.SCENARIO_YAML_DIR)
     # Check preload flag
     do_load, do_make, do_list = args.preload, len(args.yamls) > 0, args.list_yamls
+    do_batch = args.batch is not None
     if do_load:
         preload(TType.APPLES, dirs.TEXTURES_DIR, dirs.ASSETS_DIR)
         preload(TType.OBSTACLES, dirs.TEXTURES_DIR, dirs.ASSETS_DIR)
         preload(TType.GABORS, dirs.TEXTURES_DIR, dirs.ASSETS_DIR)
 
-        preload(TType.MNIST, dirs.TEXTURES_DIR, args.dataset_dir, train=not args.test)
-        preload(TType.CIFAR10, dirs.TEXTURES_DIR, args.dataset_dir, train=not args.test)
+        for t in [TType.MNIST, TType.CIFAR10]:
+            preload(t, dirs.TEXTURES_DIR, args.dataset_dir, not args.test, args.workers)
     if do_list:
         print(f"Listing contents of {dirs.SCENARIO_YAML_DIR}:")
         for flnm in os.listdir(dirs.SCENARIO_YAML_DIR):
             print(flnm)
         print("If you want to load from a different folder, change this to")
     if do_make:
-        cfg, needed_types = check_preload(cfg, args.test)
-        any_dataset = False
-        for t in needed_types:
-            any_dataset = any_dataset or t.is_dataset
-            if t.is_asset:
-                preload(t, dirs.TEXTURES_DIR, dirs.ASSETS_DIR)
-            else:
-                preload(t, dirs.TEXTURES_DIR, args.dataset_dir, train=not args.test)
-        if not any_dataset:
-            warnings.warn("No test set will be created - no dataset textures used!")
-        scenario_name = args.name
-        if args.name is None:
-            scenario_name = "-".join(args.yamls)
-            scenario_name += "-test" if args.test and any_dataset else ""
-        make_scenario(cfg, dirs, scenario_name)
-    if not (do_load or do_make or do_list):  # no positional - warn
+        cfg, scenario_name, _ = prepare_scenario(
+            args.yamls, dirs, args.test, args.dataset_dir, args.name, args.workers
+        )
+        if not make_scenario(
+            cfg, dirs, scenario_name, force=args.force, **build_options
+        ):
+            print(f"Scenario {scenario_name} is up to date.")
+    if do_batch:
+        scenarios = batch_scenarios(args, dirs)
+        built = make_scenarios(
+            scenarios, dirs, args.workers, force=args.force, **build_options
+        )
+        print(
+            f"Built {built} of {len(scenarios)} scenarios, the others are up to date."
+        )
+    if not (do_load or do_make or do_list or do_batch):  # no positional - warn
         print("No yaml files provided. Nothing to do.")
 
 
+def batch_scenarios(
+    args: argparse.Namespace, dirs: Directories
+) -> List[Tuple[Config, str]]:
+    """Prepare the (config, name) pairs of all scenarios and splits of a batch."""
+    splits = [False, True] if args.both_splits else [args.test]
+    scenarios: List[Tuple[Config, str]] = []
+    for spec in args.batch:
+        for test in splits:
+            cfg, scenario_name, any_dataset = prepare_scenario(
+                spec.split(","), dirs, test, args.dataset_dir, num_workers=args.workers
+            )
+            # Without dataset textures the test split is the train split
+            if test and not any_dataset and len(splits) > 1:
+                continue
+            scenarios.append((cfg, scenario_name))
+    return scenarios
+
+
 if __name__ == "__main__":
     sys.exit(main())
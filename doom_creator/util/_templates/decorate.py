@@ -42,8 +42,8 @@ ACTOR {name} : CustomInventory {{
 """
 
 
-def states_template(index: int, texture_code: str):
-    return f"Texture{index}: {texture_code} A -1\n\t"
+def states_template(index: int, texture_code: str, frame: str = "A"):
+    return f"Texture{index}: {texture_code} {frame} -1\n\t"
 
 
 def include(actor_name: str):
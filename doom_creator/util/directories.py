@@ -9,6 +9,7 @@ class Directories:
     resource_dir: Path = Path("doom_creator", "resources")
     scenario_out_dir: Optional[Path] = None
     build_dir: Optional[Path] = None
+    build_cache_dir: Optional[Path] = None
     textures_dir: Optional[Path] = None
     assets_dir: Optional[Path] = None
     scenario_yaml_dir: Optional[Path] = None
@@ -26,6 +27,11 @@ class Directories:
             if self.build_dir is None
             else self.build_dir
         )
+        self.BUILD_CACHE_DIR: Path = (
+            Path(self.CACHE_DIR, "build-cache")
+            if self.build_cache_dir is None
+            else self.build_cache_dir
+        )
         self.TEXTURES_DIR: Path = (
             Path(self.CACHE_DIR, "textures")
             if self.textures_dir is None
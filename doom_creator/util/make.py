@@ -1,29 +1,113 @@
+import contextlib
+import hashlib
+import json
 import os
 import os.path as osp
 import shutil
+import struct
 import subprocess
-from typing import Dict, List, Optional
-from zipfile import ZipFile, ZipInfo
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
 
 import omg
 from tqdm import tqdm
 
 from doom_creator.util import config, templates
 from doom_creator.util.directories import Directories
+from doom_creator.util.manifest import TextureManifest
 
 
 ### Creating Scenarios ###
+def make_scenarios(
+    scenarios: List[Tuple[config.Config, str]],
+    directories: Directories,
+    num_workers: Optional[int] = None,
+    compression: int = ZIP_STORED,
+    compresslevel: Optional[int] = None,
+    force: bool = False,
+    packed: bool = False,
+) -> int:
+    """Compile several (config, scenario_name) pairs concurrently in a process pool.
+
+    The textures of all scenarios are indexed once up front and shared by the workers,
+    so the texture directories are not walked again for every scenario. Textures have
+    to be preloaded before. Returns the number of scenarios that were (re)built.
+    """
+    texture_index = index_textures(
+        osp.join(directories.CACHE_DIR, "textures"),
+        [png_pth for cfg, _ in scenarios for png_pth in _texture_pths(cfg)],
+    )
+    with ProcessPoolExecutor(num_workers) as pool:
+        futures = [
+            pool.submit(
+                make_scenario,
+                cfg,
+                directories,
+                scenario_name,
+                compression,
+                compresslevel,
+                texture_index,
+                False,
+                force,
+                packed,
+            )
+            for cfg, scenario_name in scenarios
+        ]
+        return sum(
+            future.result()
+            for future in tqdm(
+                as_completed(futures), total=len(futures), desc="Compiling scenarios"
+            )
+        )
+
+
 def make_scenario(
     cfg: config.Config,
     directories: Directories,
     scenario_name: Optional[str] = None,
-):
-    # Create Zip for output
+    compression: int = ZIP_STORED,
+    compresslevel: Optional[int] = None,
+    texture_index: Optional[Dict[str, List[str]]] = None,
+    progress: bool = True,
+    force: bool = False,
+    packed: bool = False,
+) -> bool:
+    """Compile a scenario into a zip in the scenario output directory.
+
+    Zip members are written with the given compression (see zipfile). The default is to
+    store them uncompressed, since most of the archive are PNGs, which are compressed
+    already. Scenarios are built in their own build directory, so that several of them
+    can be compiled at the same time (see make_scenarios).
+
+    Builds are incremental: the scenario is only rebuilt if the hash of its config,
+    textures and templates changed since the last build (or if force is set), and
+    compiled ACS and map WADs are cached in the build cache by the hash of their
+    sources. Returns whether the scenario was (re)built.
+
+    If packed is set, all sprites are written into a single WAD in the zip (see
+    write_sprite_wad) instead of one zip member per sprite, and sprites are numbered
+    by frame as well, which allows up to 26^4 instead of 26^3 textures per actor. In
+    both modes, a .textures.json next to the zip lists the source png of every sprite.
+    """
+    actors = collect_actors(cfg, directories, texture_index)
+
     directories.SCENARIO_OUT_DIR.mkdir(parents=True, exist_ok=True)
     out_file = osp.join(directories.SCENARIO_OUT_DIR, scenario_name) + ".zip"
-    if osp.exists(out_file):
-        os.remove(out_file)
-    s_zip = ZipFile(out_file, "x")
+    config_file = osp.join(directories.SCENARIO_OUT_DIR, scenario_name) + ".cfg"
+    hash_file = osp.join(directories.SCENARIO_OUT_DIR, scenario_name) + ".hash"
+    build_hash = scenario_hash(
+        cfg, directories, actors, compression, compresslevel, packed
+    )
+    up_to_date = osp.exists(out_file) and osp.exists(config_file)
+    if not force and up_to_date and _read_hash(hash_file) == build_hash:
+        return False
+
+    # Create Zip for output, which replaces the old one once it is complete
+    tmp_file = out_file + ".tmp"
+    s_zip = ZipFile(tmp_file, "w", compression=compression, compresslevel=compresslevel)
 
     # Create directories in zip
     dirs = ["acs", "maps", "sprites", "actors", "textures"]
@@ -49,36 +133,40 @@ def make_scenario(
     # Building decorate and loading textures
     actor_names = []
     actor_num_textures = []
+    sprites: List[Tuple[str, str]] = []  # (lump name, png)
 
     include_decorate = ""
-    actor_idx = 0
-    for typ, type_cfg in tqdm(cfg.objects.items(), desc="Creating Objects"):
-        for actor_name, actor_cfg in tqdm(
-            type_cfg.actors.items(), desc="Creating " + typ.value, leave=False
+    for actor_idx, (typ, actor_name, pngs) in enumerate(
+        tqdm(actors, desc="Creating Objects", disable=not progress)
+    ):
+        num_textures = len(pngs)
+
+        sprite_frames = make_sprite_frames(actor_idx, num_textures, packed)
+        sprites += [
+            (sprite_name + frame + "0", png)
+            for (sprite_name, frame), png in zip(sprite_frames, pngs)
+        ]
+
+        actor_names.append(actor_name)
+        actor_num_textures.append(num_textures)
+
+        dec = make_actor_decorate(actor_name, typ, sprite_frames)
+        s_zip.writestr(osp.join("actors", actor_name + ".dec"), dec)
+        include_decorate += templates.decorate.include(actor_name)
+
+    # Add pngs as sprites
+    if packed:
+        write_sprite_wad(s_zip, sprites)
+    else:
+        for lump_name, png in tqdm(
+            sprites, desc="Adding textures", leave=False, disable=not progress
         ):
-            actor_name = actor_name.replace("-", "_")  # Make name ACS compatible
-            # get all pngs listend in pngpths and subdirs
-            png_pths = actor_cfg.textures
-            pngs = get_pngs(osp.join(directories.CACHE_DIR, "textures"), png_pths)
-            num_textures = len(pngs)
-
-            sprite_names = [actor_code(actor_idx, i) for i in range(num_textures)]
-            # Add pngs as sprites
-            for j, png in tqdm(
-                enumerate(pngs),
-                desc="add textures for " + actor_name,
-                leave=False,
-                total=num_textures,
-            ):
-                s_zip.write(png, osp.join("sprites", sprite_names[j] + "A0.png"))
-
-            actor_idx += 1
-            actor_names.append(actor_name)
-            actor_num_textures.append(num_textures)
-
-            dec = make_actor_decorate(actor_name, typ, sprite_names)
-            s_zip.writestr(osp.join("actors", actor_name + ".dec"), dec)
-            include_decorate += templates.decorate.include(actor_name)
+            s_zip.write(png, osp.join("sprites", lump_name + ".png"))
+    write_sprite_index(
+        osp.join(directories.SCENARIO_OUT_DIR, scenario_name) + ".textures.json",
+        osp.join(directories.CACHE_DIR, "textures"),
+        sprites,
+    )
 
     # Write decorate include to root
     s_zip.writestr("DECORATE.txt", include_decorate)
@@ -86,14 +174,14 @@ def make_scenario(
     ## Create ACS ##
 
     # Defining pths
-    if osp.exists(directories.BUILD_DIR):
-        shutil.rmtree(directories.BUILD_DIR)
-    os.mkdir(directories.BUILD_DIR)
+    build_dir = Path(directories.BUILD_DIR, scenario_name)
+    if osp.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+    directories.BUILD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
     retinal_acs_pth = osp.join(directories.ASSETS_DIR, "acs", "retinal.acs")
-    map_acs_pth = osp.join(directories.BUILD_DIR, scenario_name) + ".acs"
-    retinal_comp_pth = osp.join(directories.BUILD_DIR, "retinal.o")
-    map_comp_pth = map_acs_pth[:-3] + "o"  # Replace ".acs" ending with ".o"
+    map_acs_pth = osp.join(build_dir, scenario_name) + ".acs"
 
     acs = make_acs(
         cfg.objects,
@@ -107,10 +195,23 @@ def make_scenario(
     with open(map_acs_pth, "w") as f:
         f.write(acs)
 
-    # Compile ACS
-    subprocess.call(["acc", "-i", "/usr/share/acc", retinal_acs_pth, retinal_comp_pth])
-    subprocess.call(
-        ["acc", "-i", "/usr/share/acc", "-i", directories.ASSETS_DIR, map_acs_pth]
+    # Compile ACS (the map includes retinal.acs)
+    retinal_comp_pth = _cache_file(directories, [retinal_acs_pth], ".o")
+    map_comp_pth = _cache_file(directories, [retinal_acs_pth, map_acs_pth], ".o")
+    compile_acs(
+        [
+            (["-i", "/usr/share/acc", retinal_acs_pth], retinal_comp_pth),
+            (
+                [
+                    "-i",
+                    "/usr/share/acc",
+                    "-i",
+                    str(directories.ASSETS_DIR),
+                    map_acs_pth,
+                ],
+                map_comp_pth,
+            ),
+        ]
     )
 
     # For completeness, add retinal and map acs to zip
@@ -119,27 +220,145 @@ def make_scenario(
     s_zip.write(map_acs_pth, "behavior.acs")
 
     # Map Wad
+    s_zip.write(make_map_wad(directories, map_comp_pth), osp.join("maps", "MAP01.wad"))
+    s_zip.close()
+    os.replace(tmp_file, out_file)
+
+    # Cleanup (the build dir is shared by scenarios built at the same time)
+    shutil.rmtree(build_dir)
+    with contextlib.suppress(OSError):
+        os.rmdir(directories.BUILD_DIR)
+
+    # Copy vizdoom config
+    # add doom_scenario_pth to beginning of cfg
+    with open(config_file, "w") as f:
+        f.write(templates.vizdoom.config(scenario_name=scenario_name))
+
+    # Mark the build as complete
+    with open(hash_file, "w") as f:
+        f.write(build_hash)
+    return True
+
+
+def collect_actors(
+    cfg: config.Config,
+    directories: Directories,
+    texture_index: Optional[Dict[str, List[str]]] = None,
+) -> List[Tuple[config.ObjectType, str, List[str]]]:
+    """Returns the type, (ACS compatible) name and texture pngs of all actors"""
+    textures_dir = osp.join(directories.CACHE_DIR, "textures")
+    if texture_index is None:
+        texture_index = index_textures(textures_dir, _texture_pths(cfg))
+
+    actors = []
+    for typ, type_cfg in cfg.objects.items():
+        for actor_name, actor_cfg in type_cfg.actors.items():
+            # get all pngs listend in pngpths and subdirs
+            pngs = get_pngs(textures_dir, actor_cfg.textures, texture_index)
+            actors.append((typ, actor_name.replace("-", "_"), pngs))
+    return actors
+
+
+def _texture_pths(cfg: config.Config) -> List[str]:
+    return [
+        png_pth
+        for type_cfg in cfg.objects.values()
+        for actor_cfg in type_cfg.actors.values()
+        for png_pth in actor_cfg.textures
+    ]
+
+
+def compile_acs(compilations: List[Tuple[List[str], str]]) -> None:
+    """Compiles (acc arguments, output) pairs whose output doesn't exist yet.
+
+    The compilers run at the same time. Outputs are written to a temporary file first,
+    so that scenarios built concurrently never read a partially written output.
+    """
+    processes = []
+    for args, out_pth in compilations:
+        if osp.exists(out_pth):
+            continue
+        tmp_pth = f"{out_pth[:-2]}-{os.getpid()}.o"
+        processes.append((subprocess.Popen(["acc", *args, tmp_pth]), tmp_pth, out_pth))
+    for process, tmp_pth, out_pth in processes:
+        if process.wait() != 0:
+            raise RuntimeError(f"Compiling {out_pth} failed: acc {process.args}")
+        os.replace(tmp_pth, out_pth)
+
+
+def make_map_wad(directories: Directories, map_comp_pth: str) -> str:
+    """Returns the (cached) map wad for the compiled map ACS"""
+    textmap_pth = osp.join(directories.ASSETS_DIR, "TEXTMAP.txt")
+    map_pth = _cache_file(directories, [textmap_pth, map_comp_pth], ".wad")
+    if osp.exists(map_pth):
+        return map_pth
+
     wad = omg.WAD()
     map_lump = omg.LumpGroup()
-    map_lump["TEXTMAP"] = omg.Lump(
-        from_file=osp.join(directories.ASSETS_DIR, "TEXTMAP.txt")
-    )
+    map_lump["TEXTMAP"] = omg.Lump(from_file=textmap_pth)
     map_lump["BEHAVIOR"] = omg.Lump(from_file=map_comp_pth)
     wad.udmfmaps["MAP01"] = omg.UMapEditor(map_lump).to_lumps()
 
-    # Save wad to map and add to zip
-    map_pth = osp.join(directories.BUILD_DIR, "MAP01.wad")
-    wad.to_file(map_pth)
-    s_zip.write(map_pth, osp.join("maps", "MAP01.wad"))
+    tmp_pth = f"{map_pth[:-4]}-{os.getpid()}.wad"
+    wad.to_file(tmp_pth)
+    os.replace(tmp_pth, map_pth)
+    return map_pth
 
-    # Cleanup
-    shutil.rmtree(directories.BUILD_DIR)
 
-    # Copy vizdoom config
-    config_name = scenario_name + ".cfg"
-    # add doom_scenario_pth to beginning of cfg
-    with open(osp.join(directories.SCENARIO_OUT_DIR, config_name), "w") as f:
-        f.write(templates.vizdoom.config(scenario_name=scenario_name))
+### Build Hashes ###
+
+
+def scenario_hash(
+    cfg: config.Config,
+    directories: Directories,
+    actors: List[Tuple[config.ObjectType, str, List[str]]],
+    compression: int = ZIP_STORED,
+    compresslevel: Optional[int] = None,
+    packed: bool = False,
+) -> str:
+    """Hash of everything a scenario is built from.
+
+    This covers the config, the texture set (paths, sizes and modification times of
+    the pngs), the assets and templates, and this module itself.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(repr((cfg, compression, compresslevel, packed)).encode())
+    for _, actor_name, pngs in actors:
+        hasher.update(actor_name.encode())
+        for png in pngs:
+            stat = os.stat(png)
+            hasher.update(f"{png}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+
+    templates_dir = osp.join(osp.dirname(__file__), "_templates")
+    sources = [
+        __file__,
+        *sorted(glob(osp.join(templates_dir, "*.py"))),
+        *sorted(glob(osp.join(directories.ASSETS_DIR, "acs", "*"))),
+        *[
+            osp.join(directories.ASSETS_DIR, asset)
+            for asset in ["grass.png", "wind.png", "MAPINFO.txt", "TEXTMAP.txt"]
+        ],
+    ]
+    for source in sources:
+        with open(source, "rb") as f:
+            hasher.update(hashlib.sha256(f.read()).digest())
+    return hasher.hexdigest()
+
+
+def _cache_file(directories: Directories, sources: List[str], suffix: str) -> str:
+    """Path in the build cache for an artifact built from the given source files"""
+    hasher = hashlib.sha256()
+    for source in sources:
+        with open(source, "rb") as f:
+            hasher.update(hashlib.sha256(f.read()).digest())
+    return osp.join(directories.BUILD_CACHE_DIR, hasher.hexdigest() + suffix)
+
+
+def _read_hash(hash_file: str) -> Optional[str]:
+    if not osp.exists(hash_file):
+        return None
+    with open(hash_file) as f:
+        return f.read().strip()
 
 
 ### Building ACS files ###
@@ -215,20 +434,81 @@ def texture_code(j):
     return chr(65 + j // 26**2) + chr(65 + (j // 26) % 26) + chr(65 + j % 26)
 
 
+def make_sprite_frames(
+    actor_idx: int, num_textures: int, packed: bool = False
+) -> List[Tuple[str, str]]:
+    """Returns the (sprite name, frame) of each texture of an actor.
+
+    Every texture is a sprite of its own with frame A, or if packed, textures are
+    distributed over the 26 frames (A-Z) of each sprite.
+    """
+    frames = 26 if packed else 1
+    if num_textures > frames * 26**3:
+        raise ValueError(
+            f"Actor {actor_idx} has {num_textures} textures, but only "
+            f"{frames * 26**3} are possible{'' if packed else ' (use packed)'}."
+        )
+    return [
+        (actor_code(actor_idx, j // frames), chr(65 + j % frames))
+        for j in range(num_textures)
+    ]
+
+
+def write_sprite_wad(
+    s_zip: ZipFile, sprites: List[Tuple[str, str]], arcname: str = "sprites.wad"
+):
+    """Writes (lump name, png) sprites into a single WAD member of the zip.
+
+    The pngs are lumps between S_START and S_END markers, and the WAD directory indexes
+    them. Like GZDoom, VizDoom loads WADs in the root of the scenario zip, so this is
+    equivalent to one zip member per sprite, but much faster to write and load for
+    large texture sets. The pngs are streamed into the zip, and never held in memory.
+    """
+    sizes = [os.path.getsize(png) for _, png in sprites]
+    lumps = [
+        ("S_START", 0),
+        *[(lump_name, size) for (lump_name, _), size in zip(sprites, sizes)],
+        ("S_END", 0),
+    ]
+    header_size = 12
+    with s_zip.open(arcname, "w", force_zip64=True) as f:
+        f.write(struct.pack("<4sii", b"PWAD", len(lumps), header_size + sum(sizes)))
+        for _, png in sprites:
+            with open(png, "rb") as src:
+                shutil.copyfileobj(src, f)
+        # Directory: offset, size and name of every lump
+        offset = header_size
+        for lump_name, size in lumps:
+            f.write(struct.pack("<ii8s", offset, size, lump_name.encode()))
+            offset += size
+
+
+def write_sprite_index(
+    index_file: str, textures_dir: str, sprites: List[Tuple[str, str]]
+):
+    """Writes the (textures_dir relative) source png of every sprite lump as json"""
+    index = {lump_name: osp.relpath(png, textures_dir) for lump_name, png in sprites}
+    with open(index_file, "w") as f:
+        json.dump(index, f, indent=0)
+
+
 def make_actor_decorate(
-    actor_name: str, typ: config.ObjectType, sprite_names: list[str]
+    actor_name: str, typ: config.ObjectType, sprite_frames: List[Tuple[str, str]]
 ):
     """Returns the decorate description for an actor as a str.
 
     Keyword arguments:
     actor_name -- name of the actor
     typ -- (nourishment, poison, obstacle, distractor)
-    Each sprite img is used as an individual state.
+    sprite_frames -- (sprite name, frame) of each texture
+    Each sprite frame is used as an individual state.
     """
     states = ""
 
-    for i, sprite_name in enumerate(sprite_names):
-        states += templates.decorate.states_template(index=i, texture_code=sprite_name)
+    for i, (sprite_name, frame) in enumerate(sprite_frames):
+        states += templates.decorate.states_template(
+            index=i, texture_code=sprite_name, frame=frame
+        )
 
     if typ is config.ObjectType.nourishment:
         decorate = templates.decorate.nourishment(
@@ -250,10 +530,28 @@ def make_actor_decorate(
     return decorate
 
 
-def get_pngs(base_pth: str, png_pths: list[str]):
-    """Returns all .png files in subdirs of each png_pth (with base_pth used as root dir)"""
+def index_textures(base_pth: str, png_pths: list[str]) -> Dict[str, List[str]]:
+    """Returns the .png files of each png_pth, looked up in the texture manifest"""
+    manifest = TextureManifest(base_pth)
+    texture_index = {png_pth: manifest.pngs(png_pth) for png_pth in set(png_pths)}
+    manifest.save()
+    return texture_index
+
+
+def get_pngs(
+    base_pth: str,
+    png_pths: list[str],
+    texture_index: Optional[Dict[str, List[str]]] = None,
+):
+    """Returns all .png files in subdirs of each png_pth (with base_pth used as root dir)
+
+    Paths found in texture_index (see index_textures) are not searched again.
+    """
     pngs = []
     for png_pth in png_pths:
+        if texture_index is not None and png_pth in texture_index:
+            pngs += texture_index[png_pth]
+            continue
         full_pth = osp.join(base_pth, png_pth)
         # if pngpth is a png, add it
         if png_pth.endswith(".png"):
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import os.path as osp
+from typing import Dict, List
+
+MANIFEST_FILE = "manifest.json"
+
+
+class TextureManifest:
+    """Index of the pngs in a textures directory, persisted next to the textures.
+
+    Every texture directory (e.g. mnist, apples) is indexed once with the path, class
+    (name of the containing directory), size and hash of each png, and looked up in
+    memory afterwards. An indexed directory is re-indexed if the modification time of
+    it or any of its subdirectories changed, i.e. if pngs were added or removed. Only
+    the pngs whose size or modification time changed are hashed again then.
+    """
+
+    def __init__(self, textures_dir: str):
+        """Load the manifest of textures_dir, if there is one."""
+        self.textures_dir = str(textures_dir)
+        self.manifest_file = osp.join(self.textures_dir, MANIFEST_FILE)
+        self.entries: Dict[str, Dict] = {}
+        self._pngs: Dict[str, List[str]] = {}
+        self._checked: set = set()
+        self._changed = False
+
+        if osp.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.entries = json.load(f)
+        for entry in self.entries.values():
+            self._add_to_lookup(entry)
+
+    def pngs(self, png_pth: str) -> List[str]:
+        """Returns all .png files in png_pth and its subdirs (or png_pth if it's a png)"""
+        if png_pth.endswith(".png"):
+            return [osp.join(self.textures_dir, png_pth)]
+        png_pth = osp.normpath(png_pth)
+        self.update(png_pth.split(os.sep)[0])
+        return [
+            osp.join(self.textures_dir, path) for path in self._pngs.get(png_pth, [])
+        ]
+
+    def update(self, texture_dir: str, force: bool = False) -> None:
+        """(Re)index a top level texture directory if it changed since it was indexed."""
+        if texture_dir in self._checked and not force:
+            return
+        self._checked.add(texture_dir)
+
+        entry = self.entries.get(texture_dir)
+        if not force and entry is not None and self._unchanged(entry):
+            return
+        if not osp.isdir(osp.join(self.textures_dir, texture_dir)):
+            return
+
+        indexed = {} if entry is None else {f["path"]: f for f in entry["files"]}
+        mtimes = self._mtimes(texture_dir)
+        files = []
+        for subdir in sorted(mtimes):
+            with os.scandir(osp.join(self.textures_dir, subdir)) as dir_entries:
+                pngs = sorted(
+                    (e.name, e.stat()) for e in dir_entries if e.name.endswith(".png")
+                )
+            for png, stat in pngs:
+                path = osp.join(subdir, png)
+                file = indexed.get(path)
+                if (
+                    file is None
+                    or file["size"] != stat.st_size
+                    or file.get("mtime") != stat.st_mtime_ns
+                ):
+                    with open(osp.join(self.textures_dir, path), "rb") as f:
+                        digest = hashlib.sha256(f.read()).hexdigest()
+                else:
+                    digest = file["hash"]
+                files.append(
+                    {
+                        "path": path,
+                        "class": osp.basename(subdir),
+                        "size": stat.st_size,
+                        "mtime": stat.st_mtime_ns,
+                        "hash": digest,
+                    }
+                )
+        entry = {"mtimes": mtimes, "files": files}
+        self.entries[texture_dir] = entry
+        for subdir in list(self._pngs):
+            if subdir == texture_dir or subdir.startswith(texture_dir + os.sep):
+                del self._pngs[subdir]
+        self._add_to_lookup(entry)
+        self._changed = True
+
+    def save(self) -> None:
+        """Write the manifest if it changed."""
+        if not self._changed:
+            return
+        tmp_file = f"{self.manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_file, self.manifest_file)
+        self._changed = False
+
+    def _unchanged(self, entry: Dict) -> bool:
+        # Adding or removing a png or directory changes the mtime of its parent
+        for subdir, mtime in entry["mtimes"].items():
+            try:
+                if os.stat(osp.join(self.textures_dir, subdir)).st_mtime_ns != mtime:
+                    return False
+            except FileNotFoundError:
+                return False
+        return True
+
+    def _mtimes(self, texture_dir: str) -> Dict[str, int]:
+        """Modification times of a texture directory and all its subdirectories"""
+        mtimes: Dict[str, int] = {}
+        full_pth = osp.join(self.textures_dir, texture_dir)
+        for root, _, _ in os.walk(full_pth):
+            mtimes[osp.relpath(root, self.textures_dir)] = os.stat(root).st_mtime_ns
+        return mtimes
+
+    def _add_to_lookup(self, entry: Dict) -> None:
+        # Every png is listed under all directories containing it
+        for subdir in entry["mtimes"]:
+            self._pngs[subdir] = []
+        for file in entry["files"]:
+            directory = osp.dirname(file["path"])
+            while directory:
+                self._pngs.setdefault(directory, []).append(file["path"])
+                directory = osp.dirname(directory)
@@ -1,16 +1,29 @@
+import logging
 import os
 import os.path as osp
 import shutil
 import struct
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
 from glob import glob
-from typing import Optional, Set, Tuple
+from typing import Any, List, Optional, Set, Tuple
 
 from PIL import Image
 from PIL.PngImagePlugin import PngInfo
+from tqdm import tqdm
 
 from doom_creator.util.config import Config
+from doom_creator.util.manifest import TextureManifest
 from doom_creator.util.texture import TextureType
 
+_COMPLETE_MARKER = ".complete"
+
+logger = logging.getLogger(__name__)
+
+# Dataset of a preload worker process, see _load_worker_dataset
+_worker_dataset: Optional[Any] = None
+
 ### Util ###
 
 
@@ -18,7 +31,14 @@ from doom_creator.util.texture import TextureType
 def doomify_image(png, scale=1.0, shift=(0, 0), save_to=None):
     if save_to is None:
         save_to = png
-    img = Image.open(png)
+    img, pnginfo = doomify(Image.open(png), scale, shift)
+    img.save(save_to, pnginfo=pnginfo)
+
+
+def doomify(
+    img: Image.Image, scale: float = 1.0, shift: Tuple[int, int] = (0, 0)
+) -> Tuple[Image.Image, PngInfo]:
+    """Scale an image in memory and return it with its grAb (offset) chunk"""
     if scale != 1.0:
         img = img.resize(
             (int(img.size[0] * scale), int(img.size[1] * scale)),
@@ -30,7 +50,17 @@ def doomify_image(png, scale=1.0, shift=(0, 0), save_to=None):
     height += shift[1]
     pnginfo = PngInfo()
     pnginfo.add(b"grAb", struct.pack(">II", width // 2, height))
-    img.save(save_to, pnginfo=pnginfo)
+    return img, pnginfo
+
+
+def save_doomified(images: List[Tuple[Image.Image, str]], scale: float = 1.0) -> int:
+    """Doomify images and write each of them once to its png path"""
+    for img, png in images:
+        img, pnginfo = doomify(img, scale)
+        # Write to a temporary file first, so that no partial pngs are left behind
+        img.save(png + ".tmp", format="PNG", pnginfo=pnginfo)
+        os.replace(png + ".tmp", png)
+    return len(images)
 
 
 ### Loading Datasets ###
@@ -41,6 +71,7 @@ def preload(
     textures_dir: str,
     source_dir: Optional[str] = None,
     train: bool = True,
+    num_workers: Optional[int] = None,
 ):
     if type.is_asset:
         assert source_dir is not None
@@ -49,7 +80,14 @@ def preload(
         )  # only gabor images are not doomified somehow
         preload_assets(type, textures_dir, source_dir, doomify)
     else:
-        preload_dataset(type, textures_dir, source_dir, train=train)
+        preload_dataset(
+            type, textures_dir, source_dir, train=train, num_workers=num_workers
+        )
+
+    # Index the textures once, so that scenario builds don't have to search them
+    manifest = TextureManifest(textures_dir)
+    manifest.update(type.out_dir(type.is_dataset and not train))
+    manifest.save()
 
 
 def preload_assets(
@@ -75,34 +113,115 @@ def preload_dataset(
     source_dir: Optional[str] = None,
     clean: Optional[bool] = None,
     train: bool = True,
+    num_workers: Optional[int] = None,
+    chunk_size: int = 1024,
 ):
+    """Save the images of a dataset as doomified pngs, organized by word label.
+
+    Images are doomified in memory and written once, in chunks of chunk_size images
+    spread over num_workers processes. The workers load the dataset themselves and
+    get the indices of the images, and at most two chunks per worker are in flight,
+    so the images are neither pickled nor held in memory all at once. Class
+    directories that already hold all their images are skipped, so an interrupted
+    preload picks up where it stopped, and a complete preload is marked so that it
+    isn't checked again.
+    """
     if clean is None:
         clean = source_dir is None
 
     out_path = osp.join(textures_dir, dataset_type.out_dir(not train))
+    complete_marker = osp.join(out_path, _COMPLETE_MARKER)
 
     if source_dir is None:
         source_dir = out_path
 
-    # check if resources/textures/$dataset$ exists
-    if not osp.exists(out_path):
-        dataset_wrapper = dataset_type.get_dataset_wrapper(source_dir, train)
-        os.makedirs(out_path)
-
-        # save images as pngs organized by word label
-        for i in range(dataset_wrapper.num_classes):
-            os.makedirs(osp.join(out_path, dataset_wrapper.label_to_str(i)))
-        for i in range(len(dataset_wrapper.dataset)):
-            png = osp.join(
-                out_path,
-                dataset_wrapper.label_to_str(dataset_wrapper.dataset[i][1]),
-                str(i) + ".png",
-            )  # TODO: instead of saving and then doomifying, doomify and save
-            dataset_wrapper.dataset[i][0].save(png)
-            doomify_image(png, 2)
-
-        if clean:
-            dataset_wrapper.clean(source_dir)
+    if osp.exists(complete_marker):
+        return
+
+    dataset_wrapper = dataset_type.get_dataset_wrapper(source_dir, train)
+    dataset = dataset_wrapper.dataset
+    labels = [int(label) for label in dataset.targets]
+
+    # Only (re)write the classes which are not complete yet
+    class_sizes = Counter(labels)
+    missing_classes = set()
+    for i in range(dataset_wrapper.num_classes):
+        class_dir = osp.join(out_path, dataset_wrapper.label_to_str(i))
+        os.makedirs(class_dir, exist_ok=True)
+        if _count_pngs(class_dir) != class_sizes[i]:
+            missing_classes.add(i)
+    indices = [i for i, label in enumerate(labels) if label in missing_classes]
+
+    pngs = [
+        (i, osp.join(out_path, dataset_wrapper.label_to_str(labels[i]), f"{i}.png"))
+        for i in indices
+    ]
+    _write_dataset_pngs(dataset_type, source_dir, train, pngs, num_workers, chunk_size)
+
+    with open(complete_marker, "w"):
+        pass
+
+    if clean:
+        dataset_wrapper.clean(source_dir)
+
+
+def _write_dataset_pngs(
+    dataset_type: TextureType,
+    source_dir: str,
+    train: bool,
+    pngs: List[Tuple[int, str]],
+    num_workers: Optional[int],
+    chunk_size: int,
+):
+    """Write the dataset images with the given indices to their pngs in a process pool"""
+    if not pngs:
+        return
+    max_in_flight = 2 * (num_workers or os.cpu_count() or 1)
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(
+        num_workers,
+        initializer=_load_worker_dataset,
+        initargs=(dataset_type, source_dir, train),
+    ) as pool, tqdm(
+        total=len(pngs), desc=f"Preloading {dataset_type.value}", unit="img"
+    ) as progress:
+        in_flight: Set[Future[int]] = set()
+        for chunk_start in range(0, len(pngs), chunk_size):
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                progress.update(sum(future.result() for future in done))
+            chunk = pngs[chunk_start : chunk_start + chunk_size]
+            in_flight.add(pool.submit(_save_dataset_images, chunk, 2))
+        for future in in_flight:
+            progress.update(future.result())
+    duration = time.perf_counter() - start
+    logger.info(
+        "Preloaded %d %s images in %.1fs (%.0f images/s)",
+        len(pngs),
+        dataset_type.value,
+        duration,
+        len(pngs) / duration,
+    )
+
+
+def _load_worker_dataset(dataset_type: TextureType, source_dir: str, train: bool):
+    global _worker_dataset
+    # The dataset was downloaded by the parent process
+    _worker_dataset = dataset_type.get_dataset_wrapper(
+        source_dir, train, download=False
+    ).dataset
+
+
+def _save_dataset_images(pngs: List[Tuple[int, str]], scale: float) -> int:
+    """Doomify the dataset images with the given indices to their png paths"""
+    assert _worker_dataset is not None
+    return save_doomified([(_worker_dataset[i][0], png) for i, png in pngs], scale)
+
+
+def _count_pngs(directory: str) -> int:
+    with os.scandir(directory) as entries:
+        return sum(entry.name.endswith(".png") for entry in entries)
 
 
 def check_preload(cfg: Config, test: bool) -> Tuple[Config, Set[TextureType]]:
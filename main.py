@@ -42,7 +42,7 @@ def _program(cfg: DictConfig):
     optimizer = instantiate(cfg.optimizer.optimizer, brain.parameters())
     if hasattr(cfg.optimizer, "objective"):
         objective = instantiate(cfg.optimizer.objective, brain=brain)
-        # TODO: RL framework currently can't use objective
+        objective.register_decoupled_decay(optimizer)
     else:
         objective = None
         warnings.warn("No objective specified, is that wanted?")
@@ -1,6 +1,6 @@
 """Utility functions for plotting the results of statistical analyses."""
 
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 import matplotlib.pyplot as plt
 import networkx as nx
@@ -372,6 +372,94 @@ def plot_histories(histories: Dict[str, List[float]]) -> Figure:
     return fig
 
 
+class HistoryPlot:
+    """Plot of training and test metrics over epochs that is updated in place.
+
+    Where plot_histories redraws the full history, update only appends the new
+    epochs to the existing lines. The figure is rebuilt only when a new metric
+    appears.
+    """
+
+    def __init__(self) -> None:
+        self.fig: Optional[Figure] = None
+        self.metrics: List[str] = []
+        self.axes: Dict[str, Axes] = {}
+        self.lines: Dict[str, Line2D] = {}
+        self.epochs: Dict[str, List[float]] = {}
+        self.values: Dict[str, List[float]] = {}
+
+    def update(self, records: List[Dict[str, float]]) -> Figure:
+        """Append history records (one dict of metric values per epoch, including the "epoch") and return the figure."""
+        for record in records:
+            epoch = record["epoch"]
+            metrics = _history_metrics(record)
+            if self.fig is None or not set(metrics) <= set(self.metrics):
+                self._build(sorted(set(self.metrics) | set(metrics)))
+
+            for key, value in record.items():
+                if key in self.lines:
+                    self.epochs[key].append(epoch)
+                    self.values[key].append(value)
+
+        if self.fig is None:
+            self._build([])
+        assert self.fig is not None
+
+        for key, line in self.lines.items():
+            line.set_data(self.epochs[key], self.values[key])
+        for ax in self.axes.values():
+            ax.relim()
+            ax.autoscale_view()
+
+        return self.fig
+
+    def _build(self, metrics: List[str]) -> None:
+        """(Re)create the figure for the given metrics, keeping the points plotted so far."""
+        self.metrics = metrics
+        self.axes = {}
+        self.lines = {}
+
+        # Determine the number of rows needed (2 metrics per row)
+        num_rows = max((len(metrics) + 1) // 2, 1)
+
+        self.fig = Figure(figsize=(15, 5 * num_rows), constrained_layout=True)
+        axs = self.fig.subplots(num_rows, 2, squeeze=False).flatten()
+
+        for idx, metric in enumerate(metrics):
+            ax: Axes = axs[idx]
+            lbl: str = " ".join([word.capitalize() for word in metric.split("_")])
+
+            for split, color in [("train", "black"), ("test", "red")]:
+                key = f"{split}_{metric}"
+                (self.lines[key],) = ax.plot(
+                    self.epochs.setdefault(key, []),
+                    self.values.setdefault(key, []),
+                    label=f"{lbl} {'Training' if split == 'train' else 'Test'}",
+                    color=color,
+                )
+
+            ax.set_xlabel("Epochs")
+            ax.set_ylabel("Value")
+            ax.set_title(lbl)
+            ax.legend()
+            ax.grid(True)
+            ax.xaxis.set_major_locator(MaxNLocator(integer=True))
+            self.axes[metric] = ax
+
+        # Remove any unused subplots
+        for idx in range(len(metrics), len(axs)):
+            self.fig.delaxes(axs[idx])
+
+        self.fig.suptitle("Training and Test Metrics", fontsize=16)
+
+
+def _history_metrics(record: Dict[str, float]) -> List[str]:
+    """Return the metrics of a history record for which both train and test values are present."""
+    train_metrics = {key.split("_", 1)[1] for key in record if key.startswith("train_")}
+    test_metrics = {key.split("_", 1)[1] for key in record if key.startswith("test_")}
+    return sorted(train_metrics & test_metrics)
+
+
 def plot_channel_statistics(
     receptive_fields: FloatArray,
     spectral: Dict[str, FloatArray],
@@ -5,11 +5,14 @@ and calculating losses for the Brain model. It works in conjunction with the
 Brain and BrainOptimizer classes to perform model training and evaluation.
 """
 
+import json
 import logging
-from typing import Dict, List, Tuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import torch
 from torch import Tensor
+from torch.amp.grad_scaler import GradScaler
 from torch.optim.optimizer import Optimizer
 from torch.utils.data import DataLoader
 
@@ -22,6 +25,56 @@ from retinal_rl.models.objective import Objective
 
 logger = logging.getLogger(__name__)
 
+_precision_dtypes: Dict[str, Optional[torch.dtype]] = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+class MixedPrecision:
+    """Autocast and gradient scaling settings for (mixed) precision training.
+
+    The precision is one of "fp32", "bf16" or "fp16". With bf16 or fp16 the forward
+    pass and losses run under autocast, and fp16 additionally scales the losses to
+    keep small gradients from underflowing. bf16 works on CPU as well as on GPU.
+    """
+
+    def __init__(self, device: torch.device, precision: str = "fp32"):
+        """Initialize the autocast and scaler settings for the given device."""
+        if precision not in _precision_dtypes:
+            raise ValueError(
+                f"Unknown precision {precision}, must be one of {list(_precision_dtypes)}"
+            )
+        self.device_type = device.type
+        self.dtype = _precision_dtypes[precision]
+        self.scaler = GradScaler(device.type, enabled=precision == "fp16")
+
+    def autocast(self) -> torch.autocast:
+        """Return the autocast context for the forward pass and loss computation.
+
+        The Objective leaves the autocast context to scale and differentiate the
+        losses, so backward passes don't run under autocast.
+        """
+        return torch.autocast(
+            self.device_type, dtype=self.dtype, enabled=self.dtype is not None
+        )
+
+    def step(self, optimizer: Optimizer) -> None:
+        """Unscale the gradients (if needed) and perform the optimizer step.
+
+        The step is skipped if no parameter has a gradient, e.g. when no loss is
+        in its training epochs (the fp16 scaler can't step without gradients).
+        """
+        if not any(
+            param.grad is not None
+            for group in optimizer.param_groups
+            for param in group["params"]
+        ):
+            return
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
 
 def run_epoch(
     device: torch.device,
@@ -32,6 +85,9 @@ def run_epoch(
     epoch: int,
     trainloader: DataLoader[Tuple[Tensor, Tensor, int]],
     testloader: DataLoader[Tuple[Tensor, Tensor, int]],
+    precision: Optional[MixedPrecision] = None,
+    micro_batch_size: Optional[int] = None,
+    accumulation_steps: int = 1,
 ) -> Tuple[Brain, Dict[str, List[float]]]:
     """Perform a single training epoch and evaluation.
 
@@ -49,6 +105,9 @@ def run_epoch(
         epoch (int): The current epoch number.
         trainloader (DataLoader): DataLoader for the training dataset.
         testloader (DataLoader): DataLoader for the test dataset.
+        precision (Optional[MixedPrecision]): Mixed precision settings, fp32 if None.
+        micro_batch_size (Optional[int]): Maximum number of samples per forward pass.
+        accumulation_steps (int): Number of training batches per optimizer step.
 
     Returns:
     -------
@@ -56,10 +115,27 @@ def run_epoch(
 
     """
     train_losses = process_dataset(
-        device, brain, objective, optimizer, epoch, trainloader, is_training=True
+        device,
+        brain,
+        objective,
+        optimizer,
+        epoch,
+        trainloader,
+        is_training=True,
+        precision=precision,
+        micro_batch_size=micro_batch_size,
+        accumulation_steps=accumulation_steps,
     )
     test_losses = process_dataset(
-        device, brain, objective, optimizer, epoch, testloader, is_training=False
+        device,
+        brain,
+        objective,
+        optimizer,
+        epoch,
+        testloader,
+        is_training=False,
+        precision=precision,
+        micro_batch_size=micro_batch_size,
     )
 
     # Update history
@@ -81,11 +157,17 @@ def process_dataset(
     epoch: int,
     dataloader: DataLoader[Tuple[Tensor, Tensor, int]],
     is_training: bool,
+    precision: Optional[MixedPrecision] = None,
+    micro_batch_size: Optional[int] = None,
+    accumulation_steps: int = 1,
 ) -> Dict[str, float]:
     """Process a dataset (train or test) and return average losses.
 
     This function runs the model on all batches in the given dataset. If in training mode,
-    it also performs optimization steps.
+    it also performs optimization steps. Batches larger than micro_batch_size are
+    processed in chunks, and gradients are accumulated over accumulation_steps batches
+    before each optimizer step, so that the effective batch size is independent of the
+    memory available on the device.
 
     Args:
     ----
@@ -95,30 +177,59 @@ def process_dataset(
         epoch (int): The current epoch number.
         dataloader (DataLoader): The DataLoader containing the dataset to process.
         is_training (bool): Whether to perform optimization (True) or just evaluate (False).
+        precision (Optional[MixedPrecision]): Mixed precision settings, fp32 if None.
+        micro_batch_size (Optional[int]): Maximum number of samples per forward pass,
+            whole batches if None.
+        accumulation_steps (int): Number of batches per optimizer step.
 
     Returns:
     -------
         Dict[str, float]: A dictionary of average losses for the processed dataset.
 
     """
+    if precision is None:
+        precision = MixedPrecision(device)
+
     total_losses: Dict[str, float] = {}
     steps = 0
+    num_batches = len(dataloader)
 
-    for batch in dataloader:
-        context = get_classification_context(device, brain, batch, epoch)
+    for batch_idx, batch in enumerate(dataloader):
+        batch_size = len(batch[0])
+        losses: Dict[str, float] = {}
 
-        if is_training:
-            brain.train()
-            losses = objective.backward(context)
-            optimizer.step()
-            optimizer.zero_grad(set_to_none=True)
+        for micro_batch in _micro_batches(batch, micro_batch_size):
+            # Weight by size, so that losses and gradients are batch averages
+            fraction = len(micro_batch[0]) / batch_size
+
+            if is_training:
+                brain.train()
+                with precision.autocast():
+                    context = get_classification_context(
+                        device, brain, micro_batch, epoch
+                    )
+                    micro_losses = objective.backward(
+                        context, precision.scaler, fraction / accumulation_steps
+                    )
+
+            else:
+                with torch.no_grad(), precision.autocast():
+                    brain.eval()
+                    context = get_classification_context(
+                        device, brain, micro_batch, epoch
+                    )
+                    micro_losses = {
+                        loss.key_name: loss(context).item() for loss in objective.losses
+                    }
 
-        else:
-            with torch.no_grad():
-                brain.eval()
-                losses: Dict[str, float] = {}
-                for loss in objective.losses:
-                    losses[loss.key_name] = loss(context).item()
+            for key, value in micro_losses.items():
+                losses[key] = losses.get(key, 0.0) + fraction * value
+
+        if is_training and (
+            (batch_idx + 1) % accumulation_steps == 0 or batch_idx + 1 == num_batches
+        ):
+            precision.step(optimizer)
+            optimizer.zero_grad(set_to_none=True)
 
         # Accumulate losses and objectives
         for key, value in losses.items():
@@ -128,3 +239,85 @@ def process_dataset(
 
     # Calculate average losses
     return {key: value / steps for key, value in total_losses.items()}
+
+
+def find_max_micro_batch_size(
+    device: torch.device,
+    brain: Brain,
+    objective: Objective[ClassificationContext],
+    batch: Tuple[Tensor, Tensor, Tensor],
+    epoch: int,
+    precision: Optional[MixedPrecision] = None,
+    cache_file: Optional[Path] = None,
+) -> int:
+    """Find the largest micro-batch size for which a training step fits in memory.
+
+    Starting from the size of the given batch, the micro-batch size is halved until a
+    forward and backward pass no longer runs out of memory. No optimizer step is
+    taken, and gradients and buffers (e.g. batch norm statistics) are restored. The
+    result is cached in cache_file per device, precision and batch size.
+    """
+    if precision is None:
+        precision = MixedPrecision(device)
+
+    size = len(batch[0])
+    key = f"{device}-{precision.dtype}-{size}"
+    cache: Dict[str, int] = {}
+    if cache_file is not None and cache_file.exists():
+        with open(cache_file) as f:
+            cache = json.load(f)
+        if key in cache:
+            return cache[key]
+
+    buffers = {name: buffer.clone() for name, buffer in brain.named_buffers()}
+    brain.train()
+
+    while True:
+        try:
+            micro_batch = tuple(tensor[:size] for tensor in batch)
+            _probe_training_step(
+                device, brain, objective, micro_batch, epoch, precision
+            )
+            break
+        except torch.cuda.OutOfMemoryError:
+            if size == 1:
+                raise
+            size //= 2
+            logger.info(f"Out of memory, reducing micro-batch size to {size}.")
+        finally:
+            brain.zero_grad(set_to_none=True)
+            if device.type == "cuda":
+                torch.cuda.empty_cache()
+
+    with torch.no_grad():
+        for name, buffer in brain.named_buffers():
+            buffer.copy_(buffers[name])
+
+    if cache_file is not None:
+        cache[key] = size
+        with open(cache_file, "w") as f:
+            json.dump(cache, f)
+
+    return size
+
+
+def _probe_training_step(
+    device: torch.device,
+    brain: Brain,
+    objective: Objective[ClassificationContext],
+    batch: Tuple[Tensor, ...],
+    epoch: int,
+    precision: MixedPrecision,
+) -> None:
+    # Separate function, so that activations are freed when it returns or raises
+    with precision.autocast():
+        context = get_classification_context(device, brain, batch, epoch)
+        objective.backward(context, precision.scaler)
+
+
+def _micro_batches(
+    batch: Tuple[Tensor, ...], micro_batch_size: Optional[int]
+) -> List[Tuple[Tensor, ...]]:
+    if micro_batch_size is None or micro_batch_size >= len(batch[0]):
+        return [batch]
+    return list(zip(*(tensor.split(micro_batch_size) for tensor in batch)))
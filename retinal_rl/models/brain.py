@@ -2,7 +2,7 @@
 
 import logging
 from io import StringIO
-from typing import Dict, List, OrderedDict, Tuple
+from typing import Callable, Dict, Iterable, List, Optional, OrderedDict, Tuple
 
 import networkx as nx
 import torch
@@ -12,6 +12,7 @@ from torchinfo import summary
 
 from retinal_rl.models.circuits.convolutional import ConvolutionalEncoder
 from retinal_rl.models.neural_circuit import NeuralCircuit
+from retinal_rl.models.profiling import CircuitProfiler
 
 logger = logging.getLogger(__name__)
 
@@ -43,19 +44,78 @@ class Brain(nn.Module):
         self.sensors: Dict[str, Tuple[int, ...]] = {}
         for sensor in sensors:
             self.sensors[sensor] = tuple(sensors[sensor])
+        self.profiler: Optional[CircuitProfiler] = None
+        self._topological_order: Optional[List[str]] = None
+        self._plans: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], List[str]] = {}
 
     def forward(self, stimuli: Dict[str, Tensor]) -> Dict[str, Tensor]:
         """Forward pass of the brain. Computed by following the connectome from sensors through the circuits."""
-        responses: Dict[str, Tensor] = {}
+        responses: Dict[str, Tensor] = {
+            sensor: stimuli[sensor] for sensor in self.sensors
+        }
+        return self.run_plan(self.plan(self.sensors, self.circuits), responses)
+
+    def plan(self, sources: Iterable[str], targets: Iterable[str]) -> List[str]:
+        """Return the circuits to evaluate, in order, to compute targets from sources.
 
-        for node in nx.topological_sort(self.connectome):
-            if node in self.sensors:
-                responses[node] = stimuli[node]
+        These are the targets and all circuits upstream of them that can not be reached
+        from them only via a source. Plans are cached, so the connectome is only
+        traversed the first time a plan is requested.
+        """
+        key = (tuple(sources), tuple(targets))
+        if key not in self._plans:
+            needed = set()
+            stack = list(key[1])
+            while stack:
+                node = stack.pop()
+                if node in needed or node in key[0]:
+                    continue
+                needed.add(node)
+                stack.extend(self.connectome.predecessors(node))
+            if self._topological_order is None:
+                self._topological_order = list(nx.topological_sort(self.connectome))
+            self._plans[key] = [
+                node
+                for node in self._topological_order
+                if node in needed and node in self.circuits
+            ]
+        return self._plans[key]
+
+    def run_plan(
+        self,
+        plan: List[str],
+        responses: Dict[str, Tensor],
+        calls: Optional[Dict[str, Callable[[Tensor], Tensor]]] = None,
+    ) -> Dict[str, Tensor]:
+        """Evaluate the circuits of a plan, adding their outputs to responses.
+
+        responses has to contain the inputs of the plan (e.g. its sources). Circuits can
+        be replaced by other calls (e.g. to pass the states of recurrent circuits).
+        """
+        for node in plan:
+            input = self._assemble_inputs(node, responses)
+            if calls is not None and node in calls:
+                responses[node] = calls[node](input)
             else:
-                input = self._assemble_inputs(node, responses)
                 responses[node] = self.circuits[node](input)
         return responses
 
+    def enable_profiling(self, trace: bool = False) -> CircuitProfiler:
+        """Start recording per-circuit time, FLOPs and memory statistics, see CircuitProfiler.
+
+        If trace is True, the forward and backward passes of every circuit are also
+        recorded as chrome trace events.
+        """
+        self.disable_profiling()
+        self.profiler = CircuitProfiler(self.circuits, trace)
+        return self.profiler
+
+    def disable_profiling(self) -> None:
+        """Stop profiling and remove the profiling hooks from the circuits."""
+        if self.profiler is not None:
+            self.profiler.remove()
+            self.profiler = None
+
     def scan(self) -> str:
         """
         Performs a comprehensive scan of the model and its circuits, returning the results as a string.
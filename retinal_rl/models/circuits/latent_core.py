@@ -1,32 +1,59 @@
-from typing import List
+from typing import List, Tuple, Union
 
+import numpy as np
 import torch
-from torch import nn
+from torch import Tensor, nn
+from torch.nn.utils.rnn import PackedSequence
 
 from retinal_rl.models.neural_circuit import NeuralCircuit
 
 
 class LatentRNN(NeuralCircuit):
-    def __init__(self, input_shape: List[int], rnn_size, rnn_num_layers):
-        super().__init__(input_shape)
-        self.core = nn.GRU(input_shape, rnn_size, rnn_num_layers)
-
-    def forward(self, head_output, rnn_states):
-        is_seq = not torch.is_tensor(head_output)
-
-        if not is_seq:
-            head_output = head_output.unsqueeze(0)
+    """GRU core carrying a latent state across the steps of an episode.
 
-        rnn_states = rnn_states.unsqueeze(0)
+    As a circuit of a Brain, every sample is a single step from a zero state. Recurrent
+    agents step the state with forward_rnn, which takes either a batch of single steps
+    or a PackedSequence of whole trajectories (as built by sample factory's learner),
+    which is evaluated by one fused (cuDNN) GRU call instead of a loop over time.
+    """
 
-        x, new_rnn_states = self.core(head_output, rnn_states.contiguous())
+    def __init__(self, input_shape: List[int], rnn_size: int, rnn_num_layers: int = 1):
+        super().__init__(input_shape)
+        self.rnn_size = rnn_size
+        self.rnn_num_layers = rnn_num_layers
+        self.core = nn.GRU(int(np.prod(input_shape)), rnn_size, rnn_num_layers)
+
+    @property
+    def state_size(self) -> int:
+        """Size of the flattened state of all layers, per sample."""
+        return self.rnn_size * self.rnn_num_layers
+
+    def forward(self, x: Tensor) -> Tensor:
+        rnn_states = x.new_zeros(x.shape[0], self.state_size)
+        return self.forward_rnn(x, rnn_states)[0]
+
+    def forward_rnn(
+        self, head_output: Union[Tensor, PackedSequence], rnn_states: Tensor
+    ) -> Tuple[Union[Tensor, PackedSequence], Tensor]:
+        """Step the GRU, with rnn_states of shape [batch, state_size]."""
+        is_seq = isinstance(head_output, PackedSequence)
+
+        if is_seq:
+            head_output = head_output._replace(data=head_output.data.flatten(1))
+        else:
+            head_output = head_output.flatten(1).unsqueeze(0)
+
+        # [batch, layers * size] -> [layers, batch, size]
+        rnn_states = rnn_states.view(-1, self.rnn_num_layers, self.rnn_size)
+        x, new_rnn_states = self.core(
+            head_output, rnn_states.transpose(0, 1).contiguous()
+        )
 
         if not is_seq:
             x = x.squeeze(0)
 
-        new_rnn_states = new_rnn_states.squeeze(0)
-
-        return x, new_rnn_states  # TODO: not compatible (yet)
+        new_rnn_states = new_rnn_states.transpose(0, 1).reshape(-1, self.state_size)
+        return x, new_rnn_states
 
 
 class LatentFFN(NeuralCircuit):
@@ -5,6 +5,7 @@ from typing import Dict, Generic, List, Optional, TypeVar
 
 import torch
 from torch import Tensor, nn
+from torch.nn.parameter import Parameter
 
 from retinal_rl.util import camel_to_snake
 
@@ -165,6 +166,100 @@ class L1Sparsity(Loss[ContextT]):
         return f"l1_sparsity_{self.target_response.lower()}"
 
 
+class ActivationRegularization(Loss[ContextT]):
+    """Loss penalizing the p-norm of circuit responses.
+
+    The value is the sum of |x|^p over all elements of the target responses, averaged
+    over the batch. It is computed from the responses of the forward pass, with a single
+    fused reduction over all target responses.
+    """
+
+    def __init__(
+        self,
+        target_responses: List[str],
+        p: int = 2,
+        target_circuits: Optional[List[str]] = None,
+        weights: Optional[List[float]] = None,
+        min_epoch: Optional[int] = None,
+        max_epoch: Optional[int] = None,
+    ):
+        """Initialize the activation regularization loss."""
+        super().__init__(target_circuits, weights, min_epoch, max_epoch)
+        self.target_responses = target_responses
+        self.p = p
+
+    def compute_value(self, context: ContextT) -> Tensor:
+        """Compute the batch averaged sum of |x|^p of the target responses."""
+        responses = context.responses
+        for target in self.target_responses:
+            if target not in responses:
+                raise ValueError(f"Target {target} not found in responses")
+        activations = [responses[target] for target in self.target_responses]
+
+        norms = torch.stack(torch._foreach_norm(activations, self.p)).float()
+        return norms.pow(self.p).sum() / activations[0].shape[0]
+
+    @property
+    def key_name(self) -> str:
+        """Return a user-friendly name for the loss, including the target responses."""
+        targets = "_".join(target.lower() for target in self.target_responses)
+        return f"activation_l{self.p}_{targets}"
+
+
+class WeightRegularization(Loss[ContextT]):
+    """Loss penalizing the p-norm of the parameters of the target circuits.
+
+    The value is the sum of |w|^p over all parameters, computed with a single fused
+    reduction. The parameters are bound by the Objective from target_circuits, and the
+    circuit weights scale the gradients as for every other loss.
+
+    If decoupled is set, the penalty is not differentiated. Instead, the Objective
+    decays the parameters right after every optimizer step by the learning rate times
+    the gradient of the weighted penalty (as in AdamW for p=2), see
+    Objective.register_decoupled_decay.
+    """
+
+    def __init__(
+        self,
+        p: int = 2,
+        decoupled: bool = False,
+        target_circuits: Optional[List[str]] = None,
+        weights: Optional[List[float]] = None,
+        min_epoch: Optional[int] = None,
+        max_epoch: Optional[int] = None,
+    ):
+        """Initialize the weight regularization loss."""
+        super().__init__(target_circuits, weights, min_epoch, max_epoch)
+        self.p = p
+        self.decoupled = decoupled
+        self.params: List[Parameter] = []
+
+    def compute_value(self, context: ContextT) -> Tensor:
+        """Compute the sum of |w|^p over the bound parameters."""
+        if not self.params:
+            return torch.tensor(0.0)
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.decoupled):
+            norms = torch.stack(torch._foreach_norm(self.params, self.p)).float()
+            return norms.pow(self.p).sum()
+
+    @torch.no_grad()
+    def decay(self, params: List[Parameter], rate: float) -> None:
+        """Take a step of size rate along the negative gradient of the penalty."""
+        if self.p == 2:
+            torch._foreach_mul_(params, 1 - 2 * rate)
+        else:
+            grads = torch._foreach_sign(params)
+            if self.p != 1:
+                magnitudes = torch._foreach_pow(torch._foreach_abs(params), self.p - 1)
+                torch._foreach_mul_(grads, magnitudes)
+            torch._foreach_add_(params, grads, alpha=-self.p * rate)
+
+    @property
+    def key_name(self) -> str:
+        """Return a user-friendly name for the loss, including the norm."""
+        return f"weight_l{self.p}"
+
+
 class KLDivergenceSparsity(Loss[ContextT]):
     """Loss for computing the KL divergence sparsity of activations."""
 
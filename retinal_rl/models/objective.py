@@ -1,13 +1,23 @@
 """Module for managing optimization of complex neural network models with multiple circuits."""
 
 import logging
-from typing import Dict, Generic, List, Optional, Tuple
+import time
+from typing import Any, Dict, Generic, List, Optional, Tuple
 
 import torch
+from torch import Tensor
+from torch.amp.grad_scaler import GradScaler
 from torch.nn.parameter import Parameter
+from torch.optim.optimizer import Optimizer
+from torch.utils.hooks import RemovableHandle
 
 from retinal_rl.models.brain import Brain
-from retinal_rl.models.loss import ContextT, LoggingStatistic, Loss
+from retinal_rl.models.loss import (
+    ContextT,
+    LoggingStatistic,
+    Loss,
+    WeightRegularization,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -34,46 +44,134 @@ class Objective(Generic[ContextT]):
         self.losses = losses
         self.logging_statistics = logging_statistics
         self.brain: Brain = brain
+        self.epoch: Optional[int] = None
+
+        for loss in losses:
+            if isinstance(loss, WeightRegularization):
+                loss.params = self._weighted_params(loss)[1]
 
         # Build a dictionary of weighted parameters for each loss
         # TODO: If the parameters() list of a neural circuit changes dynamically, this will break
 
-    def backward(self, context: ContextT) -> Dict[str, float]:
-        loss_dict: Dict[str, float] = {}
+    def backward(
+        self,
+        context: ContextT,
+        scaler: Optional[GradScaler] = None,
+        scale: float = 1.0,
+    ) -> Dict[str, float]:
+        """Accumulate the weighted gradients of all losses and return the loss values.
+
+        If a GradScaler is given (fp16 training), gradients are computed from the
+        scaled losses and have to be unscaled by the scaler before the step. The
+        gradients are multiplied by scale before they are accumulated, e.g. to
+        average them over the micro-batches of an optimizer step.
+        """
+        loss_dict, grads = self.gradients(context, scaler, scale)
+
+        # Manually update parameters
+        with torch.no_grad():
+            for param, grad in grads.items():
+                if param.grad is None:
+                    param.grad = grad
+                else:
+                    param.grad += grad
 
-        retain_graph = True
+        return loss_dict
 
-        for i, stat in enumerate(self.logging_statistics):
+    def gradients(
+        self,
+        context: ContextT,
+        scaler: Optional[GradScaler] = None,
+        scale: float = 1.0,
+        retain_graph: bool = False,
+        timings: Optional[Dict[str, float]] = None,
+    ) -> Tuple[Dict[str, float], Dict[Parameter, Tensor]]:
+        """Return the loss values and the summed weighted gradients of all losses, see backward.
+
+        If retain_graph is set, the graph of the losses is kept (e.g. to backpropagate
+        another loss through it). If a timings dict is given, the time (in seconds)
+        to evaluate and differentiate every loss is stored in it.
+        """
+        loss_dict: Dict[str, float] = {}
+        grads: Dict[Parameter, Tensor] = {}
+        self.epoch = context.epoch
+
+        for stat in self.logging_statistics:
             loss_dict[stat.key_name] = stat(context).item()
 
         for i, loss in enumerate(self.losses):
             name = loss.key_name
+            start = time.perf_counter()
             value = loss(context)
             loss_dict[name] = value.item()
 
             # Compute losses
             weights, params = self._weighted_params(loss)
-            if not loss.is_training_epoch(context.epoch) or not params:
+            if loss.is_training_epoch(context.epoch) and params and value.requires_grad:
+                # Losses may be evaluated under autocast, but are scaled and
+                # differentiated outside of it
+                with torch.autocast(value.device.type, enabled=False):
+                    if scaler is not None:
+                        value = scaler.scale(value)
+                    # Keep the graph for all but the last loss
+                    loss_grads = torch.autograd.grad(
+                        value,
+                        params,
+                        create_graph=False,
+                        retain_graph=retain_graph or i < len(self.losses) - 1,
+                        allow_unused=True,
+                    )
+                with torch.no_grad():
+                    for param, weight, grad in zip(params, weights, loss_grads):
+                        # Target circuits (e.g. __all__) might not affect the loss
+                        if grad is None:
+                            continue
+                        if param in grads:
+                            grads[param] += (weight * scale) * grad
+                        else:
+                            grads[param] = (weight * scale) * grad
+
+            if timings is not None:
+                if value.is_cuda:
+                    torch.cuda.synchronize(value.device)
+                timings[name] = time.perf_counter() - start
+
+        return loss_dict, grads
+
+    def register_decoupled_decay(self, optimizer: Optimizer) -> RemovableHandle:
+        """Apply the decoupled weight regularization losses after every optimizer step."""
+
+        def hook(optimizer: Optimizer, *_: Any) -> None:
+            self.apply_decoupled_decay(optimizer)
+
+        return optimizer.register_step_post_hook(hook)
+
+    def apply_decoupled_decay(self, optimizer: Optimizer) -> None:
+        """Decay the parameters of the decoupled weight regularization losses once.
+
+        Every parameter w is decayed by lr * weight * d|w|^p/dw, with the learning rate
+        of its parameter group in the optimizer and its circuit weight in the loss. Losses
+        outside their training epochs (as of the last backward pass) are skipped.
+        """
+        learning_rates = {
+            param: group["lr"]
+            for group in optimizer.param_groups
+            for param in group["params"]
+        }
+        for loss in self.losses:
+            if not isinstance(loss, WeightRegularization) or not loss.decoupled:
+                continue
+            if self.epoch is not None and not loss.is_training_epoch(self.epoch):
                 continue
 
-            # Set retain_graph to True for all but the last optimizer
-            retain_graph = i < len(self.losses) - 1
-
-            # Compute gradients
-            grads = torch.autograd.grad(
-                value, params, create_graph=False, retain_graph=retain_graph
-            )
-
-            # Manually update parameters
-            with torch.no_grad():
-                for param, weight, grad in zip(params, weights, grads):
-                    if param.grad is None:
-                        param.grad = weight * grad
-                    else:
-                        param.grad += weight * grad
-
-        # Perform optimization step
-        return loss_dict
+            # Decay the parameters with the same rate in one fused update
+            groups: Dict[float, List[Parameter]] = {}
+            for weight, param in zip(*self._weighted_params(loss)):
+                if param in learning_rates:
+                    rate = learning_rates[param] * weight
+                    groups.setdefault(rate, []).append(param)
+            for rate, params in groups.items():
+                loss.decay(params, rate)
 
     def _weighted_params(
         self, loss: Loss[ContextT]
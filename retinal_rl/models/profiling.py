@@ -0,0 +1,286 @@
+"""Opt-in per-circuit profiling of forward and backward passes through hooks."""
+
+import json
+import os
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+import torch
+from torch import Tensor, nn
+from torch.utils.hooks import RemovableHandle
+
+_STATS = ["forward_time", "backward_time", "flops", "activation_bytes"]
+
+# A point in time: perf_counter on CPU, a recorded event on CUDA
+_Marker = Union[float, torch.cuda.Event]
+
+
+class CircuitProfiler:
+    """Record wall time, FLOPs, activation sizes and memory of every circuit.
+
+    Forward and backward times are measured with hooks around each circuit. On CUDA,
+    the times are measured with CUDA events, which are only resolved (with a single
+    synchronization) when the statistics are read, so profiling doesn't stall the
+    device. FLOPs are estimated from the shapes of the convolutional and linear layers
+    in a circuit, activation bytes are the sizes of the circuit outputs, and the
+    forward peak memory is the largest CUDA memory allocated on top of the memory at
+    the start of a circuit's forward pass (the peak statistics of the device are reset
+    for every circuit). Statistics are summed until the next reset, and optionally
+    recorded as chrome trace events (see export_chrome_trace). While paused (see
+    paused), nothing is recorded.
+
+    Backward times span from the gradient of a circuit's output to the gradient of its
+    input or, for circuits whose inputs don't require gradients (e.g. circuits reading
+    from sensors), to the gradient of its first parameter.
+    """
+
+    def __init__(
+        self,
+        circuits: Dict[str, nn.Module],
+        trace: bool = False,
+        max_events: int = 100000,
+    ):
+        """Attach the profiling hooks to the given circuits."""
+        self.trace = trace
+        self.active = True
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._calls: Dict[str, int] = {}
+        self._memory: Dict[str, int] = {}
+        self._memory_starts: Dict[str, int] = {}
+        self._starts: Dict[Tuple[str, str], _Marker] = {}
+        self._pending: List[Tuple[str, str, _Marker, _Marker]] = []
+        self._origin: Optional[Tuple[float, torch.cuda.Event]] = None
+        self._events: Deque[Dict[str, Any]] = deque(maxlen=max_events)
+        self._max_pending = max_events
+        self._handles: List[RemovableHandle] = []
+        self._first_params: Dict[str, nn.Parameter] = {}
+
+        for name, circuit in circuits.items():
+            self._handles += [
+                circuit.register_forward_pre_hook(self._start_hook(name)),
+                circuit.register_forward_hook(self._forward_hook(name)),
+            ]
+            # The gradient of the first layer's parameters is computed last
+            first_param = next(circuit.parameters(), None)
+            if first_param is not None:
+                self._first_params[name] = first_param
+                self._handles.append(
+                    first_param.register_hook(self._backward_end_hook(name))
+                )
+            for module in circuit.modules():
+                if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d, nn.Linear)):
+                    self._handles.append(
+                        module.register_forward_hook(self._flops_hook(name))
+                    )
+        self.reset()
+
+    def reset(self) -> None:
+        """Clear the statistics and trace events collected so far."""
+        self._stats = {}
+        self._calls = {}
+        self._memory = {}
+        self._starts = {}
+        self._pending = []
+        self._origin = None
+        self._events.clear()
+
+    def remove(self) -> None:
+        """Remove all hooks from the circuits."""
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """Don't record anything within a with block, e.g. during analyses."""
+        active = self.active
+        self.active = False
+        try:
+            yield
+        finally:
+            self.active = active
+
+    def summary(self) -> Dict[str, float]:
+        """Return the statistics per forward pass, as profile_<circuit>_<statistic>.
+
+        Times are in milliseconds, FLOPs and activation bytes are per forward pass of
+        the circuit, and the forward peak memory is the largest of all passes.
+        """
+        self._resolve()
+        summary: Dict[str, float] = {}
+        for name, stats in self._stats.items():
+            calls = max(self._calls.get(name, 0), 1)
+            summary[f"profile_{name}_forward_ms"] = 1000 * stats["forward_time"] / calls
+            summary[f"profile_{name}_backward_ms"] = (
+                1000 * stats["backward_time"] / calls
+            )
+            summary[f"profile_{name}_flops"] = stats["flops"] / calls
+            summary[f"profile_{name}_activation_bytes"] = (
+                stats["activation_bytes"] / calls
+            )
+            if name in self._memory:
+                summary[f"profile_{name}_forward_peak_memory"] = self._memory[name]
+        return summary
+
+    def export_chrome_trace(self, path: Path) -> None:
+        """Write the recorded trace events in the chrome trace format (chrome://tracing)."""
+        self._resolve()
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"traceEvents": list(self._events)}, f)
+        os.replace(tmp_path, path)
+
+    ### Hooks ###
+
+    def _start_hook(self, name: str):
+        def hook(_module: nn.Module, inputs: Any) -> None:
+            if not self.active:
+                return
+            device = _device(inputs)
+            if device is not None and device.type == "cuda":
+                torch.cuda.reset_peak_memory_stats(device)
+                self._memory_starts[name] = torch.cuda.memory_allocated(device)
+            self._starts[(name, "forward")] = self._marker(device)
+
+        return hook
+
+    def _forward_hook(self, name: str):
+        def hook(_module: nn.Module, inputs: Any, output: Any) -> None:
+            if not self.active:
+                return
+            device = _device(output)
+            self._record(name, "forward", self._marker(device))
+            self._calls[name] = self._calls.get(name, 0) + 1
+            stats = self._circuit_stats(name)
+            stats["activation_bytes"] += sum(
+                tensor.numel() * tensor.element_size() for tensor in _tensors(output)
+            )
+            if name in self._memory_starts:
+                peak = torch.cuda.max_memory_allocated(device)
+                peak -= self._memory_starts.pop(name)
+                self._memory[name] = max(self._memory.get(name, 0), peak)
+
+            # The backward pass of the circuit starts with the gradient of its output,
+            # and ends with the gradient of its input or else its first parameter
+            grad_inputs = [
+                tensor for tensor in _tensors(inputs) if tensor.requires_grad
+            ]
+            grad_outputs = [
+                tensor for tensor in _tensors(output) if tensor.requires_grad
+            ]
+            first_param = self._first_params.get(name)
+            timed = first_param is not None and first_param.requires_grad
+            if grad_outputs and (grad_inputs or timed):
+                for tensor in grad_outputs:
+                    tensor.register_hook(self._backward_start_hook(name))
+                for tensor in grad_inputs:
+                    tensor.register_hook(self._backward_end_hook(name))
+
+        return hook
+
+    def _backward_start_hook(self, name: str):
+        def hook(grad: Tensor) -> None:
+            if self.active:
+                self._starts.setdefault((name, "backward"), self._marker(grad.device))
+
+        return hook
+
+    def _backward_end_hook(self, name: str):
+        def hook(grad: Tensor) -> None:
+            if self.active:
+                self._record(name, "backward", self._marker(grad.device))
+
+        return hook
+
+    def _flops_hook(self, name: str):
+        def hook(module: nn.Module, inputs: Any, output: Tensor) -> None:
+            if self.active:
+                self._circuit_stats(name)["flops"] += _layer_flops(
+                    module, inputs[0], output
+                )
+
+        return hook
+
+    ### Timing ###
+
+    def _marker(self, device: Optional[torch.device]) -> _Marker:
+        """Mark the current time, with a CUDA event on CUDA devices."""
+        if device is None or device.type != "cuda":
+            return time.perf_counter()
+        event = torch.cuda.Event(enable_timing=True)
+        event.record(torch.cuda.current_stream(device))
+        if self._origin is None:
+            self._origin = (time.perf_counter(), event)
+        return event
+
+    def _record(self, name: str, phase: str, end: _Marker) -> None:
+        start = self._starts.pop((name, phase), None)
+        if start is not None:
+            self._pending.append((name, phase, start, end))
+        # Bound the pending measurements if the statistics are rarely read
+        if len(self._pending) >= self._max_pending:
+            self._resolve()
+
+    def _resolve(self) -> None:
+        """Add the pending measurements to the statistics and trace events."""
+        for _, _, _, end in self._pending:
+            if isinstance(end, torch.cuda.Event):
+                end.synchronize()
+        for name, phase, start, end in self._pending:
+            start_time, end_time = self._time(start), self._time(end)
+            self._circuit_stats(name)[f"{phase}_time"] += end_time - start_time
+            if self.trace:
+                self._events.append(
+                    {
+                        "name": name,
+                        "cat": phase,
+                        "ph": "X",
+                        "ts": 1e6 * start_time,
+                        "dur": 1e6 * (end_time - start_time),
+                        "pid": os.getpid(),
+                        "tid": phase,
+                    }
+                )
+        self._pending = []
+
+    def _time(self, marker: _Marker) -> float:
+        if isinstance(marker, float):
+            return marker
+        assert self._origin is not None
+        origin_time, origin_event = self._origin
+        return origin_time + origin_event.elapsed_time(marker) / 1000
+
+    def _circuit_stats(self, name: str) -> Dict[str, float]:
+        if name not in self._stats:
+            self._stats[name] = {stat: 0.0 for stat in _STATS}
+        return self._stats[name]
+
+
+def _layer_flops(module: nn.Module, input: Tensor, output: Tensor) -> float:
+    """Estimate the FLOPs (multiply and add) of a convolutional or linear layer."""
+    if isinstance(module, nn.Linear):
+        return 2.0 * output.numel() * module.in_features
+    if isinstance(module, nn.Conv2d):
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        return 2.0 * output.numel() * kernel * module.in_channels / module.groups
+    if isinstance(module, nn.ConvTranspose2d):
+        # Every input element is scattered to kernel * out_channels / groups outputs
+        kernel = module.kernel_size[0] * module.kernel_size[1]
+        return 2.0 * input.numel() * kernel * module.out_channels / module.groups
+    return 0.0
+
+
+def _tensors(value: Any) -> List[Tensor]:
+    if isinstance(value, Tensor):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [tensor for item in value for tensor in _tensors(item)]
+    return []
+
+
+def _device(value: Any) -> Optional[torch.device]:
+    tensors = _tensors(value)
+    return tensors[0].device if tensors else None
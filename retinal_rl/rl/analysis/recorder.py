@@ -0,0 +1,198 @@
+"""Chunked on-disk storage for simulation records."""
+
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy.typing import ArrayLike, DTypeLike, NDArray
+
+_META_FILE = "meta.json"
+
+
+class SimulationRecorder:
+    """Stream per-frame records of a batch of environments to disk.
+
+    Every field is stored as a sequence of .npy chunks of chunk_size frames, which are
+    preallocated as memory maps and filled frame by frame. Arrays are frame-major, i.e.
+    (frames, envs, *shape), so that recording a frame is a contiguous write per field.
+    Storage is append-only: finished chunks are never written again, and the metadata
+    is updated after every chunk so that an interrupted recording can be resumed.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        num_envs: int,
+        fields: Dict[str, Tuple[Tuple[int, ...], DTypeLike]],
+        chunk_size: int = 1024,
+        append: bool = False,
+    ):
+        """Create a recording in path with the given field shapes and dtypes.
+
+        If append is True and path already holds a recording, new frames are appended
+        after its last frame. Earlier chunks are left untouched, and a partially filled
+        last chunk is reopened and filled up.
+        """
+        self.path = path
+        self.num_envs = num_envs
+        self.fields = {
+            name: (tuple(shape), np.dtype(dtype))
+            for name, (shape, dtype) in fields.items()
+        }
+        self.chunk_size = chunk_size
+        self.num_frames = 0
+        self._chunks: Dict[str, np.memmap] = {}
+        self._partial_chunk: Optional[int] = None
+
+        if append and (path / _META_FILE).exists():
+            self._resume()
+        path.mkdir(parents=True, exist_ok=True)
+
+    def record(self, **values: ArrayLike) -> None:
+        """Write one frame, with each field given as an array of shape (envs, *shape)."""
+        offset = self.num_frames % self.chunk_size
+        if not self._chunks:
+            self._open_chunk(self.num_frames // self.chunk_size)
+        for name, value in values.items():
+            self._chunks[name][offset] = value
+        self.num_frames += 1
+
+        # Keep the recording resumable after every completed chunk
+        if self.num_frames % self.chunk_size == 0:
+            self._flush()
+            self._chunks = {}
+            self._write_meta()
+
+    def close(self) -> None:
+        """Flush the last chunk and write the metadata of the recording."""
+        self._flush()
+        self._chunks = {}
+        self._write_meta()
+
+    def _write_meta(self) -> None:
+        meta = {
+            "num_envs": self.num_envs,
+            "chunk_size": self.chunk_size,
+            "num_frames": self.num_frames,
+            "fields": {
+                name: {"shape": list(shape), "dtype": dtype.str}
+                for name, (shape, dtype) in self.fields.items()
+            },
+        }
+        tmp_file = self.path / f"{_META_FILE}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_file, self.path / _META_FILE)
+
+    def _resume(self) -> None:
+        meta = read_meta(self.path)
+        fields = {
+            name: (tuple(field["shape"]), np.dtype(field["dtype"]))
+            for name, field in meta["fields"].items()
+        }
+        if meta["num_envs"] != self.num_envs or fields != self.fields:
+            raise ValueError(
+                f"Cannot append to {self.path}, the number of environments or fields differ."
+            )
+        self.chunk_size = meta["chunk_size"]
+        self.num_frames = meta["num_frames"]
+        if self.num_frames % self.chunk_size:
+            self._partial_chunk = self.num_frames // self.chunk_size
+
+    def _open_chunk(self, index: int) -> None:
+        for name, (shape, dtype) in self.fields.items():
+            chunk_file = _chunk_file(self.path, name, index)
+            if index == self._partial_chunk:
+                # Fill up the last chunk of the resumed recording in place
+                self._chunks[name] = np.load(chunk_file, mmap_mode="r+")
+            else:
+                self._chunks[name] = np.lib.format.open_memmap(
+                    chunk_file,
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(self.chunk_size, self.num_envs, *shape),
+                )
+
+    def _flush(self) -> None:
+        for chunk in self._chunks.values():
+            chunk.flush()
+
+
+def load_simulation(
+    path: Path, fields: Optional[List[str]] = None
+) -> Dict[str, NDArray[np.generic]]:
+    """Load (a subset of) the fields of a recording as (frames, envs, *shape) arrays."""
+    meta = read_meta(path)
+    num_frames = meta["num_frames"]
+    num_chunks = -(-num_frames // meta["chunk_size"])
+
+    if fields is None:
+        fields = list(meta["fields"])
+
+    records: Dict[str, NDArray[np.generic]] = {}
+    for name in fields:
+        if num_chunks == 0:
+            shape, dtype = meta["fields"][name]["shape"], meta["fields"][name]["dtype"]
+            records[name] = np.zeros((0, meta["num_envs"], *shape), dtype=dtype)
+            continue
+        chunks = [
+            np.load(_chunk_file(path, name, index), mmap_mode="r")
+            for index in range(num_chunks)
+        ]
+        records[name] = np.concatenate(chunks)[:num_frames]
+    return records
+
+
+def read_frames(
+    path: Path, fields: List[str], frames: ArrayLike
+) -> Dict[str, NDArray[np.generic]]:
+    """Read the given frames of some fields of a recording, without loading whole chunks."""
+    meta = read_meta(path)
+    frames = np.asarray(frames, dtype=np.int64)
+    chunk_indices = frames // meta["chunk_size"]
+
+    records: Dict[str, NDArray[np.generic]] = {}
+    for name in fields:
+        shape, dtype = meta["fields"][name]["shape"], meta["fields"][name]["dtype"]
+        values = np.empty((len(frames), meta["num_envs"], *shape), dtype=dtype)
+        for index in np.unique(chunk_indices):
+            chunk = np.load(_chunk_file(path, name, int(index)), mmap_mode="r")
+            selected = chunk_indices == index
+            values[selected] = chunk[frames[selected] % meta["chunk_size"]]
+        records[name] = values
+    return records
+
+
+def write_frames(path: Path, name: str, start: int, values: ArrayLike) -> None:
+    """Write values of shape (frames, envs, *shape) into a field, starting at frame start.
+
+    This is meant for fields derived after the recording, e.g. attributions, whose
+    chunks are preallocated by the recorder but not filled while recording.
+    """
+    meta = read_meta(path)
+    values = np.asarray(values)
+    chunk_size = meta["chunk_size"]
+    end = start + len(values)
+    if end > meta["num_frames"]:
+        raise ValueError(f"Frames up to {end} exceed the recording of {path}.")
+
+    frame = start
+    while frame < end:
+        index, offset = divmod(frame, chunk_size)
+        count = min(chunk_size - offset, end - frame)
+        chunk = np.load(_chunk_file(path, name, index), mmap_mode="r+")
+        chunk[offset : offset + count] = values[frame - start : frame - start + count]
+        chunk.flush()
+        frame += count
+
+
+def read_meta(path: Path) -> Dict[str, Any]:
+    """Read the metadata (number of frames and environments, fields) of a recording."""
+    with open(path / _META_FILE) as f:
+        return json.load(f)
+
+
+def _chunk_file(path: Path, name: str, index: int) -> Path:
+    return path / f"{name}_{index:05d}.npy"
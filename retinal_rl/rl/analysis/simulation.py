@@ -1,9 +1,15 @@
 ### Util for preparing simulations and data for analysis
 
-from typing import Tuple
+import atexit
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
 
 import numpy as np
 import torch
+from numpy.typing import NDArray
 from sample_factory.algo.sampling.batched_sampling import preprocess_actions
 from sample_factory.algo.utils.action_distributions import argmax_actions
 from sample_factory.algo.utils.env_info import extract_env_info
@@ -15,269 +21,514 @@ from sample_factory.model.model_utils import get_rnn_size
 from sample_factory.utils.attr_dict import AttrDict
 from sample_factory.utils.typing import Config
 from sample_factory.utils.utils import log
+from torch import Tensor
 from tqdm.auto import tqdm
 
-from retinal_rl.util import from_float_to_rgb, obs_dict_to_tuple, obs_to_img
+from retinal_rl.rl.analysis.recorder import (
+    SimulationRecorder,
+    read_frames,
+    read_meta,
+    write_frames,
+)
 
 torch.backends.cudnn.enabled = False
 
+_T = TypeVar("_T")
+
+
+class VectorizedEnvs:
+    """Step a batch of (single-agent) sample factory environments in lockstep.
+
+    Observations of all environments are stacked along the batch dimension, so that
+    the policy can be evaluated once per step for the whole batch. Environments are
+    stepped concurrently by a thread per environment: every VizDoom game runs in its
+    own engine process and releases the GIL while it advances, so the engines of a
+    step run in parallel while the environments stay in this process (and can be
+    pooled, see EnvPool).
+    """
+
+    def __init__(self, envs: List[BatchedVecEnv]):
+        """Wrap the given environments."""
+        self.envs = envs
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._reset_obs: Optional[Dict[str, Tensor]] = None
+
+    @property
+    def num_envs(self) -> int:
+        return len(self.envs)
+
+    def _map(self, fn: Callable[[int, BatchedVecEnv], _T]) -> List[_T]:
+        # Calls fn(i, env) for every environment, in parallel for more than one
+        if self.num_envs <= 1:
+            return [fn(i, env) for i, env in enumerate(self.envs)]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.num_envs, thread_name_prefix="retinal-env"
+            )
+        return list(self._executor.map(fn, range(self.num_envs), self.envs))
+
+    def reset(self) -> Dict[str, Tensor]:
+        """Reset all environments, unless they weren't stepped since the last reset."""
+        if self._reset_obs is None:
+            self._reset_obs = _stack_obs(self._map(lambda _i, env: env.reset()[0]))
+        return self._reset_obs
+
+    def step(
+        self, actions: Any
+    ) -> Tuple[Dict[str, Tensor], NDArray[np.float64], NDArray[np.bool_]]:
+        """Step every environment with its action, and return observations, rewards and dones.
+
+        Environments reset automatically at the end of an episode.
+        """
+        self._reset_obs = None
+        results = self._map(lambda i, env: env.step(actions[i : i + 1]))
+        obs_dicts, rewards, terminated, truncated, _ = zip(*results)
+        dones = [
+            _scalar(term) or _scalar(trunc)
+            for term, trunc in zip(terminated, truncated)
+        ]
+        return (
+            _stack_obs(list(obs_dicts)),
+            np.array([_scalar(reward) for reward in rewards]),
+            np.array(dones, dtype=bool),
+        )
+
+    def infos(self) -> List[Dict[str, Any]]:
+        return [env.unwrapped.get_info() for env in self.envs]
+
+    def shutdown(self) -> None:
+        """Stop the stepping threads, but keep the environments open."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def close(self) -> None:
+        self.shutdown()
+        for env in self.envs:
+            env.close()
+
+
+# Settings an environment is created with, environments are only shared if they match
+_ENV_KEY_FIELDS = ["env", "env_frameskip", "res_w", "res_h", "input_satiety"]
+
+# Pools whose idle environments are closed at exit
+_pools: "weakref.WeakSet[EnvPool]" = weakref.WeakSet()
+
+
+class EnvPool:
+    """Keep initialized environments alive between analysis runs.
+
+    Starting VizDoom dominates short analyses, so environments are created once and
+    checked out by every following analysis or checkpoint evaluation of the same
+    scenario (and settings). Up to max_idle_envs environments per scenario are kept
+    after checkin. Checked out environments are reset, so no episode carries over
+    from a previous checkout.
+    """
+
+    def __init__(self, max_idle_envs: int = 8):
+        """Create an empty pool, which closes its environments at exit."""
+        self.max_idle_envs = max_idle_envs
+        self._idle: Dict[Tuple[Any, ...], List[BatchedVecEnv]] = {}
+        self._keys: Dict[int, Tuple[Any, ...]] = {}
+        self._num_created = 0
+        _pools.add(self)
+
+    def checkout(
+        self, cfg: Config, num_envs: int, render_mode: str = "rgb_array"
+    ) -> VectorizedEnvs:
+        """Return num_envs reset environments, creating those that aren't idle."""
+        key = (*(getattr(cfg, field, None) for field in _ENV_KEY_FIELDS), render_mode)
+        idle = self._idle.setdefault(key, [])
+        envs = [idle.pop() for _ in range(min(num_envs, len(idle)))]
+        for env in envs:
+            self._keys[id(env)] = key
+
+        checked_out = VectorizedEnvs(envs)
+        try:
+            new_envs = make_envs(
+                cfg, num_envs - len(envs), render_mode, self._num_created
+            )
+            self._num_created += new_envs.num_envs
+            for env in new_envs.envs:
+                self._keys[id(env)] = key
+            checked_out.envs += new_envs.envs
+            checked_out.reset()
+        except BaseException:
+            # Environments that failed to start or reset aren't reused
+            for env in checked_out.envs:
+                self._keys.pop(id(env))
+            checked_out.close()
+            raise
+        return checked_out
+
+    def checkin(self, envs: VectorizedEnvs) -> None:
+        """Return environments to the pool, closing those exceeding max_idle_envs."""
+        envs.shutdown()
+        for env in envs.envs:
+            idle = self._idle.setdefault(self._keys.pop(id(env)), [])
+            if len(idle) < self.max_idle_envs:
+                idle.append(env)
+            else:
+                env.close()
+
+    @contextmanager
+    def lease(
+        self, cfg: Config, num_envs: int, render_mode: str = "rgb_array"
+    ) -> Iterator[VectorizedEnvs]:
+        """Check out environments for the duration of a with block."""
+        envs = self.checkout(cfg, num_envs, render_mode)
+        try:
+            yield envs
+        finally:
+            self.checkin(envs)
+
+    def close(self) -> None:
+        """Close all idle environments."""
+        for idle in self._idle.values():
+            for env in idle:
+                env.close()
+        self._idle = {}
+
+
+@atexit.register
+def _close_pools() -> None:
+    for pool in list(_pools):
+        pool.close()
+
+
+def make_envs(
+    cfg: Config, num_envs: int, render_mode: str = "rgb_array", first_env_id: int = 0
+) -> VectorizedEnvs:
+    """Create num_envs environments, numbered from first_env_id on."""
+    log.debug("RETINAL RL: Making %d environments...", num_envs)
+    return VectorizedEnvs(
+        [
+            make_env_func_batched(
+                cfg,
+                env_config=AttrDict(worker_index=0, vector_index=env_id, env_id=env_id),
+                render_mode=render_mode,
+            )
+            for env_id in range(first_env_id, first_env_id + num_envs)
+        ]
+    )
+
 
 def get_brain_env(
-    cfg: Config, checkpoint_dict
-) -> Tuple[ActorCritic, BatchedVecEnv, AttrDict, int]:
+    cfg: Config,
+    checkpoint_dict,
+    num_envs: int = 1,
+    env_pool: Optional[EnvPool] = None,
+) -> Tuple[ActorCritic, VectorizedEnvs, AttrDict, int]:
     """
-    Load the model from checkpoint, initialize the environment, and return both.
+    Load the model from checkpoint, initialize num_envs environments, and return both.
+
+    If an env_pool is given, the environments are checked out from it, and have to be
+    checked in again after use (see EnvPool). Otherwise they are created, and have to
+    be closed after use. If loading the model fails, they are checked in or closed
+    before the error is raised.
     """
     # verbose = False
 
     cfg.env_frameskip = cfg.eval_env_frameskip
 
+    # Every environment is created individually and batched by VectorizedEnvs
     cfg.num_envs = 1
 
-    # In general we only focus on saving to files
-    render_mode = "rgb_array"
-
-    log.debug("RETINAL RL: Making environment...")
-    env = make_env_func_batched(
-        cfg,
-        env_config=AttrDict(worker_index=0, vector_index=0, env_id=0),
-        render_mode=render_mode,
-    )
+    # In general we only focus on saving to files (rgb_array rendering)
+    if env_pool is None:
+        envs = make_envs(cfg, num_envs)
+    else:
+        envs = env_pool.checkout(cfg, num_envs)
 
-    log.debug("RETINAL RL: Finished making environment, loading actor-critic model...")
-    brain = create_actor_critic(cfg, env.observation_space, env.action_space)
-    # log.debug("RETINAL RL: ...evaluating actor-critic model...")
-    brain.eval()
+    try:
+        log.debug(
+            "RETINAL RL: Finished making environments, loading actor-critic model..."
+        )
+        brain = create_actor_critic(
+            cfg, envs.envs[0].observation_space, envs.envs[0].action_space
+        )
+        # log.debug("RETINAL RL: ...evaluating actor-critic model...")
+        brain.eval()
 
-    # log.debug("RETINAL RL: Actor-critic initialized...")
+        # log.debug("RETINAL RL: Actor-critic initialized...")
 
-    device = torch.device("cpu" if cfg.device == "cpu" else "cuda")
-    brain.model_to_device(device)
+        device = torch.device("cpu" if cfg.device == "cpu" else "cuda")
+        brain.model_to_device(device)
 
-    # log.debug("RETINAL RL: ...copied to device...")
+        # log.debug("RETINAL RL: ...copied to device...")
 
-    brain.load_state_dict(checkpoint_dict["model"])
-    nstps = checkpoint_dict["env_steps"]
+        brain.load_state_dict(checkpoint_dict["model"])
+        nstps = checkpoint_dict["env_steps"]
+    except BaseException:
+        if env_pool is None:
+            envs.close()
+        else:
+            env_pool.checkin(envs)
+        raise
 
     # log.debug("RETINAL RL: ...and loaded from checkpoint.")
 
-    return brain, env, cfg, nstps
+    return brain, envs, cfg, nstps
 
 
-def generate_simulation(  # TODO: code unused, can be deleted?
+def generate_simulation(
     cfg: Config,
     brain: ActorCritic,
-    env: BatchedVecEnv,
-    sim_recs,
+    envs: VectorizedEnvs,
+    path: Path,
     prgrs: bool,
     video: bool,
-):
+    append: bool = False,
+    chunk_size: int = 1024,
+) -> SimulationRecorder:
     """
-    Save an example simulation.
+    Record cfg.max_num_frames frames of the policy in every environment to path.
+
+    The policy is evaluated once per step for all environments, and records are streamed
+    to disk in (frames, envs, ...) chunks, see SimulationRecorder and load_simulation.
+    Images are stored as uint8 and normalized images and attributions as float16. With
+    append, the frames are added to an existing recording in path (see --append_sim).
+    Attributions are not computed during the rollout, but in batches afterwards, see
+    attribute_simulation.
     """
-    num_frames = 0
+    num_envs = envs.num_envs
     t_max = int(cfg.max_num_frames)
 
-    if sim_recs is None:
-        sim_recs = {}
-        # Initializing stream arrays
-        sim_recs["ltnts"] = np.zeros((cfg.rnn_size, t_max))
-        sim_recs["plcys"] = np.zeros((2, 3, t_max))
-        sim_recs["uhlths"] = np.zeros(t_max)
-        sim_recs["nnrshms"] = np.zeros(t_max)
-        sim_recs["npsns"] = np.zeros(t_max)
-        sim_recs["hlths"] = np.zeros(t_max)
-        sim_recs["rwds"] = np.zeros(t_max)
-        sim_recs["vals"] = np.zeros(t_max)
-        sim_recs["crwds"] = np.zeros(t_max)
-        sim_recs["dns"] = np.zeros(t_max)
-
-        if video:
-            sim_recs["imgs"] = np.zeros((cfg.res_h, cfg.res_w, 3, t_max)).astype(
-                np.uint8
-            )
-            sim_recs["nimgs"] = np.zeros((cfg.res_h, cfg.res_w, 3, t_max))
-            sim_recs["attrs"] = np.zeros((cfg.res_h, cfg.res_w, 3, t_max))
-
-    else:
-        # Set num_frames to the number of frames already saved
-        num_frames = sim_recs["rwds"].shape[0]
-        # Extend the arrays to the new size
-        sim_recs["ltnts"] = np.concatenate(
-            (sim_recs["ltnts"], np.zeros((cfg.rnn_size, t_max))), axis=1
-        )
-        sim_recs["plcys"] = np.concatenate(
-            (sim_recs["plcys"], np.zeros((2, 3, t_max))), axis=2
-        )
-        sim_recs["uhlths"] = np.concatenate((sim_recs["uhlths"], np.zeros(t_max)))
-        sim_recs["nnrshms"] = np.concatenate((sim_recs["nnrshms"], np.zeros(t_max)))
-        sim_recs["npsns"] = np.concatenate((sim_recs["npsns"], np.zeros(t_max)))
-        sim_recs["hlths"] = np.concatenate((sim_recs["hlths"], np.zeros(t_max)))
-        sim_recs["rwds"] = np.concatenate((sim_recs["rwds"], np.zeros(t_max)))
-        sim_recs["vals"] = np.concatenate((sim_recs["vals"], np.zeros(t_max)))
-        sim_recs["crwds"] = np.concatenate((sim_recs["crwds"], np.zeros(t_max)))
-        sim_recs["dns"] = np.concatenate((sim_recs["dns"], np.zeros(t_max)))
-
-        if video:
-            sim_recs["imgs"] = np.cat(
-                (
-                    sim_recs["imgs"],
-                    np.zeros((cfg.res_h, cfg.res_w, 3, t_max - num_frames)).astype(
-                        np.uint8
-                    ),
-                ),
-                dim=3,
-            )
-            sim_recs["nimgs"] = np.cat(
-                (
-                    sim_recs["nimgs"],
-                    np.zeros((cfg.res_h, cfg.res_w, 3, t_max - num_frames)),
-                ),
-                dim=3,
-            )
-            sim_recs["attrs"] = np.cat(
-                (
-                    sim_recs["attrs"],
-                    np.zeros((cfg.res_h, cfg.res_w, 3, t_max - num_frames)),
-                ),
-                dim=3,
-            )
-
-    t_max = int(cfg.max_num_frames) + num_frames
+    fields: Dict[str, Tuple[Tuple[int, ...], Any]] = {
+        "ltnts": ((cfg.rnn_size,), np.float32),
+        "plcys": ((2, 3), np.float32),
+        "uhlths": ((), np.float32),
+        "nnrshms": ((), np.float32),
+        "npsns": ((), np.float32),
+        "hlths": ((), np.float32),
+        "rwds": ((), np.float32),
+        "vals": ((), np.float32),
+        "crwds": ((), np.float32),
+        "dns": ((), np.bool_),
+    }
+    if video:
+        fields["imgs"] = ((cfg.res_h, cfg.res_w, 3), np.uint8)
+        fields["nimgs"] = ((cfg.res_h, cfg.res_w, 3), np.float16)
+        fields["attrs"] = ((cfg.res_h, cfg.res_w, 3), np.float16)
+        # Policy inputs, to compute the attributions after the rollout
+        fields["rnn_states"] = ((get_rnn_size(cfg),), np.float32)
 
     # Initializing some local variables
-    env_info = extract_env_info(env, cfg)
+    env_info = extract_env_info(envs.envs[0], cfg)
     action_repeat: int = cfg.env_frameskip // cfg.eval_env_frameskip
     device = torch.device("cpu" if cfg.device == "cpu" else "cuda")
 
-    # Initializing simulation state
-    obs_dict, _ = env.reset()
+    # Initializing simulation state (environments reset by a checkout aren't reset twice)
+    obs_dict = envs.reset()
     nobs_dict = prepare_and_normalize_obs(brain, obs_dict)
-    nobs, msms = obs_dict_to_tuple(nobs_dict)
+    if video and "measurements" in obs_dict:
+        fields["msms"] = (tuple(obs_dict["measurements"].shape[1:]), np.float32)
+
+    recorder = SimulationRecorder(path, num_envs, fields, chunk_size, append)
+    start_frame = recorder.num_frames
+    t_max += start_frame
+
     rnn_states = torch.zeros(
-        [env.num_agents, get_rnn_size(cfg)], dtype=torch.float32, device=device
+        [num_envs, get_rnn_size(cfg)], dtype=torch.float32, device=device
     )
-    is_dn = 0
-    rwd = 0
-    crwd = 0
+    # Appended frames start new episodes, so the seam is marked like an episode end
+    is_dn = np.full(num_envs, recorder.num_frames > 0)
+    rwd = np.zeros(num_envs)
+    crwd = np.zeros(num_envs)
+
+    with tqdm(initial=recorder.num_frames, total=t_max, disable=not prgrs) as progress:
+        while recorder.num_frames < t_max:
+            # Evaluate policy for all environments at once
+            with torch.no_grad():
+                policy_outputs = brain(nobs_dict, rnn_states)
+            # Policy inputs are only recorded (and copied to the host) for attributions
+            input_rnn_states = rnn_states.cpu().numpy() if video else None
+            rnn_states = policy_outputs["new_rnn_states"]
+            actions = policy_outputs["actions"]
+            action_distribution = brain.action_distribution()
+            policy = torch.stack(
+                [dstrb.probs for dstrb in action_distribution.distributions], dim=1
+            )
+            value = policy_outputs["values"]
+            ltnt = policy_outputs["latent_states"]
+
+            # can pass --eval_deterministic=True to CLI in order to argmax the probabilistic actions
+            if cfg.eval_deterministic:
+                actions = argmax_actions(action_distribution)
+
+            # actions shape should be [num_envs, num_actions] even if it's [1, 1]
+            if actions.ndim == 1:
+                actions = unsqueeze_tensor(actions, dim=-1)
+            actions = preprocess_actions(env_info, actions)
+
+            ltnt_np = ltnt.cpu().numpy()
+            policy_np = policy.cpu().numpy()
+            value_np = value.reshape(-1).cpu().numpy()
+
+            # Repeating actions during evaluation because we run the simulation at higher FPS
+            dones = np.zeros(num_envs, dtype=bool)
+            for _ in range(action_repeat):
+                if recorder.num_frames == t_max:
+                    break
+
+                infos = envs.infos()
+                crwd = np.where(is_dn, 0, crwd + rwd)
+
+                frame = {
+                    "ltnts": ltnt_np,
+                    "plcys": policy_np,
+                    "hlths": [info.get("HEALTH") for info in infos],
+                    "uhlths": [info.get("USER17") for info in infos],
+                    "nnrshms": [info.get("USER18") for info in infos],
+                    "npsns": [info.get("USER19") for info in infos],
+                    "dns": is_dn,
+                    "vals": value_np,
+                    "rwds": rwd,
+                    "crwds": crwd,
+                }
+
+                if input_rnn_states is not None:
+                    frame.update(_video_frame(obs_dict, nobs_dict, input_rnn_states))
+
+                recorder.record(**frame)
+                progress.update()
+
+                obs_dict, rwd, is_dn = envs.step(actions)
+                nobs_dict = prepare_and_normalize_obs(brain, obs_dict)
+                dones |= is_dn
+
+            rnn_states = _reset_done_states(rnn_states, dones)
+
+    recorder.close()
 
-    nobs1 = torch.unsqueeze(nobs, 0)
-    msms1 = torch.tensor([])
+    if video:
+        attribute_simulation(
+            brain,
+            path,
+            device,
+            start_frame,
+            cfg.attribution_step,
+            cfg.attribution_batch_size,
+            prgrs,
+        )
 
-    if msms is not None:
-        msms1 = torch.unsqueeze(msms, 0)
+    return recorder
 
-    # onnx_inpts = brain.prune_inputs(nobs1,msms1,rnn_states)
 
-    # Simulation loop with tqdm
-    for num_frames in tqdm(range(num_frames, t_max), disable=not prgrs):
-        # Evaluate policy
-        policy_outputs = brain(nobs_dict, rnn_states)
-        rnn_states = policy_outputs["new_rnn_states"]
-        actions = policy_outputs["actions"]
-        action_distribution = brain.action_distribution()
-        acts_dstrbs = action_distribution.distributions
-        policy = torch.stack([dstrb.probs[0] for dstrb in acts_dstrbs])
-        value = policy_outputs["values"]
+def attribute_simulation(
+    brain: ActorCritic,
+    path: Path,
+    device: torch.device,
+    start_frame: int = 0,
+    step: int = 1,
+    batch_size: int = 256,
+    prgrs: bool = False,
+) -> None:
+    """
+    Compute the attributions of a recorded simulation from start_frame on.
+
+    The attribution of a frame is the absolute gradient of the value with respect to
+    the normalized observation. Frames are read back from the recording and attributed
+    in batches of batch_size (frames x envs). With step > 1, only every step-th frame
+    is attributed and the frames in between are linearly interpolated.
+    """
+    meta = read_meta(path)
+    num_frames = meta["num_frames"]
+    inputs = ["imgs", "rnn_states"] + (["msms"] if "msms" in meta["fields"] else [])
+
+    # Attribute and write windows of about one batch of keyframes at a time
+    window = max(batch_size // meta["num_envs"], 1) * step
+    for start in tqdm(range(start_frame, num_frames, window), disable=not prgrs):
+        frames = np.arange(start, min(start + window, num_frames))
+
+        # Keyframes before and after every frame of the chunk
+        before = start_frame + (frames - start_frame) // step * step
+        after = np.where(
+            frames == before, before, np.minimum(before + step, num_frames - 1)
+        )
+        keyframes, key_indices = np.unique(
+            np.concatenate([before, after]), return_inverse=True
+        )
 
-        ltnt = policy_outputs["latent_states"]
+        records = read_frames(path, inputs, keyframes)
+        key_attrs = _batched_saliency(brain, records, device, batch_size)
+
+        # Linear interpolation between the surrounding keyframes
+        weights = np.divide(
+            frames - before,
+            after - before,
+            out=np.zeros(len(frames)),
+            where=after > before,
+        ).reshape(-1, 1, 1, 1, 1)
+        attrs = (1 - weights) * key_attrs[key_indices[: len(frames)]] + (
+            weights * key_attrs[key_indices[len(frames) :]]
+        )
+        write_frames(path, "attrs", start, attrs.astype(np.float16))
 
-        # can pass --eval_deterministic=True to CLI in order to argmax the probabilistic actions
-        if cfg.eval_deterministic:
-            action_distribution = brain.action_distribution()
-            actions = argmax_actions(action_distribution)
-
-        # actions shape should be [num_agents, num_actions] even if it's [1, 1]
-        if actions.ndim == 1:
-            actions = unsqueeze_tensor(actions, dim=-1)
-        actions = preprocess_actions(env_info, actions)
-
-        # Repeating actions during evaluation because we run the simulation at higher FPS
-        for _ in range(action_repeat):
-            obs, msms = obs_dict_to_tuple(obs_dict)
-            nobs, _ = obs_dict_to_tuple(nobs_dict)
-
-            info = env.unwrapped.get_info()
-            health = info.get("HEALTH")  # environment info (health etc.)
-            unbound_health = info.get("USER17")  # environment info (health etc.)
-            num_nourishments = info.get("USER18")  # environment info (health etc.)
-            num_poisons = info.get("USER19")  # environment info (health etc.)
-
-            if is_dn:
-                crwd = 0
-            else:
-                crwd += rwd
-
-            sim_recs["ltnts"][:, num_frames] = ltnt.cpu().detach().numpy()
-            sim_recs["plcys"][:, :, num_frames] = policy.cpu().detach().numpy()
-
-            sim_recs["hlths"][num_frames] = health
-            sim_recs["uhlths"][num_frames] = unbound_health
-            sim_recs["nnrshms"][num_frames] = num_nourishments
-            sim_recs["npsns"][num_frames] = num_poisons
-            sim_recs["dns"][num_frames] = is_dn
-            sim_recs["vals"][num_frames] = value
-            sim_recs["rwds"][num_frames] = rwd
-            sim_recs["crwds"][num_frames] = crwd
-
-            if video:
-                if msms is not None:
-                    msms1 = torch.unsqueeze(msms, 0)
-
-                nobs1 = torch.unsqueeze(nobs, 0)
-                nobsatt = brain.attribute(nobs1, msms1, rnn_states)
-                attr = torch.squeeze(nobsatt, 0)
-
-                img = obs_to_img(obs)
-                nimg = obs_to_img(nobs)
-                attrimg = obs_to_img(attr)
-
-                sim_recs["imgs"][:, :, :, num_frames] = img
-                sim_recs["nimgs"][:, :, :, num_frames] = nimg
-                sim_recs["attrs"][:, :, :, num_frames] = attrimg
-
-            obs_dict, rwd, terminated, truncated, _ = env.step(actions)
-            is_dn = truncated | terminated
-            nobs_dict = prepare_and_normalize_obs(brain, obs_dict)
-
-            # Report multivariate mean and std of plcys from 0 to current frame using tqdm
-            # if prgrs and num_frames % 100 == 0:
-            #     heading_means = np.mean(plcys[0,:,:num_frames+1],axis=1)
-            #     heading_sds = np.std(plcys[0,:,:num_frames+1],axis=1)
-            #     velocity_means = np.mean(plcys[1,:,:num_frames+1],axis=1)
-            #     velocity_sds = np.std(plcys[1,:,:num_frames+1],axis=1)
-            #   # Update the statistics on the second line
-            #     stats1.set_description(f"Heading stats: means {heading_means}; sds: {heading_sds}")
-            #     stats1.refresh()  # Refresh to show the updated statistics
-            #     stats2.set_description(f"Velocity stats: means {velocity_means}; sds: {velocity_sds}")
-            #     stats2.refresh()  # Refresh to show the updated statistics
-            #
 
-    if video:
-        sim_recs["attrs"] = abs(sim_recs["attrs"])
-        sim_recs["attrs"] = from_float_to_rgb(sim_recs["attrs"])
-        sim_recs["nimgs"] = from_float_to_rgb(sim_recs["nimgs"])
-
-    # Shuffle x and y in the same way
-    # idx = shuffle(np.arange(t_max))
-    # x = hlths[idx]
-    # # transpose ltnts so that each row is a latent state
-    # y = np.transpose(ltnts)
-    # y = y[idx]
-    #
-    # # Split data into training and test sets
-    # x_train, x_test, y_train, y_test = train_test_split(x, y, test_size=0.2, random_state=42)
-    #
-    # # Train a linear predictor
-    # reg = LinearRegression().fit(y_train, x_train)
-    #
-    # # Predict on the test set
-    # x_pred = reg.predict(y_test)
-    #
-    # # Calculate the root mse
-    # rmse = mean_squared_error(x_test, x_pred, squared=False)
-    #
-    # print(f"\n\n\nHealth Mean Squared Error: {rmse}")
-    # print(f"Coefficients: {reg.coef_}")
-    #
-    return sim_recs
+def _batched_saliency(
+    brain: ActorCritic,
+    records: Dict[str, NDArray[Any]],
+    device: torch.device,
+    batch_size: int,
+) -> NDArray[np.float32]:
+    # Flatten (frames, envs) into one batch dimension
+    num_frames, num_envs = records["imgs"].shape[:2]
+    flat = {key: value.reshape(-1, *value.shape[2:]) for key, value in records.items()}
+
+    attrs: List[NDArray[np.float32]] = []
+    for i in range(0, num_frames * num_envs, batch_size):
+        obs_dict = {
+            "obs": torch.from_numpy(flat["imgs"][i : i + batch_size])
+            .permute(0, 3, 1, 2)
+            .to(device)
+        }
+        if "msms" in flat:
+            obs_dict["measurements"] = torch.from_numpy(
+                flat["msms"][i : i + batch_size]
+            ).to(device)
+        rnn_states = torch.from_numpy(flat["rnn_states"][i : i + batch_size]).to(device)
+
+        nobs_dict = prepare_and_normalize_obs(brain, obs_dict)
+        nobs = nobs_dict["obs"].detach().requires_grad_()
+        values = brain({**nobs_dict, "obs": nobs}, rnn_states)["values"]
+        (grad,) = torch.autograd.grad(values.sum(), nobs)
+        attrs.append(np.abs(_to_img(grad)).astype(np.float32))
+
+    return np.concatenate(attrs).reshape(num_frames, num_envs, *attrs[0].shape[1:])
+
+
+def _video_frame(
+    obs_dict: Dict[str, Tensor],
+    nobs_dict: Dict[str, Tensor],
+    rnn_states: NDArray[np.float32],
+) -> Dict[str, NDArray[Any]]:
+    frame = {
+        "imgs": _to_img(obs_dict["obs"]),
+        "nimgs": _to_img(nobs_dict["obs"]),
+        "rnn_states": rnn_states,
+    }
+    if "measurements" in obs_dict:
+        frame["msms"] = obs_dict["measurements"].cpu().numpy()
+    return frame
+
+
+def _reset_done_states(rnn_states: Tensor, dones: NDArray[np.bool_]) -> Tensor:
+    # Episodes of environments that were reset start from a zero state again
+    if not dones.any():
+        return rnn_states
+    not_done = torch.as_tensor(~dones, dtype=rnn_states.dtype, device=rnn_states.device)
+    return rnn_states * not_done.unsqueeze(-1)
+
+
+def _to_img(obs: Tensor) -> NDArray[Any]:
+    # Batch of CHW observations to HWC images
+    return obs.detach().permute(0, 2, 3, 1).cpu().numpy()
+
+
+def _stack_obs(obs_dicts: List[Dict[str, Tensor]]) -> Dict[str, Tensor]:
+    return {key: torch.cat([obs[key] for obs in obs_dicts]) for key in obs_dicts[0]}
+
+
+def _scalar(value: Any) -> Any:
+    return torch.as_tensor(value).reshape(-1)[0].item()
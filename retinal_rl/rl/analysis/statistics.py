@@ -77,28 +77,73 @@ def gradient_receptive_fields(
     return stas
 
 
-def _activation_triggered_average(
-    model: nn.Sequential, n_batch: int = 2048, rf_size=None, device=None
-):
+def gaussian_noise_sta(
+    model: nn.Module,
+    input_shape: Tuple[int, int, int],
+    num_samples: int,
+    output_index: Optional[Tuple[int, int]] = None,
+    window: Optional[Tuple[int, int, int, int]] = None,
+    memory_budget: int = 2**28,
+    device: Optional[torch.device] = None,
+    generator: Optional[torch.Generator] = None,
+) -> Tuple[Tensor, Tensor]:
+    """Accumulate the activation-triggered averages of Gaussian noise for all output channels.
+
+    Noise batches are drawn once for all channels, and the weighted sums of all channels
+    are computed with a single einsum over the (cropped) input window. Batches are sized
+    so that inputs and outputs take roughly memory_budget bytes, and the sums are
+    accumulated across batches, so memory does not grow with num_samples.
+
+    Args:
+    ----
+        model (nn.Module): Model mapping (N, C, H, W) inputs to (N, channels, ...) outputs.
+        input_shape (Tuple[int, int, int]): Shape (C, H, W) of the noise inputs.
+        num_samples (int): Total number of noise samples.
+        output_index (Optional[Tuple[int, int]]): Spatial output unit (h, w) whose
+            response weights the inputs. If None, spatial outputs are summed.
+        window (Optional[Tuple[int, int, int, int]]): Input window (h_min, h_max, w_min,
+            w_max) to average over, the whole input if None.
+        memory_budget (int): Approximate number of bytes per batch.
+        device (Optional[torch.device]): Device to run the model on.
+        generator (Optional[torch.Generator]): Random generator for the noise.
+
+    Returns:
+    -------
+        Tuple[Tensor, Tensor]: The weighted input sums (channels, C, h, w) and the sums
+            of the weights (channels,), both float64 on the cpu.
+
+    """
     model.eval()
-    if rf_size is None:
-        _out_channels, input_size = get_input_output_shape(model)
-    else:
-        input_size = rf_size
-    input_tensor = torch.randn(
-        (n_batch, *input_size), requires_grad=False, device=device
-    )
-    output = model(input_tensor)
-    output = sum_collapse_output(output)
-    input_tensor = input_tensor[:, None, :, :, :].expand(
-        -1, output.shape[1], -1, -1, -1
-    )
+    h_min, h_max, w_min, w_max = window or (0, input_shape[1], 0, input_shape[2])
 
-    weights = output[:, :, None, None, None].expand(-1, -1, *input_size)
-    weight_sums = output.sum(0)
-    weight_sums[weight_sums == 0] = 1
-    weighted = (weights * input_tensor).sum(0)
-    return weighted.cpu().detach(), weight_sums.cpu().detach()
+    def responses(outputs: Tensor) -> Tensor:
+        if outputs.ndim > 2:
+            if output_index is None:
+                return outputs.flatten(2).sum(2)
+            return outputs[:, :, output_index[0], output_index[1]]
+        return outputs
+
+    with torch.no_grad():
+        probe = model(torch.zeros(1, *input_shape, device=device))
+        num_outputs = responses(probe).shape[1]
+        sample_bytes = 4 * (math.prod(input_shape) + probe.numel())
+        batch_size = max(1, min(num_samples, memory_budget // sample_bytes))
+
+        crop_shape = (input_shape[0], h_max - h_min, w_max - w_min)
+        weighted = torch.zeros(num_outputs, *crop_shape, dtype=torch.float64)
+        weight_sums = torch.zeros(num_outputs, dtype=torch.float64)
+
+        for start in range(0, num_samples, batch_size):
+            n_batch = min(batch_size, num_samples - start)
+            inputs = torch.randn(
+                (n_batch, *input_shape), device=device, generator=generator
+            )
+            outputs = responses(model(inputs))
+            crop = inputs[:, :, h_min:h_max, w_min:w_max]
+            weighted += torch.einsum("nj,nchw->jchw", outputs, crop).cpu().double()
+            weight_sums += outputs.sum(0).cpu().double()
+
+    return weighted, weight_sums
 
 
 def activation_triggered_average(
@@ -111,25 +156,21 @@ def activation_triggered_average(
     # TODO: WIP
     warnings.warn("Code is not tested and might contain bugs.")
     stas: Dict[str, NDArray[np.float64]] = {}
-    with torch.no_grad():
-        for index, (layer_name, mdl) in tqdm(
-            enumerate(model.named_children()), total=len(model)
-        ):
-            weighted, weight_sums = _activation_triggered_average(
-                model[: index + 1], n_batch, device=device
-            )
-            for _ in tqdm(range(n_iter - 1), total=n_iter - 1, leave=False):
-                it_weighted, it_weight_sums = _activation_triggered_average(
-                    model[: index + 1], n_batch, rf_size, device=device
-                )
-                weighted += it_weighted
-                weight_sums += it_weight_sums
-            stas[layer_name] = (
-                weighted.cpu().detach()
-                / weight_sums[:, None, None, None]
-                / len(weight_sums)
-            ).numpy()
-        torch.cuda.empty_cache()
+    for index, (layer_name, mdl) in tqdm(
+        enumerate(model.named_children()), total=len(model)
+    ):
+        if rf_size is None:
+            _out_channels, input_size = get_input_output_shape(model[: index + 1])
+        else:
+            input_size = rf_size
+        weighted, weight_sums = gaussian_noise_sta(
+            model[: index + 1], input_size, n_batch * n_iter, device=device
+        )
+        weight_sums[weight_sums == 0] = 1
+        stas[layer_name] = (
+            weighted / weight_sums[:, None, None, None] / len(weight_sums)
+        ).numpy()
+    torch.cuda.empty_cache()
     return stas
 
 
@@ -4,6 +4,7 @@ from captum.attr import NeuronGradient
 from openTSNE import TSNE
 from tqdm import tqdm
 
+from retinal_rl.rl.analysis.statistics import gaussian_noise_sta
 from retinal_rl.util import encoder_out_size, rf_size_and_start
 
 
@@ -16,25 +17,18 @@ def gaussian_noise_stas(cfg, env, actor_critic, nbtch, nreps, prgrs):
     dev = torch.device("cpu" if cfg.device == "cpu" else "cuda")
 
     nclrs, hght, wdth = list(env.observation_space["obs"].shape)
-    ochns = nclrs
-
-    btchsz = [nbtch, nclrs, hght, wdth]
 
     stas = {}
 
-    repttl = len(enc.conv_head) * nreps
     mdls = []
 
-    with torch.no_grad(), tqdm(
-        total=repttl, desc="Generating STAs", disable=not (prgrs)
+    with tqdm(
+        total=len(enc.conv_head), desc="Generating STAs", disable=not (prgrs)
     ) as pbar:
         for lyrnm, mdl in enc.conv_head.named_children():
             mdls.append(mdl)
             subenc = torch.nn.Sequential(*mdls)
 
-            # check if mdl has out channels
-            if hasattr(mdl, "out_channels"):
-                ochns = mdl.out_channels
             hsz, wsz = encoder_out_size(subenc, hght, wdth)
 
             hidx = (hsz - 1) // 2
@@ -42,23 +36,24 @@ def gaussian_noise_stas(cfg, env, actor_critic, nbtch, nreps, prgrs):
 
             hrf_size, wrf_size, hmn, wmn = rf_size_and_start(subenc, hidx, widx)
 
-            hmx = hmn + hrf_size
-            wmx = wmn + wrf_size
-
-            stas[lyrnm] = np.zeros((ochns, nclrs, hrf_size, wrf_size))
+            hmn = max(0, hmn)
+            wmn = max(0, wmn)
+            hmx = min(hght, hmn + hrf_size)
+            wmx = min(wdth, wmn + wrf_size)
+
+            # All channels are averaged over the same nbtch * nreps noise samples
+            weighted, weight_sums = gaussian_noise_sta(
+                subenc,
+                (nclrs, hght, wdth),
+                nbtch * nreps,
+                output_index=(hidx, widx),
+                window=(hmn, hmx, wmn, wmx),
+                device=dev,
+            )
+            weight_sums[weight_sums == 0] = 1
+            stas[lyrnm] = (weighted / weight_sums[:, None, None, None]).numpy()
 
-            for _ in range(nreps):
-                pbar.update(1)
-
-                for j in range(ochns):
-                    obss = torch.randn(size=btchsz, device=dev)
-                    obss1 = obss[:, :, hmn:hmx, wmn:wmx].cpu()
-                    outs = subenc(obss)[:, j, hidx, widx].cpu()
-
-                    if torch.sum(outs) != 0:
-                        stas[lyrnm][j] += (
-                            np.average(obss1, axis=0, weights=outs) / nreps
-                        )
+            pbar.update(1)
 
     return stas
 
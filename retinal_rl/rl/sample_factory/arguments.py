@@ -72,6 +72,12 @@ def add_retinal_env_args(parser):
         type=str2bool,
         help="Whether to run online analyses of the model during training",
     )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        type=str2bool,
+        help="Record per-circuit times, FLOPs and memory into the summaries (profile_*)",
+    )
     parser.add_argument(
         "--dry_run",
         default=False,
@@ -140,3 +146,15 @@ def add_retinal_env_eval_args(parser):
         type=str2bool,
         help="If running a simulation, append the simulation to the existing sim_recs.npy file",
     )
+    parser.add_argument(
+        "--attribution_step",
+        type=int,
+        default=1,
+        help="Attribute only every k-th frame of a simulation video and interpolate the rest",
+    )
+    parser.add_argument(
+        "--attribution_batch_size",
+        type=int,
+        default=256,
+        help="Number of frames per batch when computing the attributions of a simulation",
+    )
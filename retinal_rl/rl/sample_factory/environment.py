@@ -45,7 +45,12 @@ def doom_action_space_basic():
 
 
 class SatietyInput(gym.Wrapper):
-    """Add game variables to the observation space + reward shaping."""
+    """Add game variables to the observation space + reward shaping.
+
+    Every step returns a new observation dict with its own measurements, so
+    observations that are kept (e.g. by a frame stack or a recorder) are never
+    overwritten by later steps.
+    """
 
     def __init__(self, env):
         super().__init__(env)
@@ -65,24 +70,20 @@ class SatietyInput(gym.Wrapper):
             }
         )
 
-        num_measurements = 1
-
-        self.measurements_vec = np.zeros([num_measurements], dtype=np.float32)
-
     def _parse_info(self, obs, info):
         # we don't really care how much negative health we have, dead is dead
         hlth = float(
             info["HEALTH"]
         )  # TODO: Used when input_satiety = true - but info does not contain HEALTH
         # clip health to [-1,1]
-        hlth = np.clip(hlth, 0, 100)
-        satiety = (hlth - 50) / 50.0
-        self.measurements_vec[0] = satiety
-        return {"obs": obs, "measurements": self.measurements_vec}
+        hlth = min(max(hlth, 0.0), 100.0)
+        measurements = np.array([(hlth - 50) / 50.0], dtype=np.float32)
+        return {"obs": obs, "measurements": measurements}
 
     def reset(self, **kwargs):
-        obs, _ = self.env.reset(**kwargs)
-        info = self.env.unwrapped.get_info()
+        obs, info = self.env.reset(**kwargs)
+        if "HEALTH" not in info:
+            info = self.env.unwrapped.get_info()
         obs = self._parse_info(obs, info)
         return obs, info
 
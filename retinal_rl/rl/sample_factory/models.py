@@ -1,18 +1,26 @@
 import warnings
+import weakref
 from enum import Enum
-from typing import Dict, Optional, Tuple
+from typing import Any, Dict, List, Optional, Tuple
 
 import networkx as nx
 import numpy as np
 import torch
+from hydra.utils import instantiate
 from omegaconf import DictConfig
 from sample_factory.algo.utils.tensor_dict import TensorDict
 from sample_factory.model.actor_critic import ActorCritic
-from sample_factory.model.model_utils import model_device
+from sample_factory.model.model_utils import get_rnn_size, model_device
 from sample_factory.utils.typing import ActionSpace, Config, ObsSpace
 from torch import Tensor, nn
+from torch.nn.utils.rnn import PackedSequence
+from torch.optim import Optimizer
+from torch.optim.optimizer import register_optimizer_step_post_hook
 
 from retinal_rl.models.brain import Brain
+from retinal_rl.models.circuits.latent_core import LatentRNN
+from retinal_rl.models.loss import BaseContext
+from retinal_rl.models.objective import Objective
 from retinal_rl.rl.sample_factory.sf_interfaces import ActorCriticProtocol
 from runner.util import create_brain  # TODO: Remove runner reference!
 
@@ -31,6 +39,8 @@ class SampleFactoryBrain(ActorCritic, ActorCriticProtocol):
 
         self.set_brain(create_brain(DictConfig(cfg.brain)))
         # TODO: Find way to instantiate brain outside
+        if getattr(cfg, "profile", False):
+            self.brain.enable_profiling()
 
         dec_out_shape = self.brain.circuits[self.decoder_name].output_shape
         decoder_out_size = np.prod(dec_out_shape)
@@ -39,31 +49,136 @@ class SampleFactoryBrain(ActorCritic, ActorCriticProtocol):
             decoder_out_size
         )  # boils down to a linear layer mapping to num_action_outputs
 
+        # Optimizer steps of the learner, which set the epochs of the objective
+        self.train_steps = 0
+        self._optimizer: Optional[weakref.ref[Optimizer]] = None
+        if self.objective is not None:
+            self._register_step_hook()
+
     def set_brain(self, brain: Brain):
         """
         method to set weights / brain.
         Checks for brain compatibility.
-        Decide which part of the brain is head/core/tail or creates Identity transforms if needed.
+        Partitions the circuits the decoder depends on into head, core and tail, see partition.
         """
         enc, core, dec = self.get_encoder_decoder(brain)
         self.brain = brain
         self.encoder_name = enc
-        self.core_mode = core
         self.decoder_name = dec
 
+        objective_cfg = getattr(self.cfg, "objective", None)
+        self.objective: Optional[Objective[BaseContext]] = None
+        if objective_cfg is not None:
+            self.objective = instantiate(objective_cfg, brain=brain)
+        self.objective_summaries: Dict[str, float] = {}
+        self._head_responses: Dict[str, Tensor] = {}
+
+        head, core, tail = self.partition(brain, core, dec)
+        self.core_names = core
+
+        recurrent = [
+            name
+            for name in head + core + tail
+            if isinstance(brain.circuits[name], LatentRNN)
+        ]
+        if any(name not in core for name in recurrent) or len(recurrent) > 1:
+            raise ValueError(
+                f"At most one recurrent circuit is supported, in the core, got {recurrent}"
+            )
+        self.rnn_name: Optional[str] = recurrent[0] if recurrent else None
+
+        if self.rnn_name is not None and len(core) == 1:
+            self.core_mode = CoreMode.RNN
+        elif len(core) == 0:
+            self.core_mode = CoreMode.IDENTITY
+        elif len(core) == 1:
+            self.core_mode = CoreMode.SIMPLE
+        else:
+            self.core_mode = CoreMode.MULTI_MODULES
+
+        # Responses passed from head to core, and from core to tail
+        def consumed(producers: List[str], consumers: List[str]) -> List[str]:
+            return [
+                node
+                for node in producers
+                if any(brain.connectome.has_edge(node, c) for c in consumers)
+            ]
+
+        sensors = [node for node in brain.sensors if node in brain.connectome]
+        self.sensor_names = consumed(sensors, head + core + tail)
+        self.head_outputs = consumed(self.sensor_names + head, core + tail)
+        self.core_outputs = consumed(self.head_outputs + core, tail)
+        if self.objective is not None:
+            # Pass all core responses to the tail for the objective, unpermuted by the
+            # learner in case of packed sequences
+            self.core_outputs += [
+                node for node in core if node not in self.core_outputs
+            ]
+        self.head_plan = brain.plan(self.sensor_names, self.head_outputs)
+        self.core_plan = brain.plan(self.head_outputs, self.core_outputs)
+        self.tail_plan = brain.plan(self.core_outputs, [dec])
+
+        self._shapes = {
+            node: tuple(
+                brain.sensors[node]
+                if node in brain.sensors
+                else brain.circuits[node].output_shape
+            )
+            for node in self.head_outputs + self.core_outputs
+        }
+
+        if self.rnn_name is not None:
+            rnn = brain.circuits[self.rnn_name]
+            assert isinstance(rnn, LatentRNN)
+            if not self.cfg.use_rnn or get_rnn_size(self.cfg) != rnn.state_size:
+                raise ValueError(
+                    f"The recurrent core {self.rnn_name} needs use_rnn and a state of "
+                    f"size {rnn.state_size} (rnn_size * rnn_num_layers)"
+                )
+
     @staticmethod
-    def get_encoder_decoder(brain: Brain) -> Tuple[str, CoreMode, str]:
+    def partition(
+        brain: Brain, core: List[str], decoder: str
+    ) -> Tuple[List[str], List[str], List[str]]:
+        """Split the circuits needed for the decoder into head, core and tail.
+
+        The core spans all circuits between the first and the last of the given core
+        circuits, the head all circuits that do not depend on the core, and the tail
+        the remaining ones, which includes the decoder. Without core, the tail is the
+        decoder only. Circuits the decoder does not depend on (e.g. auxiliary decoders)
+        are not part of any, so they are not evaluated while training the agent.
+        """
+        needed = brain.plan(brain.sensors, [decoder])
+        if not core:
+            return [node for node in needed if node != decoder], [], [decoder]
+
+        core_set = set(core)
+        downstream = set(core)
+        for node in core:
+            downstream |= nx.descendants(brain.connectome, node)
+        upstream = nx.ancestors(brain.connectome, core[-1]) | {core[-1]}
+        core_set |= downstream & upstream
+
+        head = [node for node in needed if node not in downstream]
+        tail = [node for node in needed if node in downstream and node not in core_set]
+        return head, [node for node in needed if node in core_set], tail
+
+    @staticmethod
+    def get_encoder_decoder(brain: Brain) -> Tuple[str, List[str], str]:
         assert "vision" in brain.sensors  # needed as input
         # potential TODO: add other input sources if needed?
 
         vision_paths = []
         for node in brain.connectome:
-            if brain.connectome.out_degree(node) == 0:  # it's a leaf
-                vision_paths.append(nx.shortest_path(brain.connectome, "vision", node))
+            # it's a leaf (that sees the vision sensor)
+            if brain.connectome.out_degree(node) == 0 and nx.has_path(
+                brain.connectome, "vision", node
+            ):
+                vision_paths.append(_longest_path(brain, "vision", node))
 
         decoder = "action_decoder"  # default assumption
         if decoder in brain.circuits:  # needed to produce output = decoder
-            vision_path = nx.shortest_path(brain.connectome, "vision", "action_decoder")
+            vision_path = _longest_path(brain, "vision", "action_decoder")
         else:
             selected_path = 0
             out_dim = np.inf
@@ -81,45 +196,78 @@ class SampleFactoryBrain(ActorCritic, ActorCriticProtocol):
             )
 
         encoder = vision_path[1]
-        if len(vision_path) == 4:
-            core = CoreMode.SIMPLE
-            CoreMode.SIMPLE.value = vision_path[2]  # use center module as core
-            # TODO: Check if recurrent!
-        if len(vision_path) < 4:
-            core = CoreMode.IDENTITY
+        core = vision_path[2:-1]
+        if len(core) == 0:
             warnings.warn("Seems like there is no model core. Will use an Identity.")
-        else:  # more than four
-            core = CoreMode.MULTI_MODULES
-            warnings.warn(
-                "Will use multiple modules as core: "
-                + ", ".join([mod_name for mod_name in vision_path[2:-1]])
-            )
+        elif len(core) > 1:
+            warnings.warn("Will use multiple modules as core: " + ", ".join(core))
 
         return encoder, core, decoder
 
     def forward_head(self, normalized_obs_dict: Dict[str, Tensor]) -> Tensor:
-        vision_input = normalized_obs_dict["obs"]
-        return self.brain.circuits[self.encoder_name](vision_input)
+        # The vision sensor reads sample factory's main observation
+        responses = {
+            sensor: normalized_obs_dict["obs" if sensor == "vision" else sensor]
+            for sensor in self.sensor_names
+        }
+        self.brain.run_plan(self.head_plan, responses)
+        if self.objective is not None and torch.is_grad_enabled():
+            self._head_responses = responses
+        return self._pack(responses, self.head_outputs)
 
     def forward_core(self, head_output, rnn_states):
-        # TODO: what to do with rnn states? -> implement neural circuit that is capable?! (could also be done by some module internally, right?)
-        if self.core_mode == CoreMode.SIMPLE:
-            out = self.brain.circuits[self.core_mode.value](head_output)
-        elif self.core_mode == CoreMode.RNN:
-            out, rnn_states = self.brain.circuits[self.core_mode.value](
-                head_output, rnn_states
-            )
-        elif self.core_mode == CoreMode.IDENTITY:
-            out = head_output
-        if self.core_mode == CoreMode.MULTI_MODULES:
-            out = head_output  # TODO: Implement partial forward (in brain!)
-        return out, rnn_states
+        """Evaluate the core on single steps, or on the PackedSequence of trajectories built by the learner.
+
+        Feedforward circuits are applied to the data of a PackedSequence directly, as
+        they treat all steps independently, and the recurrent circuit (if any) gets
+        the whole sequence at once.
+        """
+        if self.core_mode == CoreMode.IDENTITY:
+            return head_output, rnn_states
+
+        is_seq = isinstance(head_output, PackedSequence)
+        new_rnn_states = rnn_states
+
+        def step_rnn(input: Tensor) -> Tensor:
+            nonlocal new_rnn_states
+            rnn = self.brain.circuits[self.rnn_name]
+            if is_seq:
+                out, new_rnn_states = rnn.forward_rnn(
+                    head_output._replace(data=input), rnn_states
+                )
+                return out.data
+            out, new_rnn_states = rnn.forward_rnn(input, rnn_states)
+            return out
+
+        responses = self._unpack(
+            head_output.data if is_seq else head_output, self.head_outputs
+        )
+        calls = {self.rnn_name: step_rnn} if self.rnn_name is not None else None
+        self.brain.run_plan(self.core_plan, responses, calls)
+
+        out = self._pack(responses, self.core_outputs)
+        if is_seq:
+            out = head_output._replace(data=out)
+        return out, new_rnn_states
 
     def forward_tail(
-        self, core_output, values_only: bool, sample_actions: bool, action_mask: Optional[Tensor] = None
+        self,
+        core_output,
+        values_only: bool,
+        sample_actions: bool,
+        action_mask: Optional[Tensor] = None,
     ) -> TensorDict:
-        out = self.brain.circuits[self.decoder_name](core_output)
-        out = torch.flatten(out, 1)
+        responses = self._unpack(core_output, self.core_outputs)
+        self.brain.run_plan(self.tail_plan, responses)
+        out = torch.flatten(responses[self.decoder_name], 1)
+
+        # The learner evaluates the tail with gradients and without sampling actions
+        if (
+            self.objective is not None
+            and torch.is_grad_enabled()
+            and not sample_actions
+        ):
+            out = self._add_objective_gradients(out, responses)
 
         values = self.critic_linear(out).squeeze()
 
@@ -138,7 +286,11 @@ class SampleFactoryBrain(ActorCritic, ActorCriticProtocol):
         return result
 
     def forward(
-        self, normalized_obs_dict, rnn_states, values_only: bool = False, action_mask: Optional[Tensor] = None
+        self,
+        normalized_obs_dict,
+        rnn_states,
+        values_only: bool = False,
+        action_mask: Optional[Tensor] = None,
     ) -> TensorDict:
         head_out = self.forward_head(normalized_obs_dict)
         core_out, new_rnn_states = self.forward_core(head_out, rnn_states)
@@ -152,9 +304,131 @@ class SampleFactoryBrain(ActorCritic, ActorCriticProtocol):
     def get_brain(self) -> Brain:
         return self.brain
 
+    def summaries(self) -> Dict[str, float]:
+        summaries = super().summaries()
+        summaries.update(self.objective_summaries)
+        # Profile of the learner's passes since the last summaries
+        if self.brain.profiler is not None:
+            summaries.update(self.brain.profiler.summary())
+            self.brain.profiler.reset()
+        return summaries
+
+    def _add_objective_gradients(
+        self, out: Tensor, responses: Dict[str, Tensor]
+    ) -> Tensor:
+        """Differentiate the objective on the responses of the learner's forward pass.
+
+        The responses of the circuits sample factory does not need (e.g. auxiliary
+        decoders) are computed from the recorded ones, so the brain is not evaluated a
+        second time. The weighted gradients are added to the parameters when the PPO
+        loss is backpropagated through the returned tensor (between zeroing the
+        gradients and the optimizer step of the learner). Epochs count the training
+        iterations of the learner, i.e. num_epochs * num_batches_per_epoch optimizer
+        steps.
+        """
+        assert self.objective is not None
+        responses = {**self._head_responses, **responses}
+        self._head_responses = {}
+        missing = [node for node in self.brain.circuits if node not in responses]
+        self.brain.run_plan(self.brain.plan(list(responses), missing), responses)
+
+        batches_per_step = self.cfg.num_epochs * self.cfg.num_batches_per_epoch
+        epoch = self.train_steps // batches_per_step
+
+        vision = responses["vision"]
+        context = BaseContext(vision, vision, responses, epoch)
+        timings: Dict[str, float] = {}
+        loss_dict, grads = self.objective.gradients(
+            context, retain_graph=True, timings=timings
+        )
+
+        self.objective_summaries = {f"objective_{k}": v for k, v in loss_dict.items()}
+        for name, seconds in timings.items():
+            self.objective_summaries[f"objective_{name}_ms"] = 1000 * seconds
+        self.objective_summaries["objective_ms"] = 1000 * sum(timings.values())
+
+        return _AddGradients.apply(out, grads)
+
+    def _register_step_hook(self) -> None:
+        """Count the steps of the learner's optimizer, and apply the decoupled decay.
+
+        Sample factory creates the optimizer of the learner internally, so the
+        optimizer is recognized by its parameters in a global step hook.
+        """
+        model = weakref.ref(self)
+
+        def hook(optimizer: Optimizer, *_: Any) -> None:
+            actor_critic = model()
+            if actor_critic is not None:
+                actor_critic._after_optimizer_step(optimizer)
+
+        handle = register_optimizer_step_post_hook(hook)
+        weakref.finalize(self, handle.remove)
+
+    def _after_optimizer_step(self, optimizer: Optimizer) -> None:
+        if self._optimizer is None or self._optimizer() is not optimizer:
+            param = next(self.parameters())
+            if not any(
+                p is param for group in optimizer.param_groups for p in group["params"]
+            ):
+                return
+            self._optimizer = weakref.ref(optimizer)
+
+        self.train_steps += 1
+        assert self.objective is not None
+        self.objective.apply_decoupled_decay(optimizer)
+
+    def get_extra_state(self) -> Dict[str, int]:
+        # Checkpoints of the learner resume the epochs of the objective
+        return {"train_steps": self.train_steps}
+
+    def set_extra_state(self, state: Dict[str, int]) -> None:
+        self.train_steps = state["train_steps"]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from before the train steps were saved start counting anew
+        state_dict.setdefault(prefix + "_extra_state", {"train_steps": 0})
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _pack(self, responses: Dict[str, Tensor], names: List[str]) -> Tensor:
+        """Concatenate the flattened responses passed between head, core and tail."""
+        if len(names) == 1:
+            return responses[names[0]]
+        return torch.cat([responses[name].flatten(1) for name in names], dim=1)
+
+    def _unpack(self, packed: Tensor, names: List[str]) -> Dict[str, Tensor]:
+        if len(names) == 1:
+            return {names[0]: packed}
+        sizes = [int(np.prod(self._shapes[name])) for name in names]
+        return {
+            name: response.view(-1, *self._shapes[name])
+            for name, response in zip(names, packed.split(sizes, dim=1))
+        }
+
     # Methods need to be overwritten 'cause the use .encoders
     def device_for_input_tensor(self, input_tensor_name: str) -> torch.device:
         return model_device(self)
 
     def type_for_input_tensor(self, input_tensor_name: str) -> torch.dtype:
         return torch.float32
+
+
+class _AddGradients(torch.autograd.Function):
+    """Identity, which adds precomputed gradients to parameters when backpropagated through."""
+
+    @staticmethod
+    def forward(ctx, x: Tensor, grads: Dict[nn.Parameter, Tensor]) -> Tensor:
+        ctx.grads = grads
+        return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad_output: Tensor) -> Tuple[Tensor, None]:
+        with torch.no_grad():
+            for param, grad in ctx.grads.items():
+                param.grad = grad if param.grad is None else param.grad + grad
+        return grad_output, None
+
+
+def _longest_path(brain: Brain, source: str, target: str) -> List[str]:
+    """Longest path from source to target, i.e. the main pathway if there are skip connections."""
+    return max(nx.all_simple_paths(brain.connectome, source, target), key=len)
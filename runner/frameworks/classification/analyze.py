@@ -1,22 +1,28 @@
+import io
 import json
 import logging
-import shutil
-from dataclasses import asdict
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
+import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 import wandb
 from matplotlib.figure import Figure
 from omegaconf import DictConfig
+from PIL import Image
 
 from retinal_rl.analysis.plot import (
+    HistoryPlot,
     layer_receptive_field_plots,
     plot_brain_and_optimizers,
     plot_channel_statistics,
-    plot_histories,
     plot_receptive_field_sizes,
     plot_reconstructions,
     plot_transforms,
@@ -32,6 +38,7 @@ from retinal_rl.classification.imageset import Imageset
 from retinal_rl.models.brain import Brain
 from retinal_rl.models.loss import ReconstructionLoss
 from retinal_rl.models.objective import ContextT, Objective
+from runner.util import HistoryLog
 
 ### Infrastructure ###
 
@@ -40,6 +47,10 @@ logger = logging.getLogger(__name__)
 
 init_dir = "initialization_analysis"
 
+# History plots are kept across analysis calls and only extended by the epochs
+# appended to the history log since the previous call.
+_history_plots: Dict[Path, Tuple[HistoryLog, HistoryPlot]] = {}
+
 
 class NumpyEncoder(json.JSONEncoder):
     """JSON encoder that handles numpy arrays."""
@@ -50,6 +61,47 @@ class NumpyEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+@dataclass
+class FigureJob:
+    """A figure described by a plotting function and its keyword arguments.
+
+    Unless ``in_process`` is set, the job is rendered in a worker process, so
+    ``plot_fn`` must be a module level function and ``kwargs`` must be picklable.
+    """
+
+    plot_fn: Callable[..., Figure]
+    kwargs: Dict[str, Any]
+    sub_dir: str
+    file_name: str
+    copy_checkpoint: bool = False
+    in_process: bool = False
+
+
+@dataclass
+class FigureQueue:
+    """The figures of a single analysis call, and where to publish them."""
+
+    use_wandb: bool
+    plot_dir: Path
+    checkpoint_plot_dir: Path
+    epoch: int
+    jobs: List[FigureJob] = field(default_factory=list)
+
+    def add(
+        self,
+        plot_fn: Callable[..., Figure],
+        kwargs: Dict[str, Any],
+        sub_dir: str,
+        file_name: str,
+        copy_checkpoint: bool = False,
+        in_process: bool = False,
+    ) -> None:
+        """Queue a figure for rendering."""
+        self.jobs.append(
+            FigureJob(plot_fn, kwargs, sub_dir, file_name, copy_checkpoint, in_process)
+        )
+
+
 ### Analysis ###
 
 
@@ -63,7 +115,13 @@ def analyze(
     test_set: Imageset,
     epoch: int,
     copy_checkpoint: bool = False,
+    pool: Optional[ProcessPoolExecutor] = None,
 ):
+    """Compute the statistics of the brain at an epoch, and plot them.
+
+    Figures are rendered by the given pool (see figure_pool), or by a pool of
+    logging.plot_workers processes started for this call.
+    """
     ## DictConfig
 
     # Path creation
@@ -81,13 +139,16 @@ def analyze(
 
     # Variables
     use_wandb = cfg.logging.use_wandb
-    channel_analysis = cfg.logging.channel_analysis
+    channel_analysis = cfg.logging.channel_analysis and _plot_due(
+        cfg, "channel_statistics", epoch
+    )
     plot_sample_size = cfg.logging.plot_sample_size
 
+    figures = FigureQueue(use_wandb, plot_dir, checkpoint_plot_dir, epoch)
+
     ## Analysis
 
-    if not use_wandb:
-        _plot_and_save_histories(plot_dir, histories)
+    _update_history_plot(plot_dir, Path(cfg.path.history_file), histories)
 
     # Get CNN statistics and save them
     cnn_stats = cnn_statistics(
@@ -104,11 +165,10 @@ def analyze(
 
     if epoch == 0:
         _perform_initialization_analysis(
+            figures,
             channel_analysis,
             use_wandb,
             analyses_dir,
-            plot_dir,
-            checkpoint_plot_dir,
             run_dir,
             brain,
             objective,
@@ -116,47 +176,75 @@ def analyze(
             cnn_stats,
         )
 
-    _analyze_layers(
-        channel_analysis,
-        use_wandb,
-        plot_dir,
-        checkpoint_plot_dir,
-        cnn_stats,
-        epoch,
-        copy_checkpoint,
-    )
+    if _plot_due(cfg, "receptive_fields", epoch):
+        _analyze_layers(
+            figures,
+            channel_analysis,
+            cnn_stats,
+            copy_checkpoint,
+        )
 
-    _perform_reconstruction_analysis(
-        use_wandb,
-        analyses_dir,
-        plot_dir,
-        checkpoint_plot_dir,
-        device,
-        brain,
-        objective,
-        train_set,
-        test_set,
-        epoch,
-        copy_checkpoint,
-    )
+    if _plot_due(cfg, "reconstructions", epoch):
+        _perform_reconstruction_analysis(
+            figures,
+            analyses_dir,
+            device,
+            brain,
+            objective,
+            train_set,
+            test_set,
+            epoch,
+            copy_checkpoint,
+        )
 
-    hist_fig = plot_histories(histories)
-    _save_figure(plot_dir, "", "histories", hist_fig)
-    plt.close(hist_fig)
+    if pool is None:
+        with figure_pool(cfg.logging.plot_workers) as pool:
+            _render_figures(figures, analyses_dir, pool)
+    else:
+        _render_figures(figures, analyses_dir, pool)
+
+
+@contextmanager
+def figure_pool(num_workers: int) -> Iterator[Optional[ProcessPoolExecutor]]:
+    """Worker processes rendering the figures of analyze, shut down at the end.
+
+    Passing the pool to several analyze calls means that worker start-up (importing
+    torch, matplotlib, ...) is only paid once. Yields None if num_workers is 0, in
+    which case figures are rendered in the main process.
+    """
+    if num_workers <= 0:
+        yield None
+        return
+    pool = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_figure_worker,
+    )
+    try:
+        yield pool
+    finally:
+        pool.shutdown(wait=True)
 
 
-def _plot_and_save_histories(plot_dir: Path, histories: Dict[str, List[float]]):
-    hist_fig = plot_histories(histories)
+def _update_history_plot(
+    plot_dir: Path, history_file: Path, histories: Dict[str, List[float]]
+):
+    if history_file not in _history_plots:
+        # Runs from before the history log existed are seeded from the checkpoint
+        if not history_file.exists():
+            HistoryLog(history_file).rewrite(histories)
+        _history_plots[history_file] = (HistoryLog(history_file), HistoryPlot())
+
+    history_log, history_plot = _history_plots[history_file]
+    hist_fig = history_plot.update(history_log.read_new())
     _save_figure(plot_dir, "", "histories", hist_fig)
-    plt.close(hist_fig)
 
 
 def _perform_initialization_analysis(
+    figures: FigureQueue,
     channel_analysis: bool,
     use_wandb: bool,
     analyses_dir: Path,
-    plot_dir: Path,
-    checkpoint_plot_dir: Path,
     run_dir: Path,
     brain: Brain,
     objective: Objective[ContextT],
@@ -171,28 +259,20 @@ def _perform_initialization_analysis(
         wandb.save(str(filepath), base_path=run_dir, policy="now")
 
     # TODO: This is a bit of a hack, we should refactor this to get the relevant information out of  cnn_stats
-    rf_sizes_fig = plot_receptive_field_sizes(**asdict(cnn_stats))
-    _process_figure(
-        use_wandb,
-        plot_dir,
-        checkpoint_plot_dir,
-        False,
-        rf_sizes_fig,
+    figures.add(
+        plot_receptive_field_sizes,
+        asdict(cnn_stats),
         init_dir,
         "receptive_field_sizes",
-        0,
     )
 
-    graph_fig = plot_brain_and_optimizers(brain, objective)
-    _process_figure(
-        use_wandb,
-        plot_dir,
-        checkpoint_plot_dir,
-        False,
-        graph_fig,
+    # The brain graph needs the live model, so it is not shipped to a worker
+    figures.add(
+        plot_brain_and_optimizers,
+        {"brain": brain, "objective": objective},
         init_dir,
         "brain_graph",
-        0,
+        in_process=True,
     )
 
     transforms = transform_base_images(train_set, num_steps=5, num_images=2)
@@ -201,135 +281,87 @@ def _perform_initialization_analysis(
     with open(transform_path, "w") as f:
         json.dump(asdict(transforms), f, cls=NumpyEncoder)
 
-    transforms_fig = plot_transforms(**asdict(transforms))
-    _process_figure(
-        use_wandb,
-        plot_dir,
-        checkpoint_plot_dir,
-        False,
-        transforms_fig,
-        init_dir,
-        "transforms",
-        0,
-    )
+    figures.add(plot_transforms, asdict(transforms), init_dir, "transforms")
 
     _analyze_input_layer(
-        use_wandb,
-        plot_dir,
-        checkpoint_plot_dir,
+        figures,
         cnn_stats.layers["input"],
         channel_analysis,
     )
 
 
 def _analyze_layers(
+    figures: FigureQueue,
     channel_analysis: bool,
-    use_wandb: bool,
-    plot_dir: Path,
-    checkpoint_plot_dir: Path,
     cnn_stats: CNNStatistics,
-    epoch: int,
     copy_checkpoint: bool,
 ):
     for layer_name, layer_data in cnn_stats.layers.items():
         if layer_name != "input":
             _analyze_regular_layer(
-                use_wandb,
-                plot_dir,
-                checkpoint_plot_dir,
+                figures,
                 layer_name,
                 layer_data,
-                epoch,
                 copy_checkpoint,
                 channel_analysis,
             )
 
 
 def _analyze_input_layer(
-    use_wandb: bool,
-    plot_dir: Path,
-    checkpoint_plot_dir: Path,
+    figures: FigureQueue,
     layer_statistics: LayerStatistics,
     channel_analysis: bool,
 ):
-    layer_rfs = layer_receptive_field_plots(layer_statistics.receptive_fields)
-    _process_figure(
-        use_wandb,
-        plot_dir,
-        checkpoint_plot_dir,
-        False,
-        layer_rfs,
+    figures.add(
+        layer_receptive_field_plots,
+        {"lyr_rfs": layer_statistics.receptive_fields},
         init_dir,
         "input_rfs",
-        0,
     )
 
     if channel_analysis:
         layer_dict = asdict(layer_statistics)
         num_channels = int(layer_dict.pop("num_channels"))
         for channel in range(num_channels):
-            channel_fig = plot_channel_statistics(
-                **layer_dict, layer_name="input", channel=channel
-            )
-            _process_figure(
-                use_wandb,
-                plot_dir,
-                checkpoint_plot_dir,
-                False,
-                channel_fig,
+            figures.add(
+                plot_channel_statistics,
+                {**layer_dict, "layer_name": "input", "channel": channel},
                 init_dir,
                 f"input_channel_{channel}",
-                0,
             )
 
 
 def _analyze_regular_layer(
-    use_wandb: bool,
-    plot_dir: Path,
-    checkpoint_plot_dir: Path,
+    figures: FigureQueue,
     layer_name: str,
     layer_statistics: LayerStatistics,
-    epoch: int,
     copy_checkpoint: bool,
     channel_analysis: bool,
 ):
-    layer_rfs = layer_receptive_field_plots(layer_statistics.receptive_fields)
-    _process_figure(
-        use_wandb,
-        plot_dir,
-        checkpoint_plot_dir,
-        copy_checkpoint,
-        layer_rfs,
+    figures.add(
+        layer_receptive_field_plots,
+        {"lyr_rfs": layer_statistics.receptive_fields},
         "receptive_fields",
         f"{layer_name}",
-        epoch,
+        copy_checkpoint,
     )
 
     if channel_analysis:
         layer_dict = asdict(layer_statistics)
         num_channels = int(layer_dict.pop("num_channels"))
         for channel in range(num_channels):
-            channel_fig = plot_channel_statistics(
-                **layer_dict, layer_name=layer_name, channel=channel
-            )
-
-            _process_figure(
-                use_wandb,
-                plot_dir,
-                checkpoint_plot_dir,
-                copy_checkpoint,
-                channel_fig,
+            figures.add(
+                plot_channel_statistics,
+                {**layer_dict, "layer_name": layer_name, "channel": channel},
                 f"{layer_name}_layer_channel_analysis",
                 f"channel_{channel}",
-                epoch,
+                copy_checkpoint,
             )
 
 
 def _perform_reconstruction_analysis(
-    use_wandb: bool,
+    figures: FigureQueue,
     analyses_dir: Path,
-    plot_dir: Path,
-    checkpoint_plot_dir: Path,
     device: torch.device,
     brain: Brain,
     objective: Objective[ContextT],
@@ -354,28 +386,35 @@ def _perform_reconstruction_analysis(
         with open(rec_path, "w") as f:
             json.dump(rec_dict, f, cls=NumpyEncoder)
 
-        recon_fig = plot_reconstructions(
-            norm_means,
-            norm_stds,
-            *rec_dict["train"].values(),
-            *rec_dict["test"].values(),
-            num_samples=5,
-        )
-        _process_figure(
-            use_wandb,
-            plot_dir,
-            checkpoint_plot_dir,
-            copy_checkpoint,
-            recon_fig,
+        figures.add(
+            plot_reconstructions,
+            {
+                "normalization_mean": norm_means,
+                "normalization_std": norm_stds,
+                **{f"train_{key}": value for key, value in rec_dict["train"].items()},
+                **{f"test_{key}": value for key, value in rec_dict["test"].items()},
+                "num_samples": 5,
+            },
             "reconstruction",
             f"{decoder}_reconstructions",
-            epoch,
+            copy_checkpoint,
         )
 
 
 ### Helper Functions ###
 
 
+def _plot_due(cfg: DictConfig, plot_group: str, epoch: int) -> bool:
+    """Check whether a plot group is rendered at this epoch.
+
+    ``logging.plot_frequency`` maps plot groups to k, such that the group is only
+    rendered every k-th checkpoint. The initial analysis is always rendered.
+    """
+    frequency = cfg.logging.plot_frequency.get(plot_group, 1)
+    checkpoint = epoch // cfg.logging.checkpoint_step
+    return epoch == 0 or checkpoint % frequency == 0
+
+
 def _save_figure(plot_dir: Path, sub_dir: str, file_name: str, fig: Figure) -> None:
     dir = plot_dir / sub_dir
     dir.mkdir(exist_ok=True)
@@ -383,16 +422,91 @@ def _save_figure(plot_dir: Path, sub_dir: str, file_name: str, fig: Figure) -> N
     fig.savefig(file_path)
 
 
-def _checkpoint_copy(
-    plot_dir: Path, checkpoint_plot_dir: Path, sub_dir: str, file_name: str, epoch: int
+def _figure_paths(figures: FigureQueue, job: FigureJob) -> List[Path]:
+    """Create and return the local paths a figure is written to."""
+    if figures.use_wandb:
+        return []
+
+    dirs = [figures.plot_dir / job.sub_dir]
+    if job.copy_checkpoint:
+        dirs.append(
+            figures.checkpoint_plot_dir / f"epoch_{figures.epoch}" / job.sub_dir
+        )
+
+    for dir in dirs:
+        dir.mkdir(parents=True, exist_ok=True)
+    return [dir / f"{job.file_name}.png" for dir in dirs]
+
+
+def _init_figure_worker() -> None:
+    matplotlib.use("Agg")
+
+
+def _render_figure(
+    plot_fn: Callable[..., Figure],
+    kwargs: Dict[str, Any],
+    file_paths: List[Path],
+    return_png: bool,
+) -> Tuple[Optional[bytes], float]:
+    """Render a figure, write it to the given paths and return the png (if requested) and the render time."""
+    start = time.perf_counter()
+    fig = plot_fn(**kwargs)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    plt.close(fig)
+
+    png = buffer.getvalue()
+    for file_path in file_paths:
+        file_path.write_bytes(png)
+
+    return (png if return_png else None), time.perf_counter() - start
+
+
+def _render_figures(
+    figures: FigureQueue, analyses_dir: Path, pool: Optional[ProcessPoolExecutor]
 ) -> None:
-    src_path = plot_dir / sub_dir / f"{file_name}.png"
+    """Render all queued figures, publish them and save a per-figure timing report."""
+
+    pending: List[Tuple[FigureJob, Future[Tuple[Optional[bytes], float]]]] = []
+    local_jobs: List[FigureJob] = []
+    for job in figures.jobs:
+        if pool is None or job.in_process:
+            local_jobs.append(job)
+        else:
+            future = pool.submit(
+                _render_figure,
+                job.plot_fn,
+                job.kwargs,
+                _figure_paths(figures, job),
+                figures.use_wandb,
+            )
+            pending.append((job, future))
+
+    timings: Dict[str, float] = {}
 
-    dest_dir = checkpoint_plot_dir / f"epoch_{epoch}" / sub_dir
-    dest_dir.mkdir(parents=True, exist_ok=True)
-    dest_path = dest_dir / f"{file_name}.png"
+    # Local jobs are rendered while the workers are busy
+    for job in local_jobs:
+        png, seconds = _render_figure(
+            job.plot_fn, job.kwargs, _figure_paths(figures, job), figures.use_wandb
+        )
+        _publish_figure(figures, job, png)
+        timings[f"{job.sub_dir}/{job.file_name}"] = seconds
 
-    shutil.copy2(src_path, dest_path)
+    for job, future in pending:
+        png, seconds = future.result()
+        _publish_figure(figures, job, png)
+        timings[f"{job.sub_dir}/{job.file_name}"] = seconds
+
+    figures.jobs.clear()
+
+    with open(analyses_dir / f"figure_timings_epoch_{figures.epoch}.json", "w") as f:
+        json.dump(timings, f, indent=2)
+
+    slowest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:5]
+    logger.info(
+        f"Rendered {len(timings)} figures ({sum(timings.values()):.2f}s render time). Slowest: "
+        + ", ".join(f"{name} ({seconds:.2f}s)" for name, seconds in slowest)
+    )
 
 
 def _wandb_title(title: str) -> str:
@@ -412,22 +526,9 @@ def _wandb_title(title: str) -> str:
     return "/".join(capitalized_parts)
 
 
-def _process_figure(
-    use_wandb: bool,
-    plot_dir: Path,
-    checkpoint_plot_dir: Path,
-    copy_checkpoint: bool,
-    fig: Figure,
-    sub_dir: str,
-    file_name: str,
-    epoch: int,
-) -> None:
-    if use_wandb:
-        title = f"{_wandb_title(sub_dir)}/{_wandb_title(file_name)}"
-        img = wandb.Image(fig)
+def _publish_figure(figures: FigureQueue, job: FigureJob, png: Optional[bytes]) -> None:
+    """Log a rendered figure to wandb. Local figures are already written by the renderer."""
+    if figures.use_wandb and png is not None:
+        title = f"{_wandb_title(job.sub_dir)}/{_wandb_title(job.file_name)}"
+        img = wandb.Image(Image.open(io.BytesIO(png)))
         wandb.log({title: img}, commit=False)
-    else:
-        _save_figure(plot_dir, sub_dir, file_name, fig)
-        if copy_checkpoint:
-            _checkpoint_copy(plot_dir, checkpoint_plot_dir, sub_dir, file_name, epoch)
-    plt.close(fig)
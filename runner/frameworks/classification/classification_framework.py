@@ -23,6 +23,8 @@ class ClassificationFramework(TrainingFramework):
             self.cfg,
             brain,
             optimizer,
+            # Analysis doesn't need the optimizer state
+            load_optimizer=self.cfg.command != "analyze",
         )
         return brain, optimizer
 
@@ -8,14 +8,13 @@ from pathlib import Path
 from typing import Any, Dict, List, Tuple, cast
 
 import omegaconf
-import torch
 import wandb
 from hydra.core.hydra_config import HydraConfig
 from omegaconf import DictConfig
 from torch.optim.optimizer import Optimizer
 
 from retinal_rl.models.brain import Brain
-from runner.util import save_checkpoint
+from runner.util import load_checkpoint, save_checkpoint
 
 ### Infrastructure ###
 
@@ -70,8 +69,9 @@ def initialize(
     dict_cfg: DictConfig,
     brain: Brain,
     optimizer: Optimizer,
+    load_optimizer: bool = True,
 ) -> Tuple[Brain, Optimizer, Dict[str, List[float]], int]:
-    """Initialize the Brain, Optimizers, and training histories. Checks whether the experiment directory exists and loads the model and history if it does. Otherwise, initializes a new model and history."""
+    """Initialize the Brain, Optimizers, and training histories. Checks whether the experiment directory exists and loads the model and history if it does. Otherwise, initializes a new model and history. The optimizer state is only read from the checkpoint if load_optimizer is set."""
 
     cfg = InitConfig.from_dict_config(dict_cfg)
     wandb_sweep_id = getenv("WANDB_SWEEP_ID", "local")
@@ -80,7 +80,7 @@ def initialize(
 
     # If continuing from a previous run, load the model and history
     if cfg.data_dir.exists():
-        return _initialize_reload(cfg, brain, optimizer)
+        return _initialize_reload(cfg, brain, optimizer, load_optimizer)
     # else, initialize a new model and history
     logger.info(
         f"Experiment data path {cfg.data_dir} does not exist. Initializing {cfg.run_name}."
@@ -146,7 +146,7 @@ def _initialize_create(
 
 
 def _initialize_reload(
-    cfg: InitConfig, brain: Brain, optimizer: Optimizer
+    cfg: InitConfig, brain: Brain, optimizer: Optimizer, load_optimizer: bool
 ) -> Tuple[Brain, Optimizer, Dict[str, List[float]], int]:
     logger.info(
         f"Experiment data dir {cfg.data_dir} exists. Loading existing model and history."
@@ -158,10 +158,12 @@ def _initialize_reload(
         logger.error(f"File not found: {checkpoint_file}")
         raise FileNotFoundError("Checkpoint file does not exist.")
 
-    # Load the state dict into the brain model
-    checkpoint = torch.load(checkpoint_file)
+    # Load the state dict into the brain model. The checkpoint is memory-mapped and
+    # copied straight into the parameters, the optimizer state is only read if needed.
+    checkpoint = load_checkpoint(checkpoint_file)
     brain.load_state_dict(checkpoint["brain_state_dict"])
-    optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+    if load_optimizer:
+        optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
     completed_epochs = checkpoint["completed_epochs"]
     history = checkpoint["histories"]
     entity = cfg.wandb_entity
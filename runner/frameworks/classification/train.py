@@ -2,8 +2,9 @@
 
 import logging
 import time
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Dict, List
+from typing import ContextManager, Dict, List, Optional
 
 import torch
 import wandb
@@ -13,11 +14,17 @@ from torch.utils.data import DataLoader
 
 from retinal_rl.classification.imageset import Imageset
 from retinal_rl.classification.loss import ClassificationContext
-from retinal_rl.classification.training import process_dataset, run_epoch
+from retinal_rl.classification.training import (
+    MixedPrecision,
+    find_max_micro_batch_size,
+    process_dataset,
+    run_epoch,
+)
 from retinal_rl.models.brain import Brain
 from retinal_rl.models.objective import Objective
-from runner.frameworks.classification.analyze import analyze
-from runner.util import save_checkpoint
+from retinal_rl.models.profiling import CircuitProfiler
+from runner.frameworks.classification.analyze import analyze, figure_pool
+from runner.util import CheckpointWriter, HistoryLog
 
 # Initialize the logger
 logger = logging.getLogger(__name__)
@@ -53,122 +60,193 @@ def train(
 
     data_dir = Path(cfg.path.data_dir)
     checkpoint_dir = Path(cfg.path.checkpoint_dir)
+    history_log = HistoryLog(Path(cfg.path.history_file))
 
     max_checkpoints = cfg.logging.max_checkpoints
     checkpoint_step = cfg.logging.checkpoint_step
 
     num_epochs = cfg.optimizer.num_epochs
     num_workers = cfg.system.num_workers
+    precision = MixedPrecision(device, cfg.system.precision)
+
+    batch_size = cfg.optimizer.get("batch_size", 64)
+    accumulation_steps = cfg.optimizer.get("accumulation_steps", 1)
 
     trainloader = DataLoader(
-        train_set, batch_size=64, shuffle=True, num_workers=num_workers
+        train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers
     )
     testloader = DataLoader(
-        test_set, batch_size=64, shuffle=False, num_workers=num_workers
+        test_set, batch_size=batch_size, shuffle=False, num_workers=num_workers
     )
 
-    wall_time = time.time()
-
-    if initial_epoch == 0:
-        brain.train()
-        train_losses = process_dataset(
-            device,
-            brain,
-            objective,
-            optimizer,
-            initial_epoch,
-            trainloader,
-            is_training=False,
-        )
-        brain.eval()
-        test_losses = process_dataset(
-            device,
-            brain,
-            objective,
-            optimizer,
-            initial_epoch,
-            testloader,
-            is_training=False,
-        )
-
-        # Initialize the history
-        logger.info("Epoch 0 training performance:")
-        for key, value in train_losses.items():
-            logger.info(f"{key}: {value:.4f}")
-            history[f"train_{key}"] = [value]
-        for key, value in test_losses.items():
-            history[f"test_{key}"] = [value]
-
-        analyze(
-            cfg,
-            device,
-            brain,
-            objective,
-            history,
-            train_set,
-            test_set,
-            initial_epoch,
-            True,
-        )
-
-        new_wall_time = time.time()
-        epoch_wall_time = new_wall_time - wall_time
-        wall_time = new_wall_time
-        logger.info(f"Initialization complete. Wall Time: {epoch_wall_time:.2f}s.")
-
-        if use_wandb:
-            _wandb_log_statistics(initial_epoch, epoch_wall_time, history)
-
-    else:
-        logger.info(
-            f"Reloading complete. Resuming training from epoch {initial_epoch}."
-        )
-
-    for epoch in range(initial_epoch + 1, num_epochs + 1):
-        brain, history = run_epoch(
+    micro_batch_size = cfg.system.micro_batch_size
+    if micro_batch_size == "auto":
+        micro_batch_size = find_max_micro_batch_size(
             device,
             brain,
             objective,
-            optimizer,
-            history,
-            epoch,
-            trainloader,
-            testloader,
+            next(iter(trainloader)),
+            initial_epoch + 1,
+            precision,
+            data_dir / "micro_batch_size.json",
         )
+        logger.info(f"Using micro-batches of size {micro_batch_size}.")
 
-        new_wall_time = time.time()
-        epoch_wall_time = new_wall_time - wall_time
-        wall_time = new_wall_time
-        logger.info(f"Epoch {epoch} complete. Wall Time: {epoch_wall_time:.2f}s.")
+    profiler = (
+        brain.enable_profiling(cfg.logging.profile_trace)
+        if cfg.logging.profile
+        else None
+    )
 
-        if epoch % checkpoint_step == 0:
-            logger.info("Saving checkpoint and plots.")
+    # The figures of all analyses are rendered by the same worker processes, and the
+    # pending checkpoint is finished when training ends (or fails)
+    checkpoint_writer = CheckpointWriter(data_dir, checkpoint_dir, max_checkpoints)
+    with checkpoint_writer, figure_pool(cfg.logging.plot_workers) as pool:
+        wall_time = time.time()
 
-            save_checkpoint(
-                data_dir,
-                checkpoint_dir,
-                max_checkpoints,
+        if initial_epoch == 0:
+            brain.train()
+            train_losses = process_dataset(
+                device,
                 brain,
+                objective,
                 optimizer,
-                history,
-                epoch,
+                initial_epoch,
+                trainloader,
+                is_training=False,
+                precision=precision,
+                micro_batch_size=micro_batch_size,
+            )
+            brain.eval()
+            test_losses = process_dataset(
+                device,
+                brain,
+                objective,
+                optimizer,
+                initial_epoch,
+                testloader,
+                is_training=False,
+                precision=precision,
+                micro_batch_size=micro_batch_size,
+            )
+
+            # Initialize the history
+            logger.info("Epoch 0 training performance:")
+            for key, value in train_losses.items():
+                logger.info(f"{key}: {value:.4f}")
+                history[f"train_{key}"] = [value]
+            for key, value in test_losses.items():
+                history[f"test_{key}"] = [value]
+            _record_profile(profiler, history)
+            history_log.rewrite(history)
+
+            with _profile_paused(profiler):
+                analyze(
+                    cfg,
+                    device,
+                    brain,
+                    objective,
+                    history,
+                    train_set,
+                    test_set,
+                    initial_epoch,
+                    True,
+                    pool,
+                )
+
+            new_wall_time = time.time()
+            epoch_wall_time = new_wall_time - wall_time
+            wall_time = new_wall_time
+            logger.info(f"Initialization complete. Wall Time: {epoch_wall_time:.2f}s.")
+
+            if use_wandb:
+                _wandb_log_statistics(initial_epoch, epoch_wall_time, history)
+
+        else:
+            # Drop epochs that were logged after the checkpoint we resume from
+            history_log.rewrite(history)
+            logger.info(
+                f"Reloading complete. Resuming training from epoch {initial_epoch}."
             )
 
-            analyze(
-                cfg,
+        for epoch in range(initial_epoch + 1, num_epochs + 1):
+            _reset_profile(profiler)
+
+            brain, history = run_epoch(
                 device,
                 brain,
                 objective,
+                optimizer,
                 history,
-                train_set,
-                test_set,
                 epoch,
-                True,
+                trainloader,
+                testloader,
+                precision,
+                micro_batch_size,
+                accumulation_steps,
             )
-            logger.info("Analysis complete.")
+            _record_profile(profiler, history)
+            history_log.append(epoch, history)
+
+            new_wall_time = time.time()
+            epoch_wall_time = new_wall_time - wall_time
+            wall_time = new_wall_time
+            logger.info(f"Epoch {epoch} complete. Wall Time: {epoch_wall_time:.2f}s.")
+
+            if epoch % checkpoint_step == 0:
+                logger.info("Saving checkpoint and plots.")
+
+                # The checkpoint is written in the background while we analyze
+                checkpoint_writer.save(brain, optimizer, history, epoch)
+
+                _export_profile_trace(profiler, data_dir / "analyses", epoch)
 
-        if use_wandb:
-            _wandb_log_statistics(epoch, epoch_wall_time, history)
+                with _profile_paused(profiler):
+                    analyze(
+                        cfg,
+                        device,
+                        brain,
+                        objective,
+                        history,
+                        train_set,
+                        test_set,
+                        epoch,
+                        True,
+                        pool,
+                    )
+                logger.info("Analysis complete.")
+
+            if use_wandb:
+                _wandb_log_statistics(epoch, epoch_wall_time, history)
+
+    brain.disable_profiling()
+
+
+def _profile_paused(profiler: Optional[CircuitProfiler]) -> ContextManager[None]:
+    """Only profile training and evaluation, not the analyses."""
+    return nullcontext() if profiler is None else profiler.paused()
+
+
+def _reset_profile(profiler: Optional[CircuitProfiler]) -> None:
+    if profiler is not None:
+        profiler.reset()
+
+
+def _record_profile(
+    profiler: Optional[CircuitProfiler], history: Dict[str, List[float]]
+) -> None:
+    """Append the profile statistics of the last epoch to the history."""
+    if profiler is not None:
+        for key, value in profiler.summary().items():
+            history.setdefault(key, []).append(value)
+
+
+def _export_profile_trace(
+    profiler: Optional[CircuitProfiler], trace_dir: Path, epoch: int
+) -> None:
+    if profiler is not None and profiler.trace:
+        trace_dir.mkdir(exist_ok=True)
+        profiler.export_chrome_trace(trace_dir / f"profile_trace_epoch_{epoch}.json")
 
 
 def _wandb_log_statistics(
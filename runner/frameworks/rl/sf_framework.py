@@ -3,7 +3,8 @@ import json
 import os
 import warnings
 from argparse import Namespace
-from typing import Any, Dict, Optional
+from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 # from retinal_rl.rl.sample_factory.observer import RetinalAlgoObserver
 import torch
@@ -23,8 +24,14 @@ from sample_factory.utils.attr_dict import AttrDict
 from sample_factory.utils.typing import Config
 
 from retinal_rl.models.brain import Brain
+from retinal_rl.models.circuits.latent_core import LatentRNN
 from retinal_rl.models.loss import ContextT
 from retinal_rl.models.objective import Objective
+from retinal_rl.rl.analysis.simulation import (
+    EnvPool,
+    generate_simulation,
+    get_brain_env,
+)
 from retinal_rl.rl.sample_factory.arguments import (
     add_retinal_env_args,
     add_retinal_env_eval_args,
@@ -33,7 +40,7 @@ from retinal_rl.rl.sample_factory.arguments import (
 from retinal_rl.rl.sample_factory.environment import register_retinal_env
 from retinal_rl.rl.sample_factory.models import SampleFactoryBrain
 from runner.frameworks.framework_interface import TrainingFramework
-from runner.util import create_brain
+from runner.util import create_brain, load_checkpoint
 
 
 class SFFramework(TrainingFramework):
@@ -48,6 +55,9 @@ class SFFramework(TrainingFramework):
         register_retinal_env(self.sf_cfg.env, self.data_root, self.sf_cfg.input_satiety)
         global_model_factory().register_actor_critic_factory(SampleFactoryBrain)
 
+        # Environments stay alive between the simulations of several checkpoints
+        self.env_pool = EnvPool()
+
     def initialize(self, brain: Brain, optimizer: torch.optim.Optimizer):
         # brain = SFFramework.load_brain_from_checkpoint(...)
         # TODO: Implement load brain and optimizer state
@@ -61,10 +71,7 @@ class SFFramework(TrainingFramework):
         objective: Optional[Objective[ContextT]] = None,
     ):
         warnings.warn(
-            "device, brain, optimizer are initialized differently in sample_factory and thus their current state will be ignored"
-        )
-        warnings.warn(
-            "objective is currently not supported for sample factory simulations"
+            "device, brain, optimizer and objective are initialized differently in sample_factory and thus their current state will be ignored"
         )
         # Run simulation
         if not (self.sf_cfg.dry_run):
@@ -85,15 +92,9 @@ class SFFramework(TrainingFramework):
             config = Namespace(**json.load(f))
         checkpoint_dict, config = SFFramework.get_checkpoint(config)
         config = DictConfig(config)
-        model_dict: Dict[str, Any] = checkpoint_dict["model"]
-        brain_dict: Dict[str, Any] = {}
-        for key in model_dict:
-            if "brain" in key:
-                brain_dict[key[6:]] = model_dict[key]
-        brain = create_brain(config.brain)
+        brain = create_brain(config.brain).to(device)
         if load_weights:
-            brain.load_state_dict(brain_dict)
-        brain.to(device)
+            brain.load_state_dict(_brain_state_dict(checkpoint_dict["model"]))
         return brain
 
     @staticmethod
@@ -102,15 +103,11 @@ class SFFramework(TrainingFramework):
     ) -> Brain:
         with open(os.path.join(config_path, "config.json")) as f:
             config = DictConfig(json.load(f))
-        checkpoint_dict = torch.load(weights_path)
-        model_dict = checkpoint_dict["model"]
-        brain_dict = {}
-        for key in model_dict:
-            if "brain" in key:
-                brain_dict[key[6:]] = model_dict[key]
-        brain = create_brain(config.brain)
-        brain.load_state_dict(brain_dict)
-        brain.to(device)
+        # Only the model weights are read from the memory-mapped checkpoint, and
+        # they are copied straight into the brain on its target device
+        checkpoint_dict = load_checkpoint(weights_path, keys=["model"])
+        brain = create_brain(config.brain).to(device)
+        brain.load_state_dict(_brain_state_dict(checkpoint_dict["model"]))
         return brain
 
     @staticmethod
@@ -139,9 +136,33 @@ class SFFramework(TrainingFramework):
         SFFramework._set_cfg_cli_argument(
             sf_cfg, "brain", OmegaConf.to_object(cfg.brain)
         )
+        # The rnn states sample factory keeps for every agent are the states of the
+        # recurrent circuit of the brain, if there is one
+        rnn = SFFramework._recurrent_circuit(cfg.brain)
+        SFFramework._set_cfg_cli_argument(sf_cfg, "use_rnn", rnn is not None)
+        if rnn is not None:
+            SFFramework._set_cfg_cli_argument(sf_cfg, "rnn_type", "gru")
+            SFFramework._set_cfg_cli_argument(sf_cfg, "rnn_size", rnn.rnn_size)
+            SFFramework._set_cfg_cli_argument(
+                sf_cfg, "rnn_num_layers", rnn.get("rnn_num_layers", 1)
+            )
+        # The learner evaluates the losses of the objective on its minibatches, in
+        # addition to the PPO loss (see SampleFactoryBrain)
+        objective = cfg.optimizer.get("objective")
+        SFFramework._set_cfg_cli_argument(
+            sf_cfg,
+            "objective",
+            None if objective is None else OmegaConf.to_object(objective),
+        )
         SFFramework._set_cfg_cli_argument(
             sf_cfg, "train_dir", os.path.join(cfg.path.run_dir, "train_dir")
         )
+        SFFramework._set_cfg_cli_argument(
+            sf_cfg, "simulate", cfg.logging.get("simulate", False)
+        )
+        SFFramework._set_cfg_cli_argument(
+            sf_cfg, "profile", cfg.logging.get("profile", False)
+        )
         SFFramework._set_cfg_cli_argument(sf_cfg, "with_wandb", cfg.logging.use_wandb)
         SFFramework._set_cfg_cli_argument(sf_cfg, "wandb_dir", cfg.path.wandb_dir)
         return sf_cfg
@@ -152,11 +173,46 @@ class SFFramework(TrainingFramework):
         brain: Brain,
         objective: Optional[Objective[ContextT]] = None,
     ):
+        """Evaluate the trained policy.
+
+        By default this runs sample factory's enjoy on the latest checkpoint. With
+        logging.simulate, a simulation of every kept checkpoint is recorded to the
+        simulations directory of the experiment instead. The environments are
+        checked out from the env pool of the framework, so they are only started
+        once for all checkpoints.
+        """
         warnings.warn(
             "device, brain, optimizer are initialized differently in sample_factory and thus their current state will be ignored"
         )
-        enjoy(self.sf_cfg)
-        # TODO: Implement analyze function for sf framework
+        if not self.sf_cfg.simulate:
+            enjoy(self.sf_cfg)
+            return
+
+        cfg = load_from_checkpoint(self.sf_cfg)
+        for checkpoint_file in SFFramework.get_checkpoint_files(cfg):
+            checkpoint_dict = load_checkpoint(checkpoint_file)
+            actor_critic, envs, cfg, env_steps = get_brain_env(
+                cfg, checkpoint_dict, env_pool=self.env_pool
+            )
+            try:
+                generate_simulation(
+                    cfg,
+                    actor_critic,
+                    envs,
+                    Path(cfg.train_dir, cfg.experiment, "simulations", str(env_steps)),
+                    prgrs=True,
+                    video=cfg.save_video,
+                )
+            finally:
+                self.env_pool.checkin(envs)
+
+    @staticmethod
+    def _recurrent_circuit(brain_cfg: DictConfig) -> Optional[DictConfig]:
+        """Return the config of the (LatentRNN) recurrent circuit of a brain, if any."""
+        for circuit in brain_cfg.circuits.values():
+            if circuit._target_.split(".")[-1] == LatentRNN.__name__:
+                return circuit
+        return None
 
     @staticmethod
     def _set_cfg_cli_argument(cfg: Namespace, name: str, value: Any):
@@ -187,22 +243,34 @@ class SFFramework(TrainingFramework):
     @staticmethod
     def get_checkpoint(cfg: Config) -> tuple[Dict[str, Any], AttrDict]:
         """
-        Load the model from checkpoint, initialize the environment, and return both.
+        Load the latest checkpoint and its config. The checkpoint is memory-mapped,
+        so tensors are only read from disk once they are used.
         """
         # verbose = False
 
         cfg = load_from_checkpoint(cfg)
+        checkpoint_dict = load_checkpoint(SFFramework.get_checkpoint_files(cfg)[-1])
 
-        device = torch.device("cpu" if cfg.device == "cpu" else "cuda")
+        return checkpoint_dict, cfg
 
+    @staticmethod
+    def get_checkpoint_files(cfg: Config) -> List[str]:
+        """Return the kept checkpoint files of the policy, from oldest to latest."""
         policy_id = cfg.policy_index
         name_prefix = dict(latest="checkpoint", best="best")[cfg.load_checkpoint_kind]
         checkpoints = Learner.get_checkpoints(
             Learner.checkpoint_dir(cfg, policy_id), f"{name_prefix}_*"
         )
-        checkpoint_dict: Dict[str, Any] = Learner.load_checkpoint(checkpoints, device)
+        if not checkpoints:
+            raise FileNotFoundError(
+                f"No {name_prefix} checkpoint found for policy {policy_id}"
+            )
+        return checkpoints
 
-        return checkpoint_dict, cfg
+
+def _brain_state_dict(model_dict: Dict[str, Any]) -> Dict[str, Any]:
+    """Extract the Brain state dict from the state dict of a SampleFactoryBrain."""
+    return {key[6:]: value for key, value in model_dict.items() if "brain" in key}
 
 
 def brain_from_actor_critic(actor_critic: SampleFactoryBrain) -> Brain:
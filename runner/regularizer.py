@@ -1,8 +1,10 @@
 from typing import Callable
 
 import torch
+from typing_extensions import deprecated
 
 
+@deprecated("Use retinal_rl.models.loss.ActivationRegularization")
 class OutputNormHook:
     def __init__(self, norm: Callable[[torch.Tensor], torch.Tensor]):
         """Hook to capture module outputs. Sums them up according to the specified norm"""
@@ -29,6 +31,7 @@ def l2reg(x: torch.Tensor):
     return torch.pow(x, 2).sum()
 
 
+@deprecated("Use retinal_rl.models.loss.ActivationRegularization")
 class ActivationRegularization:
     def __init__(
         self,
@@ -65,6 +68,7 @@ class ActivationRegularization:
         return penalty
 
 
+@deprecated("Use retinal_rl.models.loss.WeightRegularization")
 class WeightRegularization:
     def __init__(
         self,
@@ -2,11 +2,28 @@
 
 ### Imports ###
 
+import fcntl
+import hashlib
+import json
 import logging
 import os
 import shutil
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, List, Tuple, cast
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
 
 import networkx as nx
 import torch
@@ -25,6 +42,219 @@ nx.DiGraph.__class_getitem__ = classmethod(lambda _, __: "nx.DiGraph")  # type:
 log = logging.getLogger(__name__)
 
 
+# Prefix of the circuit parameters in a Brain state dict
+_CIRCUIT_PREFIX = "_module_dict."
+# Lock file in the shard directory, see _shard_lock
+_LOCK_FILE = ".lock"
+
+
+class CheckpointWriter:
+    """Writes checkpoints in a background thread.
+
+    The state dicts are snapshotted to CPU before ``save`` returns, so training can
+    continue while the snapshot is serialised. Each circuit of the brain is stored
+    as a separate shard in ``checkpoint_dir/shards``, named by the hash of its
+    contents, and the ``epoch_*.pt`` files are manifests referencing those shards
+    (next to the optimizer state and histories). Circuits that didn't change since
+    a previous checkpoint, e.g. frozen ones, are therefore not written again.
+
+    Files are written to a temporary name and renamed into place, and
+    ``current_checkpoint.pt`` is published as a hardlink to the epoch manifest
+    rather than a copy. The epochs and shards on disk are scanned once and tracked
+    afterwards, so pruning doesn't re-list the directory; shards no longer
+    referenced by a kept epoch are deleted. At most one write is in flight;
+    ``save`` waits for the previous one.
+
+    The checkpoint files only contain the references to the shards, so they have
+    to be read with ``load_checkpoint`` (a plain ``torch.load`` doesn't return the
+    weights). Shards are referenced relative to the checkpoint files, so runs can
+    be loaded from any working directory and moved. With ``flat``, the weights are
+    embedded in the checkpoint files instead, e.g. for external tools reading them
+    with ``torch.load``.
+
+    Shards left behind by interrupted writes are removed on ``close``, unless
+    another writer is writing to the same shard directory at that time. Used as a
+    context manager, the writer is closed when the with block is left.
+    """
+
+    def __init__(
+        self,
+        data_dir: Path,
+        checkpoint_dir: Path,
+        max_checkpoints: int,
+        flat: bool = False,
+    ):
+        self.data_dir = data_dir
+        self.checkpoint_dir = checkpoint_dir
+        self.shard_dir = checkpoint_dir / "shards"
+        self.max_checkpoints = max_checkpoints
+        self.flat = flat
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: Optional[Future[None]] = None
+
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self._epochs: Deque[int] = deque(
+            sorted(
+                _checkpoint_epoch(f)
+                for f in os.listdir(checkpoint_dir)
+                if f.startswith("epoch_") and f.endswith(".pt")
+            )
+        )
+        self._epoch_shards: Dict[int, List[str]] = {
+            epoch: list(
+                load_checkpoint(self._epoch_file(epoch), resolve_shards=False)
+                .get("brain_shards", {})
+                .values()
+            )
+            for epoch in self._epochs
+        }
+        self._shard_refs: Dict[str, int] = {}
+        for digests in self._epoch_shards.values():
+            for digest in digests:
+                self._shard_refs[digest] = self._shard_refs.get(digest, 0) + 1
+
+    def save(
+        self,
+        brain: nn.Module,
+        optimizer: Optimizer,
+        histories: dict[str, List[float]],
+        completed_epochs: int,
+    ) -> None:
+        """Snapshot the model and optimizer state and write it in the background."""
+        checkpoint_dict: Dict[str, Any] = {
+            "completed_epochs": completed_epochs,
+            "brain_state_dict": _snapshot(brain.state_dict()),
+            "optimizer_state_dict": _snapshot(optimizer.state_dict()),
+            "histories": {key: list(values) for key, values in histories.items()},
+        }
+        self.wait()
+        self._pending = self._executor.submit(
+            self._write, checkpoint_dict, completed_epochs
+        )
+
+    def wait(self) -> None:
+        """Block until the pending write is done, re-raising its errors."""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            pending.result()
+
+    def close(self) -> None:
+        """Finish the pending write, stop the writer thread and remove orphaned shards."""
+        self.wait()
+        self._executor.shutdown()
+        self._remove_orphans()
+
+    def __enter__(self) -> "CheckpointWriter":
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def _remove_orphans(self) -> None:
+        """Delete the shards no checkpoint on disk references, e.g. of interrupted writes.
+
+        Writes hold a shared lock on the shard directory, so this is skipped while
+        any writer (e.g. of another process) is in the middle of a write.
+        """
+        with _shard_lock(self.shard_dir, exclusive=True) as locked:
+            if not locked:
+                return
+            manifests = [self.data_dir / "current_checkpoint.pt"] + [
+                self.checkpoint_dir / f
+                for f in os.listdir(self.checkpoint_dir)
+                if f.startswith("epoch_") and f.endswith(".pt")
+            ]
+            referenced = set()
+            for manifest in manifests:
+                if manifest.exists():
+                    checkpoint = load_checkpoint(manifest, resolve_shards=False)
+                    referenced.update(checkpoint.get("brain_shards", {}).values())
+            for f in os.listdir(self.shard_dir):
+                if f == _LOCK_FILE:
+                    continue
+                if not f.endswith(".pt") or f.split(".")[0] not in referenced:
+                    (self.shard_dir / f).unlink(missing_ok=True)
+
+    def _epoch_file(self, epoch: int) -> Path:
+        return self.checkpoint_dir / f"epoch_{epoch}.pt"
+
+    def _write(self, checkpoint_dict: Dict[str, Any], completed_epochs: int) -> None:
+        with _shard_lock(self.shard_dir, exclusive=False):
+            self._write_locked(checkpoint_dict, completed_epochs)
+
+    def _write_locked(
+        self, checkpoint_dict: Dict[str, Any], completed_epochs: int
+    ) -> None:
+        checkpoint_file = self._epoch_file(completed_epochs)
+        current_file = self.data_dir / "current_checkpoint.pt"
+
+        # Unless flat, the circuits are written to shards the manifest references
+        if not self.flat:
+            checkpoint_dict.update(self._write_shards(checkpoint_dict))
+        brain_shards: Dict[str, str] = checkpoint_dict.get("brain_shards", {})
+
+        # Save the manifest
+        _atomic_save(checkpoint_dict, checkpoint_file)
+        # Reference the new shards before releasing those of an overwritten epoch
+        for digest in brain_shards.values():
+            self._shard_refs[digest] = self._shard_refs.get(digest, 0) + 1
+        self._release_shards(completed_epochs)
+        self._epoch_shards[completed_epochs] = list(brain_shards.values())
+
+        # Publish the checkpoint as current_checkpoint.pt
+        tmp_current = current_file.with_suffix(".pt.tmp")
+        tmp_current.unlink(missing_ok=True)
+        try:
+            os.link(checkpoint_file, tmp_current)
+        except OSError:
+            # e.g. data and checkpoint dir on different file systems
+            shutil.copyfile(checkpoint_file, tmp_current)
+        os.replace(tmp_current, current_file)
+
+        # Remove older checkpoints if the number exceeds the threshold
+        if completed_epochs not in self._epochs:
+            self._epochs.append(completed_epochs)
+        # The latest epoch is always kept, current_checkpoint.pt refers to its shards
+        while len(self._epochs) > max(self.max_checkpoints, 1):
+            oldest = self._epochs.popleft()
+            self._epoch_file(oldest).unlink(missing_ok=True)
+            self._release_shards(oldest)
+
+    def _write_shards(self, checkpoint_dict: Dict[str, Any]) -> Dict[str, Any]:
+        """Write the shards of circuits that aren't on disk yet.
+
+        Returns the entries of the manifest that replace the brain state dict.
+        """
+        brain_state_dict = checkpoint_dict["brain_state_dict"]
+        circuit_dicts, rest = _split_circuits(brain_state_dict)
+        brain_shards: Dict[str, str] = {}
+        for circuit, state_dict in circuit_dicts.items():
+            digest = _shard_hash(state_dict)
+            shard_file = self.shard_dir / f"{digest}.pt"
+            if digest not in self._shard_refs and not shard_file.exists():
+                _atomic_save(state_dict, shard_file)
+            brain_shards[circuit] = digest
+
+        return {
+            "brain_state_dict": rest,
+            "brain_metadata": getattr(brain_state_dict, "_metadata", None),
+            "brain_shards": brain_shards,
+            # The manifest is published both as epoch file and current_checkpoint.pt
+            "shard_dir": [
+                os.path.relpath(self.shard_dir, self.checkpoint_dir),
+                os.path.relpath(self.shard_dir, self.data_dir),
+            ],
+        }
+
+    def _release_shards(self, epoch: int) -> None:
+        """Drop the shard references of an epoch, deleting unreferenced shards."""
+        for digest in self._epoch_shards.pop(epoch, []):
+            self._shard_refs[digest] -= 1
+            if self._shard_refs[digest] == 0:
+                del self._shard_refs[digest]
+                (self.shard_dir / f"{digest}.pt").unlink(missing_ok=True)
+
+
 def save_checkpoint(
     data_dir: Path,
     checkpoint_dir: Path,
@@ -33,31 +263,249 @@ def save_checkpoint(
     optimizer: Optimizer,
     histories: dict[str, List[float]],
     completed_epochs: int,
+    writer: Optional[CheckpointWriter] = None,
+    flat: bool = False,
 ) -> None:
-    """Save a checkpoint of the model and optimizer state."""
-    current_file = data_dir / "current_checkpoint.pt"
-    checkpoint_file = checkpoint_dir / f"epoch_{completed_epochs}.pt"
-    checkpoint_dict: Dict[str, Any] = {
-        "completed_epochs": completed_epochs,
-        "brain_state_dict": brain.state_dict(),
-        "optimizer_state_dict": optimizer.state_dict(),
-        "histories": histories,
+    """Save a checkpoint of the model and optimizer state, blocking until it is written.
+
+    Without a writer, a writer for the directories (and flat, see CheckpointWriter)
+    is created for this checkpoint, which scans the checkpoints on disk. To save
+    several checkpoints, pass the same writer (of the same directories) instead.
+    """
+    if writer is not None:
+        writer.save(brain, optimizer, histories, completed_epochs)
+        writer.wait()
+        return
+    with CheckpointWriter(data_dir, checkpoint_dir, max_checkpoints, flat) as writer:
+        writer.save(brain, optimizer, histories, completed_epochs)
+
+
+def load_checkpoint(
+    checkpoint_file: Path | str,
+    device: Optional[torch.device] = None,
+    keys: Optional[List[str]] = None,
+    circuits: Optional[List[str]] = None,
+    shard_dir: Optional[Path] = None,
+    resolve_shards: bool = True,
+) -> Dict[str, Any]:
+    """Load (parts of) a checkpoint with memory-mapped tensors.
+
+    This is the entry point for reading checkpoints: the checkpoints written by
+    CheckpointWriter only reference the weights of the circuits (unless written
+    flat), so a plain ``torch.load`` doesn't return them. Tensors are only read from disk when they are used, so e.g. loading the brain
+    weights doesn't read the optimizer state. ``keys`` selects top-level entries of
+    the checkpoint and ``circuits`` restricts ``brain_state_dict`` to the given
+    circuits. If a device is given, the selected tensors are copied straight from
+    the mapped file to it.
+
+    For sharded checkpoints written by CheckpointWriter, ``brain_state_dict`` is
+    reassembled from the circuit shards, which are looked up in the shard
+    directory recorded in the checkpoint (relative to the checkpoint file) unless
+    ``shard_dir`` is given.
+    """
+    checkpoint: Dict[str, Any] = torch.load(
+        checkpoint_file, map_location="cpu", mmap=True
+    )
+    if resolve_shards and "brain_shards" in checkpoint:
+        _resolve_shards(checkpoint, Path(checkpoint_file), circuits, shard_dir)
+
+    if keys is not None:
+        checkpoint = {key: checkpoint[key] for key in keys}
+    if circuits is not None and "brain_state_dict" in checkpoint:
+        checkpoint["brain_state_dict"] = circuit_state_dict(
+            checkpoint["brain_state_dict"], circuits
+        )
+    if device is not None:
+        checkpoint = _map_tensors(checkpoint, lambda tensor: tensor.to(device))
+    return checkpoint
+
+
+def _resolve_shards(
+    checkpoint: Dict[str, Any],
+    checkpoint_file: Path,
+    circuits: Optional[List[str]],
+    shard_dir: Optional[Path],
+) -> None:
+    """Reassemble the brain_state_dict of a sharded checkpoint in place."""
+    recorded = checkpoint.pop("shard_dir")
+    if shard_dir is None:
+        shard_dir = _resolve_shard_dir(checkpoint_file.parent, recorded)
+    brain_shards: Dict[str, str] = checkpoint.pop("brain_shards")
+    metadata = checkpoint.pop("brain_metadata")
+    brain_state_dict = OrderedDict(checkpoint["brain_state_dict"])
+    for circuit, digest in brain_shards.items():
+        if circuits is not None and circuit not in circuits:
+            continue
+        shard_file = shard_dir / f"{digest}.pt"
+        if not shard_file.exists():
+            raise FileNotFoundError(
+                f"The weights of circuit {circuit} of {checkpoint_file} are "
+                f"missing, there is no shard {shard_file}"
+            )
+        shard = torch.load(shard_file, map_location="cpu", mmap=True)
+        for key, value in shard.items():
+            brain_state_dict[f"{_CIRCUIT_PREFIX}{circuit}.{key}"] = value
+    if metadata is not None:
+        brain_state_dict._metadata = metadata  # type: ignore
+    checkpoint["brain_state_dict"] = brain_state_dict
+
+
+def _resolve_shard_dir(checkpoint_dir: Path, recorded: Union[str, List[str]]) -> Path:
+    """Find the shard directory among the paths recorded relative to a checkpoint file."""
+    candidates = [recorded] if isinstance(recorded, str) else recorded
+    for candidate in candidates:
+        # Absolute paths (of older checkpoints) are kept as they are
+        path = checkpoint_dir / candidate
+        if path.is_dir():
+            return path
+    raise FileNotFoundError(
+        f"No shard directory {candidates} next to the checkpoint in {checkpoint_dir}"
+    )
+
+
+@contextmanager
+def _shard_lock(shard_dir: Path, exclusive: bool) -> Iterator[bool]:
+    """Hold a shared (blocking) or exclusive (non-blocking) lock on a shard directory.
+
+    Yields whether the lock was acquired.
+    """
+    with open(shard_dir / _LOCK_FILE, "a") as f:
+        if exclusive:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+        else:
+            fcntl.flock(f, fcntl.LOCK_SH)
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def circuit_state_dict(
+    brain_state_dict: Dict[str, torch.Tensor], circuits: List[str]
+) -> Dict[str, torch.Tensor]:
+    """Restrict a Brain state dict to the parameters and buffers of the given circuits."""
+    circuit_dicts, _ = _split_circuits(brain_state_dict)
+    return {
+        f"{_CIRCUIT_PREFIX}{circuit}.{key}": value
+        for circuit in circuits
+        for key, value in circuit_dicts.get(circuit, {}).items()
     }
 
-    # Save checkpoint
-    torch.save(checkpoint_dict, checkpoint_file)
 
-    # Copy the checkpoint to current_brain.pt
-    shutil.copyfile(checkpoint_file, current_file)
+def _split_circuits(
+    brain_state_dict: Dict[str, torch.Tensor],
+) -> Tuple[Dict[str, Dict[str, torch.Tensor]], Dict[str, torch.Tensor]]:
+    """Split a Brain state dict into per-circuit state dicts (with keys relative to the circuit) and the remaining entries."""
+    circuit_dicts: Dict[str, Dict[str, torch.Tensor]] = {}
+    rest: Dict[str, torch.Tensor] = {}
+    for key, value in brain_state_dict.items():
+        if key.startswith(_CIRCUIT_PREFIX):
+            circuit, circuit_key = key[len(_CIRCUIT_PREFIX) :].split(".", 1)
+            circuit_dicts.setdefault(circuit, {})[circuit_key] = value
+        else:
+            rest[key] = value
+    return circuit_dicts, rest
 
-    # Remove older checkpoints if the number exceeds the threshold
-    checkpoints = sorted(
-        [f for f in os.listdir(checkpoint_dir) if f.startswith("epoch_")],
-        key=lambda x: int(x.split("_")[1].split(".")[0]),
-        reverse=True,
-    )
-    while len(checkpoints) > max_checkpoints:
-        os.remove(os.path.join(checkpoint_dir, checkpoints.pop()))
+
+def _shard_hash(state_dict: Dict[str, torch.Tensor]) -> str:
+    """Hash the keys, dtypes, shapes and contents of a state dict."""
+    digest = hashlib.sha256()
+    for key, tensor in state_dict.items():
+        digest.update(f"{key}:{tensor.dtype}:{tuple(tensor.shape)};".encode())
+        digest.update(tensor.contiguous().reshape(-1).view(torch.uint8).numpy())
+    return digest.hexdigest()
+
+
+def _atomic_save(obj: Any, file: Path) -> None:
+    """Save with torch.save to a temporary file and rename it into place."""
+    tmp_file = file.with_suffix(".pt.tmp")
+    torch.save(obj, tmp_file)
+    os.replace(tmp_file, file)
+
+
+def _checkpoint_epoch(file_name: str) -> int:
+    return int(file_name.split("_")[1].split(".")[0])
+
+
+def _snapshot(state: Any) -> Any:
+    """Recursively copy the tensors of a state dict to CPU."""
+    return _map_tensors(state, lambda tensor: tensor.detach().to("cpu", copy=True))
+
+
+def _map_tensors(state: Any, fn: Callable[[torch.Tensor], torch.Tensor]) -> Any:
+    """Apply fn to all tensors in a (nested) state dict."""
+    if isinstance(state, torch.Tensor):
+        return fn(state)
+    if isinstance(state, dict):
+        mapped = type(state)(
+            (key, _map_tensors(value, fn)) for key, value in state.items()
+        )
+        # Module state dicts carry version information used by load_state_dict
+        if hasattr(state, "_metadata"):
+            mapped._metadata = state._metadata  # type: ignore
+        return mapped
+    if isinstance(state, (list, tuple)):
+        return type(state)(_map_tensors(value, fn) for value in state)
+    return state
+
+
+class HistoryLog:
+    """Append-only on-disk log of the training histories, one json line per epoch.
+
+    Readers keep a byte offset into the file, so that repeated reads only parse
+    the epochs that were appended since the last read.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._offset = 0
+
+    def append(self, epoch: int, histories: Dict[str, List[float]]) -> None:
+        """Append the latest value of every history as the record of an epoch."""
+        record: Dict[str, float] = {"epoch": epoch}
+        record.update({key: values[-1] for key, values in histories.items()})
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def rewrite(self, histories: Dict[str, List[float]]) -> None:
+        """Replace the log by the given histories, e.g. when resuming from a checkpoint.
+
+        All histories end at the last epoch, so histories that are shorter than
+        others (e.g. of statistics added during the run) are aligned to the end.
+        """
+        num_epochs = max((len(values) for values in histories.values()), default=0)
+        with open(self.path, "w") as f:
+            for epoch in range(num_epochs):
+                record: Dict[str, float] = {"epoch": epoch}
+                record.update(
+                    {
+                        key: values[epoch - num_epochs + len(values)]
+                        for key, values in histories.items()
+                        if epoch >= num_epochs - len(values)
+                    }
+                )
+                f.write(json.dumps(record) + "\n")
+        self._offset = 0
+
+    def read_new(self) -> List[Dict[str, float]]:
+        """Return the records appended since the last read."""
+        if not self.path.exists():
+            return []
+        with open(self.path, "rb") as f:
+            f.seek(self._offset)
+            lines = f.readlines()
+        # Only consume complete lines, a partially written line is read next time
+        records: List[Dict[str, float]] = []
+        for line in lines:
+            if not line.endswith(b"\n"):
+                break
+            records.append(json.loads(line))
+            self._offset += len(line)
+        return records
 
 
 def delete_results(run_dir: Path) -> None:
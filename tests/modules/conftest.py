@@ -61,3 +61,42 @@ def rl_config() -> Generator[DictConfig, None, None]:
 @pytest.fixture
 def data_root() -> str:
     return "cache"
+
+
+@pytest.fixture
+def small_classifier_config() -> DictConfig:
+    # Small brain (convolutional encoder and classifier) and objective for fast unit
+    # tests, created anew for every test so it can be modified
+    return DictConfig(
+        {
+            "brain": {
+                "sensors": {"vision": [3, 32, 32]},
+                "connections": [["vision", "encoder"], ["encoder", "classifier"]],
+                "circuits": {
+                    "encoder": {
+                        "_target_": "retinal_rl.models.circuits.convolutional.ConvolutionalEncoder",
+                        "num_layers": 2,
+                        "num_channels": [4, 8],
+                        "kernel_size": 4,
+                        "stride": 2,
+                        "activation": "relu",
+                    },
+                    "classifier": {
+                        "_target_": "retinal_rl.models.circuits.fully_connected.FullyConnected",
+                        "output_shape": [10],
+                        "hidden_units": [32],
+                        "activation": "relu",
+                    },
+                },
+            },
+            "objective": {
+                "_target_": "retinal_rl.models.objective.Objective",
+                "losses": [
+                    {
+                        "_target_": "retinal_rl.classification.loss.ClassificationLoss",
+                        "target_circuits": ["__all__"],
+                    }
+                ],
+            },
+        }
+    )
@@ -0,0 +1,233 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+import torch
+
+sys.path.append(".")
+from runner.util import (
+    CheckpointWriter,
+    HistoryLog,
+    load_checkpoint,
+    save_checkpoint,
+)
+
+
+def brain_like_model() -> torch.nn.Module:
+    # Mimics the state dict layout of a Brain
+    model = torch.nn.Module()
+    model._module_dict = torch.nn.ModuleDict(
+        {"encoder": torch.nn.Linear(4, 3), "decoder": torch.nn.Linear(3, 4)}
+    )
+    return model
+
+
+def test_checkpoint_writer(tmp_path: Path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+    histories = {"train_loss": [1.0]}
+
+    writer = CheckpointWriter(tmp_path, checkpoint_dir, max_checkpoints=2)
+    for epoch in range(4):
+        writer.save(model, optimizer, histories, epoch)
+        # Later changes must not leak into the snapshot of this epoch
+        with torch.no_grad():
+            model._module_dict.encoder.weight.add_(1.0)
+        histories["train_loss"].append(float(epoch))
+    writer.close()
+
+    epochs = sorted(f for f in os.listdir(checkpoint_dir) if f.startswith("epoch_"))
+    assert epochs == ["epoch_2.pt", "epoch_3.pt"]
+
+    current = load_checkpoint(tmp_path / "current_checkpoint.pt")
+    last = load_checkpoint(checkpoint_dir / "epoch_3.pt")
+    weight_key = "_module_dict.encoder.weight"
+    assert current["completed_epochs"] == 3
+    assert current["histories"]["train_loss"] == [1.0, 0.0, 1.0, 2.0]
+    assert torch.equal(
+        current["brain_state_dict"][weight_key], last["brain_state_dict"][weight_key]
+    )
+    assert torch.equal(
+        current["brain_state_dict"][weight_key] + 1.0,
+        model._module_dict.encoder.weight.detach(),
+    )
+    model.load_state_dict(current["brain_state_dict"])
+
+
+def test_checkpoint_writer_closed_on_error(tmp_path: Path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+
+    # The pending write is finished when leaving the with block, also on errors
+    with pytest.raises(RuntimeError), CheckpointWriter(
+        tmp_path, checkpoint_dir, max_checkpoints=1
+    ) as writer:
+        writer.save(model, optimizer, {}, 0)
+        raise RuntimeError
+    assert writer._pending is None
+    assert load_checkpoint(tmp_path / "current_checkpoint.pt")["completed_epochs"] == 0
+
+
+def test_flat_checkpoint(tmp_path: Path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+
+    # Flat checkpoints can be read without load_checkpoint
+    save_checkpoint(tmp_path, checkpoint_dir, 1, model, optimizer, {}, 0, flat=True)
+    assert not list((checkpoint_dir / "shards").glob("*.pt"))
+    checkpoint = torch.load(tmp_path / "current_checkpoint.pt")
+    model.load_state_dict(checkpoint["brain_state_dict"])
+
+    # A writer can be reused, and prunes the flat checkpoints it didn't write
+    writer = CheckpointWriter(tmp_path, checkpoint_dir, max_checkpoints=1)
+    for epoch in [1, 2]:
+        save_checkpoint(
+            tmp_path, checkpoint_dir, 1, model, optimizer, {}, epoch, writer
+        )
+        assert writer._pending is None
+    writer.close()
+    assert sorted(os.listdir(checkpoint_dir)) == ["epoch_2.pt", "shards"]
+
+
+def test_missing_shards(tmp_path: Path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+    save_checkpoint(tmp_path, checkpoint_dir, 1, model, optimizer, {}, 0)
+
+    for shard in (checkpoint_dir / "shards").glob("*.pt"):
+        shard.unlink()
+    with pytest.raises(FileNotFoundError, match="weights of circuit"):
+        load_checkpoint(tmp_path / "current_checkpoint.pt")
+
+
+def test_checkpoint_shards_deduplicated(tmp_path: Path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+
+    writer = CheckpointWriter(tmp_path, checkpoint_dir, max_checkpoints=2)
+    for epoch in range(4):
+        writer.save(model, optimizer, {}, epoch)
+        # Only the encoder changes, the decoder is "frozen"
+        with torch.no_grad():
+            model._module_dict.encoder.bias.add_(1.0)
+    writer.close()
+
+    # One decoder shard, and the encoder shards of the two kept epochs
+    assert len(list((checkpoint_dir / "shards").glob("*.pt"))) == 3
+
+    # A new writer picks up the existing shards and keeps pruning them
+    writer = CheckpointWriter(tmp_path, checkpoint_dir, max_checkpoints=1)
+    writer.save(model, optimizer, {}, 4)
+    writer.close()
+    assert len(list((checkpoint_dir / "shards").glob("*.pt"))) == 2
+
+
+def test_checkpoint_orphans_removed_on_close(tmp_path: Path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+
+    writer = CheckpointWriter(tmp_path, checkpoint_dir, max_checkpoints=1)
+    writer.save(model, optimizer, {}, 0)
+    writer.wait()
+    # Shard of an interrupted (or still running) write
+    orphan = checkpoint_dir / "shards" / "orphan.pt"
+    orphan.touch()
+
+    # Creating a writer must not touch the shards
+    CheckpointWriter(tmp_path, checkpoint_dir, max_checkpoints=1).close()
+    writer.close()
+    assert not orphan.exists()
+    assert len(list((checkpoint_dir / "shards").glob("*.pt"))) == 2
+    load_checkpoint(tmp_path / "current_checkpoint.pt")
+
+
+def test_load_checkpoint_other_cwd(tmp_path: Path, monkeypatch):
+    run_dir = tmp_path / "run"
+    checkpoint_dir = run_dir / "checkpoints"
+    checkpoint_dir.mkdir(parents=True)
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+
+    # Written with paths relative to the cwd, as the runner does
+    monkeypatch.chdir(tmp_path)
+    writer = CheckpointWriter(
+        Path("run"), Path("run") / "checkpoints", max_checkpoints=1
+    )
+    writer.save(model, optimizer, {}, 0)
+    writer.close()
+
+    # Load from elsewhere, after moving the run
+    other = tmp_path / "other"
+    other.mkdir()
+    monkeypatch.chdir(other)
+    moved = tmp_path / "moved"
+    run_dir.rename(moved)
+    for checkpoint_file in [
+        moved / "current_checkpoint.pt",
+        moved / "checkpoints" / "epoch_0.pt",
+    ]:
+        checkpoint = load_checkpoint(checkpoint_file)
+        assert torch.equal(
+            checkpoint["brain_state_dict"]["_module_dict.encoder.weight"],
+            model._module_dict.encoder.weight.detach(),
+        )
+
+
+def test_load_checkpoint_subset(tmp_path: Path):
+    model = brain_like_model()
+    optimizer = torch.optim.AdamW(model.parameters())
+    checkpoint_dir = tmp_path / "checkpoints"
+    checkpoint_dir.mkdir()
+
+    writer = CheckpointWriter(tmp_path, checkpoint_dir, max_checkpoints=1)
+    writer.save(model, optimizer, {}, 0)
+    writer.close()
+
+    checkpoint = load_checkpoint(
+        tmp_path / "current_checkpoint.pt",
+        device=torch.device("cpu"),
+        keys=["brain_state_dict"],
+        circuits=["encoder"],
+    )
+    assert list(checkpoint) == ["brain_state_dict"]
+    assert set(checkpoint["brain_state_dict"]) == {
+        "_module_dict.encoder.weight",
+        "_module_dict.encoder.bias",
+    }
+    assert torch.equal(
+        checkpoint["brain_state_dict"]["_module_dict.encoder.weight"],
+        model._module_dict.encoder.weight.detach(),
+    )
+
+
+def test_history_log_rewrite(tmp_path: Path):
+    history_log = HistoryLog(tmp_path / "histories.jsonl")
+    # A statistic that was only recorded from epoch 2 on
+    histories = {"train_loss": [3.0, 2.0, 1.0, 0.5], "profile_ms": [7.0, 8.0]}
+    history_log.rewrite(histories)
+    history_log.append(4, {"train_loss": [0.25], "profile_ms": [9.0]})
+
+    records = history_log.read_new()
+    assert [record["epoch"] for record in records] == [0, 1, 2, 3, 4]
+    assert [record["train_loss"] for record in records] == [3.0, 2.0, 1.0, 0.5, 0.25]
+    assert [record.get("profile_ms") for record in records] == [
+        None,
+        None,
+        7.0,
+        8.0,
+        9.0,
+    ]
+    assert history_log.read_new() == []
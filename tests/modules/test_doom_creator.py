@@ -0,0 +1,271 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+from pathlib import Path
+from typing import List
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+from PIL import Image
+
+sys.path.append(".")
+from doom_creator.util import manifest as manifest_module
+from doom_creator.util.directories import Directories
+from doom_creator.util.manifest import MANIFEST_FILE, TextureManifest
+
+_CLASSES = ["zero", "one", "two", "three", "four"]
+_CLASSES += ["five", "six", "seven", "eight", "nine"]
+
+requires_build_tools = pytest.mark.skipif(
+    shutil.which("acc") is None, reason="Building scenarios needs acc"
+)
+
+
+def write_pngs(class_dir: Path, num: int, seed: int = 0) -> List[Path]:
+    class_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    pngs = []
+    for i in range(num):
+        pixels = rng.integers(0, 256, (8, 8), dtype=np.uint8)
+        Image.fromarray(pixels).save(class_dir / f"{i}.png")
+        pngs.append(class_dir / f"{i}.png")
+    return pngs
+
+
+@pytest.fixture
+def directories(tmp_path: Path) -> Directories:
+    directories = Directories(tmp_path / "cache")
+    for i, name in enumerate(_CLASSES):
+        write_pngs(directories.TEXTURES_DIR / "mnist" / name, 3, seed=i)
+    return directories
+
+
+@pytest.fixture
+def hashed(monkeypatch) -> List[bytes]:
+    # Contents hashed by the texture manifest
+    contents: List[bytes] = []
+    sha256 = hashlib.sha256
+
+    def tracked_sha256(content: bytes):
+        contents.append(content)
+        return sha256(content)
+
+    monkeypatch.setattr(manifest_module.hashlib, "sha256", tracked_sha256)
+    return contents
+
+
+def test_texture_manifest_invalidation(tmp_path: Path, hashed: List[bytes]):
+    pngs = write_pngs(tmp_path / "mnist" / "zero", 2)
+    write_pngs(tmp_path / "apples", 1)
+
+    manifest = TextureManifest(str(tmp_path))
+    assert manifest.pngs("mnist") == [str(png) for png in pngs]
+    assert manifest.pngs("mnist/zero/1.png") == [str(pngs[1])]
+    manifest.save()
+    assert (tmp_path / MANIFEST_FILE).exists()
+    assert len(hashed) == 2
+
+    # An unchanged directory is looked up without hashing
+    hashed.clear()
+    assert TextureManifest(str(tmp_path)).pngs("mnist/zero") == manifest.pngs("mnist")
+    assert not hashed
+
+    # Adding and removing pngs re-indexes, but only new pngs are hashed
+    pngs[0].unlink()
+    new_png = write_pngs(tmp_path / "mnist" / "one", 1)[0]
+    manifest = TextureManifest(str(tmp_path))
+    assert manifest.pngs("mnist") == [str(new_png), str(pngs[1])]
+    assert hashed == [new_png.read_bytes()]
+    manifest.save()
+
+    # A png changed in place is hashed again when the directory is re-indexed
+    hashed.clear()
+    Image.new("L", (4, 4)).save(pngs[1])
+    manifest = TextureManifest(str(tmp_path))
+    manifest.update("mnist", force=True)
+    assert hashed == [pngs[1].read_bytes()]
+    files = {f["path"]: f for f in manifest.entries["mnist"]["files"]}
+    assert set(files) == {
+        os.path.join("mnist", "one", "0.png"),
+        os.path.join("mnist", "zero", "1.png"),
+    }
+    assert (
+        files[os.path.join("mnist", "zero", "1.png")]["hash"]
+        == hashlib.sha256(pngs[1].read_bytes()).hexdigest()
+    )
+
+
+def test_save_doomified(tmp_path: Path):
+    pytest.importorskip("num2words")
+    from doom_creator.util.preload import save_doomified
+
+    images = [(Image.new("RGB", (4, 6)), str(tmp_path / f"{i}.png")) for i in range(3)]
+    assert save_doomified(images, scale=2.0) == 3
+    assert sorted(os.listdir(tmp_path)) == ["0.png", "1.png", "2.png"]
+    with Image.open(tmp_path / "0.png") as img:
+        assert img.size == (8, 12)
+    # The offset chunk centers the sprite horizontally, on its bottom
+    assert b"grAb" + struct.pack(">II", 4, 12) in (tmp_path / "0.png").read_bytes()
+
+
+class StubDataset:
+    def __init__(self, num_images: int):
+        self.targets = [i % 2 for i in range(num_images)]
+
+    def __getitem__(self, i: int):
+        return Image.new("L", (4, 4), color=i), self.targets[i]
+
+
+class StubDatasetWrapper:
+    num_classes = 2
+
+    def __init__(self, num_images: int):
+        self.dataset = StubDataset(num_images)
+
+    def label_to_str(self, i: int) -> str:
+        return _CLASSES[i]
+
+
+def test_preload_dataset_resumes(tmp_path: Path, monkeypatch):
+    pytest.importorskip("num2words")
+    from doom_creator.util.preload import _COMPLETE_MARKER, preload_dataset
+    from doom_creator.util.texture import TextureType
+
+    loaded = []
+
+    # Preload workers are forked, so they load the stub dataset too
+    def get_dataset_wrapper(_self, _source_dir, _train, download=True):
+        loaded.append(download)
+        return StubDatasetWrapper(6)
+
+    monkeypatch.setattr(TextureType, "get_dataset_wrapper", get_dataset_wrapper)
+    out_path = tmp_path / TextureType.MNIST.out_dir(False)
+
+    def preload():
+        # More chunks than can be in flight at once
+        preload_dataset(
+            TextureType.MNIST,
+            str(tmp_path),
+            str(tmp_path),
+            clean=False,
+            num_workers=1,
+            chunk_size=2,
+        )
+
+    preload()
+    assert sorted(os.listdir(out_path / "one")) == ["1.png", "3.png", "5.png"]
+    assert (out_path / _COMPLETE_MARKER).exists()
+
+    # A complete preload isn't checked again
+    preload()
+    assert loaded == [True]
+
+    # Only the incomplete classes of an interrupted preload are written
+    (out_path / _COMPLETE_MARKER).unlink()
+    (out_path / "one" / "3.png").unlink()
+    written = (out_path / "zero" / "0.png").stat().st_mtime_ns
+    preload()
+    assert sorted(os.listdir(out_path / "one")) == ["1.png", "3.png", "5.png"]
+    assert (out_path / "zero" / "0.png").stat().st_mtime_ns == written
+    assert (out_path / _COMPLETE_MARKER).exists()
+
+
+@requires_build_tools
+def test_scenario_build_cache(directories: Directories):
+    pytest.importorskip("omg")
+    from doom_creator.util.config import load
+    from doom_creator.util.make import make_scenario, make_scenarios
+
+    cfg = load(["gathering", "mnist"], directories.SCENARIO_YAML_DIR)
+    assert make_scenario(cfg, directories, "mnist", progress=False)
+    hash_file = directories.SCENARIO_OUT_DIR / "mnist.hash"
+    build_hash = hash_file.read_text()
+    cached = set(os.listdir(directories.BUILD_CACHE_DIR))
+    assert any(f.endswith(".o") for f in cached)
+    assert any(f.endswith(".wad") for f in cached)
+
+    # Nothing changed
+    assert not make_scenario(cfg, directories, "mnist", progress=False)
+
+    # Changing a texture rebuilds the scenario, and reuses the compiled ACS and map
+    texture = directories.TEXTURES_DIR / "mnist" / "six" / "0.png"
+    Image.new("L", (8, 8)).save(texture)
+    assert make_scenario(cfg, directories, "mnist", progress=False)
+    assert hash_file.read_text() != build_hash
+    assert set(os.listdir(directories.BUILD_CACHE_DIR)) == cached
+
+    # Scenarios built by the process pool
+    built = make_scenarios(
+        [(cfg, "mnist"), (cfg, "mnist-copy")], directories, num_workers=2
+    )
+    assert built == 1
+    assert (directories.SCENARIO_OUT_DIR / "mnist-copy.zip").exists()
+    assert not (directories.SCENARIO_OUT_DIR / "build").exists()
+
+
+@requires_build_tools
+def test_packed_sprite_wad(directories: Directories):
+    pytest.importorskip("omg")
+    from doom_creator.util.config import load
+    from doom_creator.util.make import make_scenario
+
+    cfg = load(["gathering", "mnist"], directories.SCENARIO_YAML_DIR)
+    make_scenario(cfg, directories, "mnist", progress=False, packed=True)
+
+    with open(directories.SCENARIO_OUT_DIR / "mnist.textures.json") as f:
+        index = json.load(f)
+    with ZipFile(directories.SCENARIO_OUT_DIR / "mnist.zip") as s_zip:
+        # No sprites besides the WAD
+        sprites = [name for name in s_zip.namelist() if name.startswith("sprites/")]
+        assert sprites == ["sprites/"]
+        wad = s_zip.read("sprites.wad")
+
+    magic, num_lumps, directory_offset = struct.unpack("<4sii", wad[:12])
+    assert magic == b"PWAD"
+    lumps = [
+        struct.unpack("<ii8s", wad[offset : offset + 16])
+        for offset in range(directory_offset, len(wad), 16)
+    ]
+    assert len(lumps) == num_lumps
+    names = [name.rstrip(b"\0").decode() for _, _, name in lumps]
+    assert names[0] == "S_START"
+    assert names[-1] == "S_END"
+    assert names[1:-1] == list(index)
+    for (offset, size, _), name in zip(lumps[1:-1], names[1:-1]):
+        png = directories.TEXTURES_DIR / index[name]
+        assert wad[offset : offset + size] == png.read_bytes()
+
+
+@requires_build_tools
+def test_packed_scenario_starts(directories: Directories):
+    pytest.importorskip("omg")
+    pytest.importorskip("vizdoom")
+    from doom_creator.util.config import load
+    from doom_creator.util.make import make_scenario
+    from retinal_rl.rl.sample_factory.environment import (
+        make_retinal_env_from_spec,
+        retinal_doomspec,
+    )
+    from runner.frameworks.rl.sf_framework import SFFramework
+
+    cfg = load(["gathering", "mnist"], directories.SCENARIO_YAML_DIR)
+    frames = []
+    for name, packed in [("loose", False), ("packed", True)]:
+        make_scenario(cfg, directories, name, progress=False, packed=packed)
+        cfg_path = str(directories.SCENARIO_OUT_DIR / f"{name}.cfg")
+        spec = retinal_doomspec(name, cfg_path, False)
+        sf_cfg = SFFramework._get_default_cfg(name)
+        env = make_retinal_env_from_spec(spec, name, sf_cfg, None)
+        try:
+            obs, _ = env.reset(seed=0)
+        finally:
+            env.close()
+        frames.append(obs)
+
+    # VizDoom finds the sprites of the packed WAD, and renders them as the loose ones
+    assert frames[1].shape == frames[0].shape
+    assert np.array_equal(frames[1], frames[0])
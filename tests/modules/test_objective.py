@@ -6,6 +6,7 @@ from omegaconf import DictConfig
 
 from retinal_rl.classification.loss import ClassificationContext
 from retinal_rl.models.brain import Brain
+from retinal_rl.models.loss import ActivationRegularization, WeightRegularization
 from retinal_rl.models.objective import Objective
 from runner.util import create_brain
 
@@ -107,3 +108,71 @@ def test_objective_all():
     assert (
         grad_sum(brain) != 0
     ), "Objective should change the gradients, but it's still 0."
+
+
+def test_activation_regularization(small_classifier_config: DictConfig):
+    brain = create_brain(small_classifier_config.brain)
+    loss = ActivationRegularization(
+        ["encoder", "classifier"], p=1, target_circuits=["encoder"]
+    )
+    objective: Objective[ClassificationContext] = Objective(brain, [loss])
+
+    input = torch.randn(4, 3, 32, 32)
+    responses = brain({"vision": input})
+    context = ClassificationContext(
+        sources=input,
+        inputs=input,
+        classes=torch.zeros(4, dtype=torch.long),
+        responses=responses,
+        epoch=1,
+    )
+
+    expected = (
+        responses["encoder"].abs().sum() + responses["classifier"].abs().sum()
+    ) / 4
+    assert torch.allclose(loss(context), expected)
+
+    loss_dict = objective.backward(context)
+    assert loss_dict[loss.key_name] == pytest.approx(expected.item(), rel=1e-5)
+    assert grad_sum(brain.circuits["encoder"]) != 0
+    assert grad_sum(brain.circuits["classifier"]) == 0
+
+
+def test_weight_regularization(small_classifier_config: DictConfig):
+    brain = create_brain(small_classifier_config.brain)
+    encoder = brain.circuits["encoder"]
+    input = torch.randn(4, 3, 32, 32)
+    context = ClassificationContext(
+        sources=input,
+        inputs=input,
+        classes=torch.zeros(4, dtype=torch.long),
+        responses=brain({"vision": input}),
+        epoch=1,
+    )
+
+    # Coupled: the gradient of weight * sum(w^2) is accumulated
+    loss = WeightRegularization(target_circuits=["encoder"], weights=[0.1])
+    objective: Objective[ClassificationContext] = Objective(brain, [loss])
+    expected = sum(param.pow(2).sum() for param in encoder.parameters())
+    assert torch.allclose(loss(context), expected)
+    objective.backward(context)
+    for param in encoder.parameters():
+        assert param.grad is not None
+        assert torch.allclose(param.grad, 0.2 * param)
+    assert grad_sum(brain.circuits["classifier"]) == 0
+
+    # Decoupled: the same update is applied in the optimizer step, without autograd
+    before = [param.detach().clone() for param in encoder.parameters()]
+    brain.zero_grad(set_to_none=True)
+    loss = WeightRegularization(
+        decoupled=True, target_circuits=["encoder"], weights=[0.1]
+    )
+    objective = Objective(brain, [loss])
+    optimizer = torch.optim.SGD(brain.parameters(), lr=0.5)
+    objective.register_decoupled_decay(optimizer)
+    loss_dict = objective.backward(context)
+    assert loss_dict[loss.key_name] == pytest.approx(expected.item(), rel=1e-5)
+    assert grad_sum(brain) == 0
+    optimizer.step()
+    for param, param0 in zip(encoder.parameters(), before):
+        assert torch.allclose(param, param0 * (1 - 0.5 * 0.2))
@@ -0,0 +1,64 @@
+import json
+import sys
+import warnings
+from pathlib import Path
+
+import torch
+from hydra.utils import instantiate
+from omegaconf import DictConfig
+
+sys.path.append(".")
+from retinal_rl.classification.loss import (
+    ClassificationContext,
+    get_classification_context,
+)
+from retinal_rl.models.objective import Objective
+from runner.util import create_brain
+
+
+def test_brain_profiling(tmp_path: Path, small_classifier_config: DictConfig):
+    # A single layer per circuit, to count the FLOPs by hand
+    brain_conf = small_classifier_config.brain
+    brain_conf.sensors.vision = [3, 16, 16]
+    brain_conf.circuits.encoder.num_layers = 1
+    brain_conf.circuits.encoder.num_channels = [4]
+    brain_conf.circuits.classifier.hidden_units = []
+    brain = create_brain(brain_conf)
+    objective: Objective[ClassificationContext] = instantiate(
+        small_classifier_config.objective, brain=brain
+    )
+    images = torch.rand(8, 3, 16, 16)
+    batch = (images, images, torch.randint(0, 10, (8,)))
+
+    profiler = brain.enable_profiling(trace=True)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        for _ in range(2):
+            context = get_classification_context(torch.device("cpu"), brain, batch, 1)
+            objective.backward(context)
+    summary = profiler.summary()
+
+    # Nothing is recorded while paused
+    with profiler.paused():
+        context = get_classification_context(torch.device("cpu"), brain, batch, 1)
+        objective.backward(context)
+    assert profiler.summary() == summary
+
+    encoder_output = brain.circuits["encoder"](images)
+    conv_flops = 2 * (encoder_output.numel() / 8) * 8 * 3 * 4 * 4
+    assert summary["profile_encoder_flops"] == conv_flops
+    assert summary["profile_classifier_flops"] == 2 * 8 * 10 * encoder_output[0].numel()
+    assert summary["profile_encoder_activation_bytes"] == 4 * encoder_output.numel()
+    assert summary["profile_encoder_forward_ms"] > 0
+    assert summary["profile_classifier_backward_ms"] > 0
+    # The encoder reads from the sensor, its backward pass ends with its parameters
+    assert summary["profile_encoder_backward_ms"] > 0
+
+    profiler.export_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json") as f:
+        events = json.load(f)["traceEvents"]
+    assert {event["name"] for event in events} == {"encoder", "classifier"}
+
+    brain.disable_profiling()
+    assert not brain.circuits["encoder"]._forward_hooks
+    assert not next(brain.circuits["encoder"].parameters())._backward_hooks
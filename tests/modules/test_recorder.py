@@ -0,0 +1,74 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.append(".")
+from retinal_rl.rl.analysis.recorder import (
+    SimulationRecorder,
+    load_simulation,
+    read_frames,
+    write_frames,
+)
+
+
+def test_recorder_roundtrip(tmp_path: Path):
+    num_envs = 3
+    fields = {"vals": ((), np.float32), "ltnts": ((4,), np.float32)}
+    recorder = SimulationRecorder(tmp_path / "sim", num_envs, fields, chunk_size=4)
+
+    rng = np.random.default_rng(0)
+    vals = rng.standard_normal((10, num_envs)).astype(np.float32)
+    ltnts = rng.standard_normal((10, num_envs, 4)).astype(np.float32)
+    for t in range(10):
+        recorder.record(vals=vals[t], ltnts=ltnts[t])
+    recorder.close()
+
+    # Three chunks of four frames, the last one partially filled
+    assert len(list((tmp_path / "sim").glob("vals_*.npy"))) == 3
+
+    records = load_simulation(tmp_path / "sim")
+    assert np.array_equal(records["vals"], vals)
+    assert np.array_equal(records["ltnts"], ltnts)
+    assert list(load_simulation(tmp_path / "sim", ["vals"])) == ["vals"]
+
+
+def test_recorder_append(tmp_path: Path):
+    fields = {"imgs": ((2, 2, 3), np.uint8), "attrs": ((2, 2, 3), np.float16)}
+    imgs = np.arange(9 * 2 * 12, dtype=np.uint8).reshape(9, 2, 2, 2, 3)
+
+    recorder = SimulationRecorder(tmp_path, 2, fields, chunk_size=4)
+    for t in range(6):
+        recorder.record(imgs=imgs[t])
+    recorder.close()
+    first_chunk = (tmp_path / "imgs_00000.npy").stat().st_mtime_ns
+
+    recorder = SimulationRecorder(tmp_path, 2, fields, chunk_size=4, append=True)
+    assert recorder.num_frames == 6
+    for t in range(6, 9):
+        recorder.record(imgs=imgs[t])
+    recorder.close()
+
+    # The full first chunk is not rewritten
+    assert (tmp_path / "imgs_00000.npy").stat().st_mtime_ns == first_chunk
+    records = load_simulation(tmp_path)
+    assert np.array_equal(records["imgs"], imgs)
+    assert records["attrs"].dtype == np.float16
+
+
+def test_read_write_frames(tmp_path: Path):
+    fields = {"vals": ((), np.float32), "attrs": ((2,), np.float16)}
+    recorder = SimulationRecorder(tmp_path, 2, fields, chunk_size=4)
+    for t in range(10):
+        recorder.record(vals=np.full(2, t))
+    recorder.close()
+
+    frames = read_frames(tmp_path, ["vals"], [1, 3, 4, 9])["vals"]
+    assert np.array_equal(frames[:, 0], [1, 3, 4, 9])
+
+    # Fill a derived field across a chunk boundary
+    attrs = np.ones((5, 2, 2), dtype=np.float16)
+    write_frames(tmp_path, "attrs", 2, attrs)
+    records = load_simulation(tmp_path, ["attrs"])
+    assert records["attrs"][2:7].sum() == 20
+    assert records["attrs"].sum() == 20
@@ -1,6 +1,13 @@
 import sys
 
-from omegaconf import DictConfig
+import gymnasium as gym
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+from sample_factory.algo.learning.rnn_utils import (
+    build_core_out_from_seq,
+    build_rnn_inputs,
+)
 from sample_factory.algo.utils.context import global_model_factory
 from sample_factory.algo.utils.make_env import make_env_func_batched
 from sample_factory.algo.utils.misc import ExperimentStatus
@@ -9,7 +16,10 @@ from sample_factory.train import make_runner
 from sample_factory.utils.attr_dict import AttrDict
 
 sys.path.append(".")
-from retinal_rl.rl.sample_factory.environment import register_retinal_env
+from retinal_rl.rl.sample_factory.environment import (
+    SatietyInput,
+    register_retinal_env,
+)
 from retinal_rl.rl.sample_factory.models import SampleFactoryBrain
 from runner.frameworks.rl.sf_framework import SFFramework
 
@@ -30,3 +40,246 @@ def test_actor_critic_brain(rl_config: DictConfig, data_root: str):
     )
 
     create_actor_critic(sf_cfg, env.observation_space, env.action_space)
+
+
+class StubDoomEnv(gym.Env):
+    observation_space = gym.spaces.Box(0, 255, (4, 4, 3), dtype=np.uint8)
+    action_space = gym.spaces.Discrete(3)
+
+    def __init__(self):
+        self.health = 100.0
+
+    def reset(self, **kwargs):
+        return np.zeros((4, 4, 3), dtype=np.uint8), {"HEALTH": self.health}
+
+    def step(self, action):
+        self.health -= 25.0
+        obs = np.full((4, 4, 3), action, dtype=np.uint8)
+        return obs, 0.0, False, False, {"HEALTH": self.health}
+
+
+def test_satiety_input_observations():
+    env = SatietyInput(StubDoomEnv())
+    first, _ = env.reset()
+    second, *_ = env.step(1)
+    third, *_ = env.step(2)
+
+    # Kept observations aren't overwritten by later steps
+    assert first["measurements"] == np.float32(1.0)
+    assert second["measurements"] == np.float32(0.5)
+    assert third["measurements"] == np.float32(0.0)
+    assert second["obs"][0, 0, 0] == 1
+    assert second is not third
+    assert second["measurements"] is not third["measurements"]
+    assert env.observation_space.contains(third)
+
+
+def test_recurrent_core(rl_config: DictConfig):
+    OmegaConf.set_struct(rl_config, False)
+    rl_config.brain.connections = [
+        ["vision", "encoder"],
+        ["encoder", "rnn"],
+        ["rnn", "action_decoder"],
+    ]
+    rl_config.brain.circuits.rnn = {
+        "_target_": "retinal_rl.models.circuits.latent_core.LatentRNN",
+        "rnn_size": 16,
+        "rnn_num_layers": 2,
+    }
+    sf_cfg = SFFramework.to_sf_cfg(rl_config)
+    assert sf_cfg.use_rnn and sf_cfg.rnn_size * sf_cfg.rnn_num_layers == 32
+    sf_cfg.normalize_input = False
+
+    obs_shape = tuple(rl_config.brain.sensors.vision)
+    obs_space = gym.spaces.Dict({"obs": gym.spaces.Box(0, 1, obs_shape)})
+    actor_critic = SampleFactoryBrain(sf_cfg, obs_space, gym.spaces.Discrete(3))
+    assert actor_critic.rnn_name == "rnn"
+
+    # Two rollouts of four steps, the first one with an episode ending after step one
+    rollout = 4
+    head = actor_critic.forward_head({"obs": torch.rand(2 * rollout, *obs_shape)})
+    dones = torch.tensor([0.0, 1, 0, 0, 0, 0, 0, 0])
+    rnn_states = torch.rand(2 * rollout, 32)
+
+    head_seq, seq_states, inverted_inds = build_rnn_inputs(
+        head, dones, rnn_states, rollout
+    )
+    core_seq, _ = actor_critic.forward_core(head_seq, seq_states)
+    core = build_core_out_from_seq(core_seq, inverted_inds)
+
+    # Stepping through the rollouts one by one gives the same outputs
+    for i in range(2 * rollout):
+        if i % rollout == 0:
+            state = rnn_states[i : i + 1]
+        elif dones[i - 1]:
+            state = torch.zeros_like(state)
+        out, state = actor_critic.forward_core(head[i : i + 1], state)
+        assert torch.allclose(core[i], out[0], atol=1e-5)
+
+
+def test_partition(rl_config: DictConfig):
+    # Core with a skip connection around it, a second sensor, and an auxiliary decoder
+    OmegaConf.set_struct(rl_config, False)
+    rl_config.brain.sensors.measurements = [1]
+    rl_config.brain.connections = [
+        ["vision", "encoder"],
+        ["encoder", "latent"],
+        ["latent", "action_decoder"],
+        ["encoder", "action_decoder"],
+        ["measurements", "action_decoder"],
+        ["encoder", "reconstruction"],
+    ]
+    linear = {
+        "_target_": "retinal_rl.models.circuits.fully_connected.FullyConnected",
+        "hidden_units": [],
+        "activation": "elu",
+    }
+    rl_config.brain.circuits.latent = {**linear, "output_shape": [32]}
+    rl_config.brain.circuits.reconstruction = {**linear, "output_shape": [8]}
+    sf_cfg = SFFramework.to_sf_cfg(rl_config)
+    sf_cfg.normalize_input = False
+
+    obs_shape = tuple(rl_config.brain.sensors.vision)
+    obs_space = gym.spaces.Dict(
+        {
+            "obs": gym.spaces.Box(0, 1, obs_shape),
+            "measurements": gym.spaces.Box(-1, 1, (1,)),
+        }
+    )
+    actor_critic = SampleFactoryBrain(sf_cfg, obs_space, gym.spaces.Discrete(3))
+    assert actor_critic.head_plan == ["encoder"]
+    assert actor_critic.core_plan == ["latent"]
+    assert actor_critic.tail_plan == ["action_decoder"]
+
+    obs = {"obs": torch.rand(4, *obs_shape), "measurements": torch.rand(4, 1)}
+    result = actor_critic(obs, torch.zeros(4, 1))
+    responses = actor_critic.brain(
+        {"vision": obs["obs"], "measurements": obs["measurements"]}
+    )
+    action_logits = actor_critic.action_parameterization.distribution_linear(
+        responses["action_decoder"].flatten(1)
+    )
+    assert torch.allclose(result["action_logits"], action_logits)
+
+
+def test_objective_gradients(rl_config: DictConfig):
+    OmegaConf.set_struct(rl_config, False)
+    rl_config.brain.connections.append(["encoder", "auxiliary"])
+    rl_config.brain.circuits.auxiliary = {
+        "_target_": "retinal_rl.models.circuits.fully_connected.FullyConnected",
+        "output_shape": [8],
+        "hidden_units": [],
+        "activation": "elu",
+    }
+    rl_config.optimizer.objective = {
+        "_target_": "retinal_rl.models.objective.Objective",
+        "losses": [
+            {
+                "_target_": "retinal_rl.models.loss.L1Sparsity",
+                "target_response": "auxiliary",
+                "target_circuits": ["encoder", "auxiliary"],
+                "weights": [0.5, 1],
+            }
+        ],
+    }
+    rl_config.logging.profile = True
+    sf_cfg = SFFramework.to_sf_cfg(rl_config)
+    sf_cfg.normalize_input = False
+
+    obs_shape = tuple(rl_config.brain.sensors.vision)
+    obs_space = gym.spaces.Dict({"obs": gym.spaces.Box(0, 1, obs_shape)})
+    actor_critic = SampleFactoryBrain(sf_cfg, obs_space, gym.spaces.Discrete(3))
+    encoder = actor_critic.brain.circuits["encoder"]
+    auxiliary = actor_critic.brain.circuits["auxiliary"]
+
+    # A learner step: forward without sampling actions, then backward of a loss
+    obs = {"obs": torch.rand(4, *obs_shape)}
+    head = actor_critic.forward_head(obs)
+    core, _ = actor_critic.forward_core(head, torch.zeros(4, 1))
+    result = actor_critic.forward_tail(core, values_only=False, sample_actions=False)
+    result["values"].sum().backward()
+
+    # Reference: the gradients of the loss plus the weighted objective gradients
+    grads = [p.grad for p in actor_critic.parameters()]
+    actor_critic.zero_grad(set_to_none=True)
+    responses = actor_critic.brain({"vision": obs["obs"]})
+    values = actor_critic.critic_linear(responses["action_decoder"].flatten(1))
+    values.sum().backward(retain_graph=True)
+    sparsity = responses["auxiliary"].abs().mean()
+    for circuit, weight in [(encoder, 0.5), (auxiliary, 1.0)]:
+        params = list(circuit.parameters())
+        circuit_grads = torch.autograd.grad(sparsity, params, retain_graph=True)
+        for param, grad in zip(params, circuit_grads):
+            if param.grad is None:
+                param.grad = weight * grad
+            else:
+                param.grad += weight * grad
+
+    for param, grad in zip(actor_critic.parameters(), grads):
+        assert (grad is None) == (param.grad is None)
+        if grad is not None:
+            assert torch.allclose(grad, param.grad, atol=1e-6)
+
+    summaries = actor_critic.summaries()
+    assert "objective_l1_sparsity_auxiliary" in summaries
+    assert "objective_l1_sparsity_auxiliary_ms" in summaries
+    assert summaries["profile_auxiliary_flops"] > 0
+    assert summaries["profile_auxiliary_backward_ms"] > 0
+
+
+def test_objective_train_steps(rl_config: DictConfig):
+    OmegaConf.set_struct(rl_config, False)
+    rl_config.optimizer.objective = {
+        "_target_": "retinal_rl.models.objective.Objective",
+        "losses": [
+            {
+                "_target_": "retinal_rl.models.loss.WeightRegularization",
+                "decoupled": True,
+                "target_circuits": ["encoder"],
+                "weights": [0.1],
+            }
+        ],
+    }
+    sf_cfg = SFFramework.to_sf_cfg(rl_config)
+    sf_cfg.normalize_input = False
+    sf_cfg.num_epochs = 1
+    sf_cfg.num_batches_per_epoch = 2
+
+    obs_shape = tuple(rl_config.brain.sensors.vision)
+    obs_space = gym.spaces.Dict({"obs": gym.spaces.Box(0, 1, obs_shape)})
+    actor_critic = SampleFactoryBrain(sf_cfg, obs_space, gym.spaces.Discrete(3))
+    encoder = actor_critic.brain.circuits["encoder"]
+    optimizer = torch.optim.SGD(actor_critic.parameters(), lr=0.5)
+
+    def learner_step():
+        obs = {"obs": torch.rand(4, *obs_shape)}
+        head = actor_critic.forward_head(obs)
+        core, _ = actor_critic.forward_core(head, torch.zeros(4, 1))
+        actor_critic.forward_tail(core, values_only=False, sample_actions=False)
+        # Without gradients, only the decoupled decay changes the parameters
+        before = [param.detach().clone() for param in encoder.parameters()]
+        optimizer.step()
+        for param, param0 in zip(encoder.parameters(), before):
+            assert torch.allclose(param, param0 * (1 - 0.5 * 0.2))
+
+    # Rollouts and optimizers of other models don't count as train steps
+    obs = {"obs": torch.rand(4, *obs_shape)}
+    actor_critic(obs, torch.zeros(4, 1))
+    torch.optim.SGD([torch.nn.Parameter(torch.zeros(1))], lr=0.1).step()
+    assert actor_critic.train_steps == 0
+
+    for step in range(3):
+        learner_step()
+        assert actor_critic.objective is not None
+        assert actor_critic.objective.epoch == step // 2
+    assert actor_critic.train_steps == 3
+
+    # The train steps are restored from checkpoints, older ones start from zero
+    state_dict = actor_critic.state_dict()
+    restored = SampleFactoryBrain(sf_cfg, obs_space, gym.spaces.Discrete(3))
+    restored.load_state_dict(state_dict)
+    assert restored.train_steps == 3
+    del state_dict["_extra_state"]
+    restored.load_state_dict(state_dict)
+    assert restored.train_steps == 0
+    assert actor_critic(obs, torch.zeros(4, 1))["values"].shape == (4,)
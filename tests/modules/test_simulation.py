@@ -0,0 +1,158 @@
+import sys
+from typing import List
+
+import numpy as np
+import pytest
+import torch
+from sample_factory.utils.attr_dict import AttrDict
+
+sys.path.append(".")
+from retinal_rl.rl.analysis import simulation
+from retinal_rl.rl.analysis.simulation import EnvPool, VectorizedEnvs
+
+
+class StubEnv:
+    observation_space = None
+    action_space = None
+
+    def __init__(self, env_id: int):
+        self.env_id = env_id
+        self.closed = False
+        self.resets = 0
+
+    def reset(self):
+        self.resets += 1
+        return {"obs": torch.full((1, 1), self.env_id)}, {}
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def created(monkeypatch) -> List[StubEnv]:
+    envs: List[StubEnv] = []
+
+    def make_env(_cfg, env_config, render_mode):
+        assert render_mode == "rgb_array"
+        envs.append(StubEnv(env_config.env_id))
+        return envs[-1]
+
+    monkeypatch.setattr(simulation, "make_env_func_batched", make_env)
+    return envs
+
+
+def env_cfg(env: str) -> AttrDict:
+    return AttrDict(
+        env=env, env_frameskip=1, eval_env_frameskip=1, res_w=160, res_h=120
+    )
+
+
+def test_env_pool_reuses_envs(created: List[StubEnv]):
+    pool = EnvPool()
+    envs = pool.checkout(env_cfg("apples"), 2)
+    assert envs.num_envs == 2
+    assert [env.env_id for env in created] == [0, 1]
+    pool.checkin(envs)
+
+    # Idle environments are reused, and only the missing ones are created
+    envs = pool.checkout(env_cfg("apples"), 3)
+    assert len(created) == 3
+    assert set(envs.envs) == set(created)
+    assert created[2].env_id == 2
+    pool.checkin(envs)
+
+    # Reused environments are reset again
+    assert [env.resets for env in created] == [2, 2, 1]
+
+    # Environments of other settings aren't shared
+    with pool.lease(env_cfg("mnist"), 1) as envs:
+        assert envs.envs[0] is created[3]
+    with pool.lease(env_cfg("mnist"), 1) as envs:
+        assert envs.envs[0] is created[3]
+    assert len(created) == 4
+
+    pool.close()
+    assert all(env.closed for env in created)
+
+
+def test_env_pool_max_idle_envs(created: List[StubEnv]):
+    pool = EnvPool(max_idle_envs=1)
+    with pool.lease(env_cfg("apples"), 3):
+        pass
+    assert [env.closed for env in created] == [False, True, True]
+
+    with pool.lease(env_cfg("apples"), 1) as envs:
+        assert envs.envs == created[:1]
+    assert len(created) == 3
+
+    pool.close()
+    assert created[0].closed
+
+
+def test_env_pool_lease_checks_in_on_error(created: List[StubEnv]):
+    pool = EnvPool()
+    with pytest.raises(RuntimeError), pool.lease(env_cfg("apples"), 1):
+        raise RuntimeError
+    assert not created[0].closed
+
+    with pool.lease(env_cfg("apples"), 1) as envs:
+        assert envs.envs == created
+
+
+class StepEnv(StubEnv):
+    def step(self, action):
+        obs = {"obs": torch.full((1, 1), self.env_id) + action}
+        done = torch.tensor([self.env_id == 1])
+        return obs, torch.tensor([float(self.env_id)]), done, torch.tensor([False]), {}
+
+
+def test_vectorized_envs_step():
+    envs = VectorizedEnvs([StepEnv(i) for i in range(3)])
+    assert envs.reset()["obs"].flatten().tolist() == [0, 1, 2]
+    # Environments aren't reset again before they are stepped
+    envs.reset()
+    assert [env.resets for env in envs.envs] == [1, 1, 1]
+
+    # Results are stacked in the order of the environments
+    obs_dict, rewards, dones = envs.step(torch.tensor([[10], [20], [30]]))
+    assert obs_dict["obs"].flatten().tolist() == [10, 21, 32]
+    assert rewards.tolist() == [0.0, 1.0, 2.0]
+    assert dones.tolist() == [False, True, False]
+    envs.reset()
+    assert [env.resets for env in envs.envs] == [2, 2, 2]
+
+    envs.close()
+    assert envs._executor is None
+    assert all(env.closed for env in envs.envs)
+
+
+def test_reset_done_states():
+    rnn_states = torch.ones(3, 2)
+    rnn_states = simulation._reset_done_states(
+        rnn_states, np.array([False, True, False])
+    )
+    assert rnn_states.tolist() == [[1.0, 1.0], [0.0, 0.0], [1.0, 1.0]]
+
+
+def test_env_pool_checkout_errors(created: List[StubEnv], monkeypatch):
+    pool = EnvPool()
+    with pool.lease(env_cfg("apples"), 1):
+        pass
+
+    def fail(*_):
+        raise RuntimeError
+
+    # Environments are returned to the pool if the model can't be loaded
+    monkeypatch.setattr(simulation, "create_actor_critic", fail)
+    with pytest.raises(RuntimeError):
+        simulation.get_brain_env(env_cfg("apples"), {}, env_pool=pool)
+    assert not created[0].closed
+    with pool.lease(env_cfg("apples"), 1) as envs:
+        assert envs.envs == created[:1]
+
+    # Environments that fail to reset are closed, including the idle ones
+    monkeypatch.setattr(StubEnv, "reset", fail)
+    with pytest.raises(RuntimeError):
+        pool.checkout(env_cfg("apples"), 2)
+    assert all(env.closed for env in created)
+    assert not pool._keys
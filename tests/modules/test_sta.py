@@ -0,0 +1,39 @@
+import sys
+
+import torch
+from torch import nn
+
+sys.path.append(".")
+from retinal_rl.rl.analysis.statistics import gaussian_noise_sta
+
+
+def test_gaussian_noise_sta_streaming():
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Conv2d(3, 4, 3), nn.ReLU(), nn.Conv2d(4, 5, 3))
+    input_shape = (3, 9, 9)
+    window = (2, 7, 2, 7)
+
+    # A memory budget of two samples (2 x 368 floats) per batch
+    weighted, weight_sums = gaussian_noise_sta(
+        model,
+        input_shape,
+        100,
+        output_index=(2, 2),
+        window=window,
+        memory_budget=2 * 368 * 4,
+        generator=torch.Generator().manual_seed(1),
+    )
+
+    # Reference: the same noise batches, expanded per channel
+    generator = torch.Generator().manual_seed(1)
+    inputs = torch.cat(
+        [torch.randn(2, *input_shape, generator=generator) for _ in range(50)]
+    )
+    with torch.no_grad():
+        outputs = model(inputs)[:, :, 2, 2]
+    crop = inputs[:, None, :, 2:7, 2:7]
+    expected = (outputs[:, :, None, None, None] * crop).sum(0)
+
+    assert weighted.shape == (5, 3, 5, 5)
+    assert torch.allclose(weighted.float(), expected, atol=1e-4)
+    assert torch.allclose(weight_sums.float(), outputs.sum(0), atol=1e-4)
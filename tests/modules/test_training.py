@@ -0,0 +1,173 @@
+import copy
+import sys
+from pathlib import Path
+
+import torch
+from hydra.utils import instantiate
+from omegaconf import DictConfig
+from torch.utils.data import DataLoader, TensorDataset
+
+sys.path.append(".")
+from retinal_rl.classification.loss import ClassificationContext
+from retinal_rl.classification.training import (
+    MixedPrecision,
+    find_max_micro_batch_size,
+    process_dataset,
+)
+from retinal_rl.models.brain import Brain
+from retinal_rl.models.objective import Objective
+from runner.util import create_brain
+
+
+def synthetic_loader(num_samples: int, seed: int, batch_size: int = 16) -> DataLoader:
+    generator = torch.Generator().manual_seed(seed)
+    images = torch.rand(num_samples, 3, 32, 32, generator=generator) * 2 - 1
+    classes = torch.randint(0, 10, (num_samples,), generator=generator)
+    return DataLoader(TensorDataset(images, images, classes), batch_size=batch_size)
+
+
+def train_and_test(
+    brain: Brain, obj_conf: DictConfig, precision: MixedPrecision
+) -> dict[str, float]:
+    device = torch.device("cpu")
+    objective: Objective[ClassificationContext] = instantiate(obj_conf, brain=brain)
+    optimizer = torch.optim.SGD(brain.parameters(), lr=0.01)
+    process_dataset(
+        device,
+        brain,
+        objective,
+        optimizer,
+        1,
+        synthetic_loader(64, seed=0),
+        is_training=True,
+        precision=precision,
+    )
+    return process_dataset(
+        device,
+        brain,
+        objective,
+        optimizer,
+        1,
+        synthetic_loader(64, seed=1),
+        is_training=False,
+        precision=precision,
+    )
+
+
+def test_bf16_parity(small_classifier_config: DictConfig):
+    torch.manual_seed(0)
+    brain = create_brain(small_classifier_config.brain)
+    obj_conf = small_classifier_config.objective
+    device = torch.device("cpu")
+
+    fp32_metrics = train_and_test(
+        copy.deepcopy(brain), obj_conf, MixedPrecision(device)
+    )
+    bf16_metrics = train_and_test(
+        copy.deepcopy(brain), obj_conf, MixedPrecision(device, "bf16")
+    )
+
+    assert fp32_metrics.keys() == bf16_metrics.keys()
+    for key, value in fp32_metrics.items():
+        assert abs(bf16_metrics[key] - value) < 0.05 * abs(value) + 1e-3, key
+
+
+def test_gradient_accumulation_parity(small_classifier_config: DictConfig):
+    torch.manual_seed(0)
+    brain = create_brain(small_classifier_config.brain)
+    device = torch.device("cpu")
+
+    def train(batch_size: int, micro_batch_size, accumulation_steps: int) -> Brain:
+        model = copy.deepcopy(brain)
+        objective: Objective[ClassificationContext] = instantiate(
+            small_classifier_config.objective, brain=model
+        )
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+        process_dataset(
+            device,
+            model,
+            objective,
+            optimizer,
+            1,
+            synthetic_loader(32, seed=0, batch_size=batch_size),
+            is_training=True,
+            micro_batch_size=micro_batch_size,
+            accumulation_steps=accumulation_steps,
+        )
+        return model
+
+    # Two steps over batches of 16, however the batches are split up
+    reference = train(16, None, 1)
+    for model in [train(16, 5, 1), train(8, None, 2), train(4, 3, 4)]:
+        for param, reference_param in zip(model.parameters(), reference.parameters()):
+            assert torch.allclose(param, reference_param, atol=1e-5)
+
+
+def test_find_max_micro_batch_size(tmp_path: Path, small_classifier_config: DictConfig):
+    brain = create_brain(small_classifier_config.brain)
+    device = torch.device("cpu")
+    objective: Objective[ClassificationContext] = instantiate(
+        small_classifier_config.objective, brain=brain
+    )
+    batch = next(iter(synthetic_loader(16, seed=0)))
+    cache_file = tmp_path / "micro_batch_size.json"
+
+    size = find_max_micro_batch_size(
+        device, brain, objective, batch, 1, cache_file=cache_file
+    )
+    assert size == 16
+    assert cache_file.exists()
+    assert all(param.grad is None for param in brain.parameters())
+
+
+def test_fp16_losses_out_of_epochs(small_classifier_config: DictConfig):
+    brain = create_brain(small_classifier_config.brain)
+    device = torch.device("cpu")
+    small_classifier_config.objective.losses[0].min_epoch = 5
+    objective: Objective[ClassificationContext] = instantiate(
+        small_classifier_config.objective, brain=brain
+    )
+    optimizer = torch.optim.SGD(brain.parameters(), lr=0.01)
+    weights = copy.deepcopy(brain.state_dict())
+
+    # No loss is trained in epoch 1, so there are no gradients to step with
+    process_dataset(
+        device,
+        brain,
+        objective,
+        optimizer,
+        1,
+        synthetic_loader(32, seed=0),
+        is_training=True,
+        precision=MixedPrecision(device, "fp16"),
+    )
+    for key, value in brain.state_dict().items():
+        assert torch.equal(value, weights[key]), key
+
+
+def test_backward_outside_autocast(small_classifier_config: DictConfig):
+    brain = create_brain(small_classifier_config.brain)
+    device = torch.device("cpu")
+    objective: Objective[ClassificationContext] = instantiate(
+        small_classifier_config.objective, brain=brain
+    )
+    optimizer = torch.optim.SGD(brain.parameters(), lr=0.01)
+
+    # CPU backward passes run on this thread, so the hooks see its autocast state
+    autocast_in_backward = []
+    for param in brain.parameters():
+        param.register_hook(
+            lambda _grad: autocast_in_backward.append(torch.is_autocast_enabled("cpu"))
+        )
+    process_dataset(
+        device,
+        brain,
+        objective,
+        optimizer,
+        1,
+        synthetic_loader(16, seed=0),
+        is_training=True,
+        precision=MixedPrecision(device, "bf16"),
+    )
+    assert autocast_in_backward
+    assert not any(autocast_in_backward)